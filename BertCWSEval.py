@@ -227,22 +227,14 @@ def test_ontonotes_file(model, args):
     for part in tqdm(parts):
         text_file = os.path.join(args.data_dir, 'eval_data/ontonotes_'+part+'.txt') #  data in text
         output_file = os.path.join(args.output_dir, 'ontonotes_'+part+'.txt') #  data in text
-        st_read = time.time()
-        with open(text_file, 'r') as f:
-            sents = f.readlines()
-        end_read = time.time()
-        print('reading time: {:.3f} seconds'.format(end_read-st_read))
-
-        outputT = model.cutlist_noUNK(sents)
-        end_decode = time.time()
-        print('decode time: {:.3f} seconds'.format(end_decode-end_read))
-
-        with open(output_file, 'a+') as f:
-            for lst in outputT:
+        st_decode = time.time()
+        with open(text_file, 'r') as f, open(output_file, 'a+') as fo:
+            # segment_stream keeps memory bounded for large files
+            for lst in model.segment_stream(f):
                 outstr = ' '.join(lst)
-                f.writelines(outstr + '\n')
-        end_write = time.time()
-        print('write time: {:.3f} seconds'.format(end_write-end_decode))
+                fo.writelines(outstr + '\n')
+        end_decode = time.time()
+        print('decode and write time: {:.3f} seconds'.format(end_decode-st_decode))
 
         print(part + ' done!')
 
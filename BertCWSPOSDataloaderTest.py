@@ -15,7 +15,7 @@ from tqdm import tqdm, trange
 from src.config import args
 from src.preprocess import CWS_POS # dataset_to_dataloader, randomly_mask_input, OntoNotesDataset
 import time
-from src.utilis import get_dataset_and_dataloader, get_eval_dataloaders
+from src.preprocess import get_dataset_and_dataloader, get_packed_dataset_and_dataloader, get_eval_dataloaders
 from src.BERT.optimization import BertAdam
 from src.metrics import outputFscoreUsedBIO, outputPOSFscoreUsedBIO
 
@@ -166,10 +166,11 @@ def do_train(model, train_dataloader, optimizer, param_optimizer, device, args,
                 input_ids = input_ids.to(device)
                 label_ids = label_ids.to(device)
             else:
-                label_ids, pos_label_ids = batch[3:] #if len(batch[3:])>2 else batch[3]
+                label_ids, pos_label_ids = batch[3:5] #if len(batch[3:])>2 else batch[3]
                 #pos_label_ids = batch[4:] if len(batch[4:])>1 else batch[4]
+            pack_ids = batch[5] if len(batch) > 5 else None # see PackedDataset
 
-            loss = model(input_ids, segment_ids, input_mask, label_ids, pos_label_ids)
+            loss = model(input_ids, segment_ids, input_mask, label_ids, pos_label_ids, pack_ids=pack_ids)
 
             n_gpu = torch.cuda.device_count()
             if n_gpu > 1: # or loss.shape[0] > 1:
@@ -451,7 +452,10 @@ def train_CWS_POS(args):
     os.system('mkdir %s' %args.output_dir)
     os.system('chmod 777 %s' %args.output_dir)
 
-    train_dataset, train_dataloader = get_dataset_and_dataloader(processor, args, training=True, type = 'train')
+    if args.pack_sequences:
+        train_dataset, train_dataloader = get_packed_dataset_and_dataloader(processor, args, type_name='train')
+    else:
+        train_dataset, train_dataloader = get_dataset_and_dataloader(processor, args, training=True, type_name='train')
 
     eval_dataloaders = get_eval_dataloaders(processor, args)
 
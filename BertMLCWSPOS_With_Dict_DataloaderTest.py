@@ -29,7 +29,9 @@ from src.BERT.modeling import BertConfig
 # `BertConfig`. To create a models from a Google pretrained models use
 # `models = BertVariant.from_pretrained(PRETRAINED_MODEL_NAME)`
 
-from src.customize_modeling import BertMLVariantCWSPOS_with_Dict
+from src.customize_modeling import BertMLVariantCWSPOS_with_Dict, use_sparse_qkv, use_transition_constraints
+from src.head_pruning import match_pruned_heads
+from src.TorchCRF import CRF
 from tensorboardX import SummaryWriter
 
 import logging
@@ -109,6 +111,8 @@ def load_CWS_POS_model(CWS_label_list, POS_label_list, args):
 
         # main code copy from modeling.py line after 506
         state_dict = torch.load(weights_path)
+        # bert_model_dir may hold a pruned model, e.g., exported by src/ffn_pruning.py
+        match_pruned_heads(model, state_dict)
 
         missing_keys = []
         unexpected_keys = []
@@ -134,6 +138,18 @@ def load_CWS_POS_model(CWS_label_list, POS_label_list, args):
             logger.info("Weights from pretrained models not used in {}: {}".format(
                 model.__class__.__name__, unexpected_keys))
 
+    if args.sparse_qkv:
+        # after loading the dense pre-trained weights, before loading any fine-tuned sparse weights
+        use_sparse_qkv(model, args.keep_dense_qkv_layers)
+
+    for module in model.modules():
+        if isinstance(module, CRF):
+            module.parallel_scan = args.crf_parallel_scan
+            module.memory_efficient = args.crf_memory_efficient
+
+    if args.constrained_decoding:
+        use_transition_constraints(model, CWS_label_list, POS_label_list)
+
     model.to(device)
     if args.local_rank != -1:
         model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.local_rank],
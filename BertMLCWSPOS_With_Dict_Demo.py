@@ -16,8 +16,11 @@ import torch
 import time
 
 from src.BERT.modeling import BertConfig
-from src.customize_modeling import BertMLCWSPOS_with_Dict
-from src.utilis import save_model
+from src.customize_modeling import BertMLCWSPOS_with_Dict, set_chunk_cache, use_transition_constraints
+from src.utilis import save_model, stream_cutlist
+from src.inference_pool import InferencePool
+from src.inference_session import InferenceSession
+from src.head_pruning import match_pruned_heads
 from tqdm import tqdm
 
 import logging
@@ -112,6 +115,9 @@ def load_CWS_POS_model(label_list, pos_label_list, args):
             logger.info("Weights from pretrained models not used in {}: {}".format(
                 model.__class__.__name__, unexpected_keys))
 
+    if args.constrained_decoding:
+        use_transition_constraints(model, label_list, pos_label_list)
+
     model.to(device)
     if args.local_rank != -1:
         model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.local_rank],
@@ -144,13 +150,19 @@ def preload(args):
         weights = torch.load(args.bert_model, map_location='cpu')
 
         try:
-            model.load_state_dict(weights)
-        except RuntimeError:
-            model.module.load_state_dict(weights)
+            match_pruned_heads(model, weights).load_state_dict(weights)
+        except (RuntimeError, AttributeError):
+            match_pruned_heads(model.module, weights).load_state_dict(weights)
 
     model.eval()
     save_model(model, args.output_dir + 'model_eval.tsv')
 
+    if args.chunk_cache_size > 0:
+        set_chunk_cache(model, args.chunk_cache_size)
+
+    # frozen model without dropout, decoded under no_grad
+    model = InferenceSession(model, trace_encoder=args.trace_encoder)
+
     return model
 
 
@@ -582,9 +594,6 @@ def test_bad_case(model):
 
 
 def test_from_file(model, infile, outfile): # line 77
-    with open(infile, 'r', encoding='utf8') as f:
-        raw_data = f.readlines()
-
     #text_list = [s.strip() for s in raw_data]
 
     t0 = time.time()
@@ -594,17 +603,29 @@ def test_from_file(model, infile, outfile): # line 77
     #for x in output0: o0 += x + '\t'
     #print(o0+'\n')
 
-    with open(outfile, 'w+') as fo:
-        for x in tqdm(raw_data):
-            print(x)
-
-            outputT0 = model.cutlist_noUNK([x])
-            output0 = ['    '.join(lst)+' ' for lst in outputT0]
-
-            print(output0[0])
-            fo.write(output0[0]+'\n')
+    def write_output(output_iter, fo):
+        for lst in tqdm(output_iter):
+            output0 = '    '.join(lst)+' '
+
+            print(output0)
+            fo.write(output0+'\n')
+
+    with open(infile, 'r', encoding='utf8') as f, open(outfile, 'w+') as fo:
+        # stream the file instead of decoding line by line
+        if args.long_window_size > 0:
+            # long documents: overlapping windows instead of chunks of max_length-2 characters
+            write_output(stream_cutlist(lambda t: model.cutlist_long(t, args.long_window_size, \
+                args.long_stride if args.long_stride > 0 else None), f, args.long_window_size, model.batch_size), fo)
+        elif args.num_workers > 1:
+            # the workers are terminated if writing fails
+            with InferencePool(model, args.num_workers, args.threads_per_worker) as pool:
+                write_output(pool.imap(f), fo)
+        else:
+            write_output(model.segment_stream(f), fo)
 
     if 0:
+        with open(infile, 'r', encoding='utf8') as f:
+            raw_data = f.readlines()
         tx = [x for x in raw_data if x.strip()]
 
         outputT0 = model.cutlist_noUNK(tx)
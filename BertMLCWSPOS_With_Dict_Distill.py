@@ -0,0 +1,290 @@
+#!/anaconda3/envs/haiqin370/bin/ python3
+# -*- coding: utf-8 -*-
+"""
+Created on at 11:46 2019-07-05
+@author: haiqinyang
+
+Feature: layer-reduction distillation of BertMLCWSPOS_with_Dict
+
+Scenario:
+    A fine-tuned teacher, args.teacher_model with args.teacher_num_hidden_layers layers, supervises a student with
+    args.num_hidden_layers (1-4) layers initialized from the bottom layers of the teacher. The student loss is
+        distill_alpha * hard loss + (1-distill_alpha) * soft CWS/POS loss at distill_temperature
+        + distill_hidden_weight * mean squared error of the mapped encoder layers.
+    If teacher_logits_dir is set and no hidden states are matched, the teacher emissions of the training set are
+    computed once into teacher_logits_dir and read back in every epoch, so an epoch costs only a student forward.
+"""
+import os
+import re
+import time
+from collections import OrderedDict
+from glob import glob
+
+import torch
+from tqdm import tqdm, trange
+
+from src.config import args
+from src.preprocess import CWS_POS, get_dataset_stored_with_dict_and_dataloader, \
+    get_eval_stored_with_dict_dataloaders, dataset_to_dataloader
+from src.BERT.modeling import BertConfig
+from src.BERT.optimization import BertAdam
+from src.customize_modeling import BertMLVariantCWSPOS_with_Dict
+from src.distillation import IndexedDataset, TeacherLogitsStore, soft_cross_entropy, hidden_state_loss
+from BertMLCWSPOS_With_Dict_DataloaderTest import load_CWS_POS_model, do_eval
+
+import logging
+logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                    datefmt = '%m/%d/%Y %H:%M:%S',
+                    level = logging.INFO)
+logger = logging.getLogger(__name__)
+
+CONFIG_NAME = 'bert_config.json'
+
+
+def unpack_batch(batch, device):
+    # a batch of OntoNotesDataset_Stored_With_Dict with do_mask_as_whole: (batch, batch2, input_via_dict)
+    batch, batch2, input_via_dict = batch
+    batch = tuple(t.to(device) for t in batch)
+    batch2 = tuple(t.to(device) for t in batch2)
+
+    input_ids, segment_ids, input_mask = batch[:3]
+    cand_indexes, token_ids = batch2[:2]
+    label_ids, pos_label_ids = batch[3:]
+
+    inputs = (input_ids, segment_ids, input_mask, cand_indexes, token_ids, input_via_dict.to(device))
+
+    return inputs, label_ids, pos_label_ids
+
+
+def load_teacher(CWS_label_list, POS_label_list, device, args):
+    if args.teacher_model is None:
+        raise RuntimeError('Distilling from a random initialized teacher is not supported...!')
+
+    if args.bert_model_dir is not None:
+        bert_config = BertConfig.from_json_file(os.path.join(args.bert_model_dir, CONFIG_NAME))
+    else:
+        bert_config = BertConfig.from_json_file(args.bert_config_file)
+    bert_config.num_hidden_layers = args.teacher_num_hidden_layers
+
+    teacher = BertMLVariantCWSPOS_with_Dict(bert_config, len(CWS_label_list), len(POS_label_list), \
+                method=args.method, fclassifier=args.fclassifier, pclassifier=args.pclassifier, \
+                do_mask_as_whole=args.do_mask_as_whole, dict_file=args.dict_file)
+    teacher.load_state_dict(torch.load(args.teacher_model, map_location='cpu'))
+
+    teacher.to(device)
+    teacher.eval()
+    for param in teacher.parameters():
+        param.requires_grad = False
+
+    return teacher
+
+
+def init_student_from_teacher(student, teacher):
+    # load the weights of the teacher into the student, except those of the encoder layers above the student's,
+    # student: the model itself, not its DataParallel wrapper, whose keys start with "module."
+    num_layers = len(student.bert.encoder.layer)
+    teacher_state = teacher.state_dict()
+    student_keys = set(student.state_dict().keys())
+
+    dropped_keys = set()
+    for k in teacher_state:
+        match = re.match(r'bert\.encoder\.layer\.(\d+)\.', k)
+        if match and int(match.group(1)) >= num_layers:
+            dropped_keys.add(k)
+    missing_keys = sorted(student_keys - set(teacher_state))
+    unexpected_keys = sorted(set(teacher_state) - student_keys - dropped_keys)
+    if missing_keys or unexpected_keys:
+        raise ValueError('The student does not match the teacher, missing keys: {}, unexpected keys: {}'.format(
+            missing_keys, unexpected_keys))
+
+    student.load_state_dict(OrderedDict([(k, v) for k, v in teacher_state.items() if k not in dropped_keys]))
+    logger.info('Initialized the student from the teacher, {} weights of the top {} layers dropped'.format(
+        len(dropped_keys), len(teacher.bert.encoder.layer) - num_layers))
+
+    return student
+
+
+def precompute_teacher_logits(teacher, train_dataset, device, args):
+    store = TeacherLogitsStore(args.teacher_logits_dir)
+
+    if store.exists():
+        logger.info('Reading the teacher logits from ' + args.teacher_logits_dir)
+    else:
+        logger.info('Writing the teacher logits to ' + args.teacher_logits_dir)
+        dataloader = dataset_to_dataloader(IndexedDataset(train_dataset), args.eval_batch_size, training=False)
+        store.create(len(train_dataset), args.max_seq_length, teacher.num_CWStags, teacher.num_POStags)
+
+        with torch.no_grad():
+            for indexes, batch in tqdm(dataloader, desc="Teacher"):
+                inputs, _, _ = unpack_batch(batch, device)
+                cws_logits, pos_logits = teacher.compute_logits(*inputs)
+                store.write(indexes, cws_logits, pos_logits)
+
+        store.close()
+
+    store.open()
+    if store.cws_logits.shape[0] != len(train_dataset):
+        raise ValueError('The teacher logits in {} are computed from {} examples, but the training set has {}!'.format(
+            args.teacher_logits_dir, store.cws_logits.shape[0], len(train_dataset)))
+
+    return store
+
+
+def do_distill(student, teacher, teacher_store, train_dataloader, optimizer, device, args, eval_dataloaders):
+    match_hidden = args.distill_hidden_weight > 0
+    old_cws_F1 = 0.
+    # compute_logits and _compute_loss are not methods of the DataParallel wrapper
+    student_model = getattr(student, 'module', student)
+
+    for ep in trange(int(args.num_train_epochs), desc="Epoch"):
+        student.train()
+        st = time.time()
+        tr_loss = 0
+        nb_tr_steps = 0
+
+        for step, (indexes, batch) in enumerate(tqdm(train_dataloader, desc="Iteration")):
+            inputs, label_ids, pos_label_ids = unpack_batch(batch, device)
+            input_mask = inputs[2]
+            mask = input_mask.byte()
+
+            outputs = student_model.compute_logits(*inputs, return_encoded_layers=match_hidden)
+            cws_logits, pos_logits = outputs[:2]
+
+            if teacher_store is not None:
+                t_cws_logits, t_pos_logits = teacher_store.read(indexes, device)
+            else:
+                with torch.no_grad():
+                    t_outputs = teacher.compute_logits(*inputs, return_encoded_layers=match_hidden)
+                t_cws_logits, t_pos_logits = t_outputs[:2]
+
+            hard_loss = student_model._compute_loss(cws_logits, mask, label_ids, 'CWS') \
+                        + student_model._compute_loss(pos_logits, mask, pos_label_ids, 'POS')
+            soft_loss = soft_cross_entropy(cws_logits, t_cws_logits, input_mask, args.distill_temperature) \
+                        + soft_cross_entropy(pos_logits, t_pos_logits, input_mask, args.distill_temperature)
+
+            loss = args.distill_alpha*hard_loss + (1.-args.distill_alpha)*soft_loss
+            if match_hidden:
+                loss += args.distill_hidden_weight * hidden_state_loss(outputs[2], t_outputs[2], input_mask)
+
+            if args.gradient_accumulation_steps > 1:
+                loss = loss / args.gradient_accumulation_steps
+
+            loss.backward()
+            tr_loss += loss.item()
+            nb_tr_steps += 1
+
+            if (step + 1) % args.gradient_accumulation_steps == 0:
+                optimizer.step()
+                student.zero_grad()
+
+        tr_time = time.time()-st
+        logger.info('Epoch {:d}: distillation loss: {:.4f}, training time: {:.3f} seconds.'.format( \
+            ep, tr_loss/max(nb_tr_steps, 1), tr_time))
+
+        rs = {}
+        for part in eval_dataloaders:
+            rs[part] = do_eval(student, eval_dataloaders[part], device, args, times=tr_time, type=part, ep=ep)
+
+        # results = [avg_times, eval_time, cws_avg_loss, pos_avg_loss, cws_F1, ...], see do_eval
+        ts_cws_F1 = rs['test'][4]
+        if ts_cws_F1 > old_cws_F1: # only save the best models
+            old_cws_F1 = ts_cws_F1
+
+            for ckpt_file in sorted(glob(os.path.join(args.output_dir, 'distill_cws_F1_*.pt'))):
+                logger.info('rm %s' % ckpt_file)
+                os.remove(ckpt_file)
+
+            output_weight_file = os.path.join(args.output_dir, 'distill_cws_F1_weights_epoch%02d.pt'%ep)
+            torch.save(student.state_dict(), output_weight_file)
+
+
+def distill_CWS_POS(args):
+    if 'ontonotes' not in args.task_name.lower():
+        raise ValueError("Distillation needs the POS tags of OntoNotes, task not supported: %s" % (args.task_name))
+    if not args.do_mask_as_whole:
+        raise ValueError("Distillation is only implemented for do_mask_as_whole=True")
+
+    processor = CWS_POS(nopunc=args.nopunc, drop_columns=['full_pos', 'bert_ner', 'src_ner', 'src_seg', 'text_seg'],
+                        pos_tags_file='./resource/pos_tags.txt')
+    CWS_label_list = processor.get_labels()
+    POS_label_list = processor.get_POS_labels()
+
+    args.output_dir = args.output_dir + '/distill_l' + str(args.num_hidden_layers)
+    print('output_dir: ' + args.output_dir)
+    os.system('mkdir -p %s' %args.output_dir)
+
+    train_dataset, _ = get_dataset_stored_with_dict_and_dataloader(processor, args, training=True, type_name='train')
+    train_dataloader = dataset_to_dataloader(IndexedDataset(train_dataset), args.train_batch_size,
+                                             args.local_rank, training=True)
+    eval_dataloaders = get_eval_stored_with_dict_dataloaders(processor, args)
+
+    # the student is truncated to args.num_hidden_layers, then initialized from the bottom layers of the teacher
+    student, device = load_CWS_POS_model(CWS_label_list, POS_label_list, args)
+    teacher = load_teacher(CWS_label_list, POS_label_list, device, args)
+    # the wrapper of DataParallel shares the parameters of student.module
+    init_student_from_teacher(getattr(student, 'module', student), teacher)
+
+    teacher_store = None
+    if args.teacher_logits_dir is not None and args.distill_hidden_weight == 0:
+        teacher_store = precompute_teacher_logits(teacher, train_dataset, device, args)
+        teacher = None # not needed any more
+
+    num_train_steps = int(
+        len(train_dataset) / args.train_batch_size / args.gradient_accumulation_steps * args.num_train_epochs)
+
+    no_decay = ['bias', 'gamma', 'beta']
+    param_optimizer = list(student.named_parameters())
+    optimizer_grouped_parameters = [
+        {'params': [p for n, p in param_optimizer if n not in no_decay], 'weight_decay_rate': 0.01},
+        {'params': [p for n, p in param_optimizer if n in no_decay], 'weight_decay_rate': 0.0}
+        ]
+
+    optimizer = BertAdam(optimizer_grouped_parameters,
+                         lr=args.learning_rate,
+                         warmup=args.warmup_proportion,
+                         t_total=num_train_steps)
+
+    do_distill(student, teacher, teacher_store, train_dataloader, optimizer, device, args, eval_dataloaders)
+
+
+def set_local_Ontonotes_param():
+    return {'task_name': 'ontonotes_cws_pos2.0',
+            'model_type': 'sequencelabeling',
+            'data_dir': '/Users/haiqinyang/Downloads/datasets/ontonotes-release-5.0/ontonote_data/proc_data/'
+                        '4nerpos_update/valid/feat_with_dict/',
+            'vocab_file': './src/BERT/models/multi_cased_L-12_H-768_A-12/vocab.txt',
+            'bert_config_file': './src/BERT/models/multi_cased_L-12_H-768_A-12/bert_config.json',
+            'output_dir': '/Users/haiqinyang/Downloads/datasets/ontonotes-release-5.0/ontonote_data/proc_data/eval/ontonotes/CWSPOS2/dict/',
+            'teacher_model': '/Users/haiqinyang/Downloads/datasets/ontonotes-release-5.0/ontonote_data/proc_data/eval/ontonotes/CWSPOS2/dict/l12/cws_F1_weights_epoch16.pt',
+            'teacher_logits_dir': '/Users/haiqinyang/Downloads/datasets/ontonotes-release-5.0/ontonote_data/proc_data/eval/ontonotes/CWSPOS2/dict/teacher_l12/',
+            'do_lower_case': False,
+            'train_batch_size': 5,
+            'max_seq_length': 128,
+            'num_hidden_layers': 3,
+            'init_checkpoint': '/Users/haiqinyang/Downloads/codes/pytorch-pretrained-BERT-master/models/multi_cased_L-12_H-768_A-12/',
+            'bert_model_dir': '/Users/haiqinyang/Downloads/codes/pytorch-pretrained-BERT-master/models/multi_cased_L-12_H-768_A-12/',
+            'no_cuda': True,
+            'num_train_epochs': 20,
+            'method': 'fine_tune',
+            'do_mask_as_whole': True,
+            'learning_rate': 5e-5,
+            'override_output': True,
+            }
+
+
+TEST_FLAG = False
+#TEST_FLAG = True
+
+def main(**kwargs):
+    if TEST_FLAG:
+        kwargs = set_local_Ontonotes_param()
+    else:
+        print('load parameters from .sh')
+
+    args._parse(kwargs)
+    distill_CWS_POS(args)
+
+
+if __name__=='__main__':
+    import fire
+    fire.Fire(main)
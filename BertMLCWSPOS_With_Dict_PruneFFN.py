@@ -0,0 +1,181 @@
+#!/anaconda3/envs/haiqin370/bin/ python3
+# -*- coding: utf-8 -*-
+"""
+Created on at 11:02 2019-07-11
+@author: haiqinyang
+
+Feature: feed-forward neuron pruning of BertMLCWSPOS_with_Dict with a speedup and F1 report
+
+Scenario:
+    The intermediate neurons of the fine-tuned model, args.bert_model, are scored by args.ffn_criterion, on the
+    dev set of args.task_name for 'activation', and every layer keeps the args.ffn_intermediate_size best ones.
+    If args.ffn_recovery_epochs > 0, the pruned model is fine-tuned by do_train on the training set, and its best
+    checkpoint is kept. The model is exported to args.output_dir as bert_config.json and pytorch_model.bin, a
+    dense BERT with a smaller intermediate_size, to be used as bert_model_dir or by
+    InferenceSession.from_checkpoint. The speedups and the F1 deltas are written to ffn_pruning_report.txt.
+    See Test_MLCWSPOS_Dict_PruneFFN.sh.
+"""
+import os
+from glob import glob
+from itertools import islice
+
+import torch
+
+from src.config import args
+from src.preprocess import CWS_POS, CWS_BMEO, get_dataset_stored_with_dict_and_dataloader, \
+    get_eval_stored_with_dict_dataloaders
+from src.BERT.optimization import BertAdam
+from src.head_pruning import match_pruned_heads
+from src.ffn_pruning import compute_neuron_importance, prune_ffn, export_pruned_model
+from BertMLCWSPOS_With_Dict_DataloaderTest import load_CWS_POS_model, do_train, do_eval
+from BertMLCWSPOS_With_Dict_Distill import unpack_batch
+
+import logging
+logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                    datefmt = '%m/%d/%Y %H:%M:%S',
+                    level = logging.INFO)
+logger = logging.getLogger(__name__)
+
+REPORT_NAME = 'ffn_pruning_report.txt'
+
+
+def recover(model, processor, device, args, eval_dataloaders):
+    # fine-tune the pruned model for ffn_recovery_epochs, then load its best checkpoint, see do_train
+    train_dataset, train_dataloader = get_dataset_stored_with_dict_and_dataloader(processor, args, training=True,
+                                                                                  type_name='train')
+    args.num_train_epochs = args.ffn_recovery_epochs
+    num_train_steps = int(
+        len(train_dataset) / args.train_batch_size / args.gradient_accumulation_steps * args.num_train_epochs)
+
+    no_decay = ['bias', 'gamma', 'beta']
+    param_optimizer = list(model.named_parameters())
+    optimizer_grouped_parameters = [
+        {'params': [p for n, p in param_optimizer if n not in no_decay], 'weight_decay_rate': 0.01},
+        {'params': [p for n, p in param_optimizer if n in no_decay], 'weight_decay_rate': 0.0}
+        ]
+
+    optimizer = BertAdam(optimizer_grouped_parameters,
+                         lr=args.learning_rate,
+                         warmup=args.warmup_proportion,
+                         t_total=num_train_steps)
+
+    do_train(model, train_dataloader, optimizer, param_optimizer, device, args, eval_dataloaders)
+
+    ckpt_files = sorted(glob(os.path.join(args.output_dir, 'cws_F1_weights_epoch*.pt')))
+    if ckpt_files:
+        logger.info('Loading the best recovered checkpoint ' + ckpt_files[-1])
+        model.load_state_dict(torch.load(ckpt_files[-1], map_location='cpu'))
+
+
+def prune_and_evaluate(args):
+    processors = {
+        **dict.fromkeys(['ontonotes_cws_pos', 'ontonotes_cws_pos2.0'], lambda: \
+            CWS_POS(nopunc=args.nopunc, drop_columns=['full_pos', 'bert_ner', 'src_ner', 'src_seg', 'text_seg'],
+                    pos_tags_file='./resource/pos_tags.txt')),
+        **dict.fromkeys(['msr', 'pku', 'as', 'cityu'], lambda: \
+            CWS_BMEO(nopunc=args.nopunc, drop_columns=['src_seg', 'text_seg']))
+    }
+
+    task_name = args.task_name.lower()
+    if task_name not in processors:
+        raise ValueError("Task not found: %s" % (task_name))
+    if args.bert_model is None:
+        raise RuntimeError('Pruning a model without fine-tuned weights, bert_model, is not supported...!')
+    if not args.do_mask_as_whole:
+        raise ValueError("Feed-forward pruning is only implemented for do_mask_as_whole=True")
+
+    processor = processors[task_name]()
+    CWS_label_list = processor.get_labels()
+    if hasattr(processor, 'get_POS_labels'):
+        POS_label_list = processor.get_POS_labels()
+    else: # the CWS datasets have no POS tags, the POS head keeps the size of the OntoNotes one
+        POS_label_list = CWS_POS(pos_tags_file='./resource/pos_tags.txt').get_POS_labels()
+
+    eval_dataloaders = get_eval_stored_with_dict_dataloaders(processor, args)
+    eval_dataloaders.pop('train', None) # only the held-out sets are reported
+
+    model, device = load_CWS_POS_model(CWS_label_list, POS_label_list, args)
+    state_dict = torch.load(args.bert_model, map_location='cpu')
+    match_pruned_heads(model, state_dict).load_state_dict(state_dict) # bert_model may have pruned heads
+
+    # results: [eval_time, cws_loss, pos_loss, cws_F1, cws_P, cws_R, cws_Acc, cws_Tags, pos_F1, ...], see do_eval
+    results = {}
+    for part, eval_dataloader in eval_dataloaders.items():
+        results[part] = [do_eval(model, eval_dataloader, device, args, type=part+'_full')]
+
+    score_part = 'dev' if 'dev' in eval_dataloaders else 'test'
+    batches = None
+    if args.ffn_criterion == 'activation':
+        num_batches = args.ffn_importance_batches if args.ffn_importance_batches > 0 else None
+        batches = (unpack_batch(batch, device)[0] for batch in islice(eval_dataloaders[score_part], num_batches))
+
+    full_size = model.bert.config.intermediate_size
+    prune_ffn(model, args.ffn_intermediate_size, compute_neuron_importance(model, args.ffn_criterion, batches))
+
+    if args.ffn_recovery_epochs > 0:
+        recover(model, processor, device, args, eval_dataloaders)
+
+    export_pruned_model(model, args.output_dir)
+
+    for part, eval_dataloader in eval_dataloaders.items():
+        results[part].append(do_eval(model, eval_dataloader, device, args, type=part+'_pruned'))
+
+    with open(os.path.join(args.output_dir, REPORT_NAME), 'a+') as writer:
+        writer.write('{:s}: intermediate_size {:d} -> {:d}, criterion {:s}, {:d} recovery epochs\n'.format( \
+            args.task_name, full_size, args.ffn_intermediate_size, args.ffn_criterion, args.ffn_recovery_epochs))
+
+        for part, (rs_full, rs_pruned) in results.items():
+            num_sents = len(eval_dataloaders[part].dataset)
+            report = '{:s} {:s}: sents/s: {:.1f} -> {:.1f} ({:.2f}x), cws_F1: {:.3f} -> {:.3f} ({:+.3f}), ' \
+                     'pos_F1: {:.3f} -> {:.3f} ({:+.3f})'.format(args.task_name, part, \
+                num_sents/(rs_full[0]*60.), num_sents/(rs_pruned[0]*60.), rs_full[0]/rs_pruned[0], \
+                rs_full[3], rs_pruned[3], rs_pruned[3]-rs_full[3], rs_full[8], rs_pruned[8], rs_pruned[8]-rs_full[8])
+
+            logger.info(report)
+            writer.write(report + '\n')
+
+    return results
+
+
+def set_local_Ontonotes_param():
+    return {'task_name': 'ontonotes_cws_pos2.0',
+            'model_type': 'sequencelabeling',
+            'data_dir': '/Users/haiqinyang/Downloads/datasets/ontonotes-release-5.0/ontonote_data/proc_data/'
+                        '4nerpos_update/valid/feat_with_dict/',
+            'vocab_file': './src/BERT/models/multi_cased_L-12_H-768_A-12/vocab.txt',
+            'bert_config_file': './src/BERT/models/multi_cased_L-12_H-768_A-12/bert_config.json',
+            'output_dir': '/Users/haiqinyang/Downloads/datasets/ontonotes-release-5.0/ontonote_data/proc_data/eval/ontonotes/CWSPOS2/ffn2048/',
+            'bert_model': '/Users/haiqinyang/Downloads/datasets/ontonotes-release-5.0/ontonote_data/proc_data/eval/ontonotes/CWSPOS2/dict/l12/cws_F1_weights_epoch16.pt',
+            'do_lower_case': False,
+            'train_batch_size': 32,
+            'max_seq_length': 128,
+            'init_checkpoint': '/Users/haiqinyang/Downloads/codes/pytorch-pretrained-BERT-master/models/multi_cased_L-12_H-768_A-12/',
+            'bert_model_dir': '/Users/haiqinyang/Downloads/codes/pytorch-pretrained-BERT-master/models/multi_cased_L-12_H-768_A-12/',
+            'no_cuda': True,
+            'method': 'fine_tune',
+            'do_mask_as_whole': True,
+            'dict_file': './resource/dict.txt',
+            'ffn_intermediate_size': 2048,
+            'ffn_criterion': 'activation',
+            'ffn_recovery_epochs': 1,
+            'learning_rate': 2e-5,
+            'override_output': True,
+            }
+
+
+TEST_FLAG = False
+#TEST_FLAG = True
+
+def main(**kwargs):
+    if TEST_FLAG:
+        kwargs = set_local_Ontonotes_param()
+    else:
+        print('load parameters from .sh')
+
+    args._parse(kwargs)
+    prune_and_evaluate(args)
+
+
+if __name__=='__main__':
+    import fire
+    fire.Fire(main)
@@ -0,0 +1,150 @@
+#!/anaconda3/envs/haiqin370/bin/ python3
+# -*- coding: utf-8 -*-
+"""
+Created on at 17:25 2019-07-10
+@author: haiqinyang
+
+Feature: attention head pruning of BertMLCWSPOS_with_Dict with a speedup and F1 report
+
+Scenario:
+    The heads of the fine-tuned model, args.bert_model, are scored on the dev set of args.task_name, the test set
+    if there is no dev set, by the gradients of the CWS+POS loss with respect to head masks. The least important
+    heads are removed so that each layer keeps args.num_heads_kept heads, and the smaller model is saved as
+    pytorch_model_pruned.pt in args.output_dir. The evaluation sets are decoded before and after pruning, and the
+    speedups and the F1 deltas of outputFscoreUsedBIO/outputPOSFscoreUsedBIO are written to
+    head_pruning_report.txt. See Test_MLCWSPOS_Dict_PruneHeads.sh.
+    The artifact is loaded by InferenceSession.from_checkpoint, or by load_state_dict after match_pruned_heads.
+    Fine-tune it again, with bert_model pointing to it, to recover the F1 lost by pruning.
+"""
+import os
+from itertools import islice
+
+import torch
+
+from src.config import args
+from src.preprocess import CWS_POS, CWS_BMEO, get_eval_stored_with_dict_dataloaders
+from src.head_pruning import compute_head_importance, select_heads_to_prune, prune_heads, match_pruned_heads, \
+    PRUNED_WEIGHTS_NAME
+from BertMLCWSPOS_With_Dict_DataloaderTest import load_CWS_POS_model, do_eval
+from BertMLCWSPOS_With_Dict_Distill import unpack_batch
+
+import logging
+logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                    datefmt = '%m/%d/%Y %H:%M:%S',
+                    level = logging.INFO)
+logger = logging.getLogger(__name__)
+
+REPORT_NAME = 'head_pruning_report.txt'
+
+
+def dev_loss(model, batch):
+    # CWS+POS loss of a batch of OntoNotesDataset_Stored_With_Dict, see compute_head_importance
+    inputs, label_ids, pos_label_ids = unpack_batch(batch, next(model.parameters()).device)
+    return model(*inputs, labels_CWS=label_ids, labels_POS=pos_label_ids)
+
+
+def prune_and_evaluate(args):
+    processors = {
+        **dict.fromkeys(['ontonotes_cws_pos', 'ontonotes_cws_pos2.0'], lambda: \
+            CWS_POS(nopunc=args.nopunc, drop_columns=['full_pos', 'bert_ner', 'src_ner', 'src_seg', 'text_seg'],
+                    pos_tags_file='./resource/pos_tags.txt')),
+        **dict.fromkeys(['msr', 'pku', 'as', 'cityu'], lambda: \
+            CWS_BMEO(nopunc=args.nopunc, drop_columns=['src_seg', 'text_seg']))
+    }
+
+    task_name = args.task_name.lower()
+    if task_name not in processors:
+        raise ValueError("Task not found: %s" % (task_name))
+    if args.bert_model is None:
+        raise RuntimeError('Pruning a model without fine-tuned weights, bert_model, is not supported...!')
+    if not args.do_mask_as_whole:
+        raise ValueError("Head pruning is only implemented for do_mask_as_whole=True")
+
+    processor = processors[task_name]()
+    CWS_label_list = processor.get_labels()
+    if hasattr(processor, 'get_POS_labels'):
+        POS_label_list = processor.get_POS_labels()
+    else: # the CWS datasets have no POS tags, the POS head keeps the size of the OntoNotes one
+        POS_label_list = CWS_POS(pos_tags_file='./resource/pos_tags.txt').get_POS_labels()
+
+    eval_dataloaders = get_eval_stored_with_dict_dataloaders(processor, args)
+    eval_dataloaders.pop('train', None) # only the held-out sets are reported
+
+    model, device = load_CWS_POS_model(CWS_label_list, POS_label_list, args)
+    state_dict = torch.load(args.bert_model, map_location='cpu')
+    match_pruned_heads(model, state_dict).load_state_dict(state_dict) # bert_model may be pruned already
+
+    # results: [eval_time, cws_loss, pos_loss, cws_F1, cws_P, cws_R, cws_Acc, cws_Tags, pos_F1, ...], see do_eval
+    results = {}
+    for part, eval_dataloader in eval_dataloaders.items():
+        results[part] = [do_eval(model, eval_dataloader, device, args, type=part+'_full')]
+
+    score_part = 'dev' if 'dev' in eval_dataloaders else 'test'
+    num_batches = args.head_importance_batches if args.head_importance_batches > 0 else None
+    importance = compute_head_importance(model, islice(eval_dataloaders[score_part], num_batches), dev_loss)
+
+    prune_heads(model, select_heads_to_prune(importance, args.num_heads_kept))
+    torch.save(model.state_dict(), os.path.join(args.output_dir, PRUNED_WEIGHTS_NAME))
+
+    for part, eval_dataloader in eval_dataloaders.items():
+        results[part].append(do_eval(model, eval_dataloader, device, args, type=part+'_pruned'))
+
+    heads_per_layer = [layer.attention.self.num_attention_heads for layer in model.bert.encoder.layer]
+    with open(os.path.join(args.output_dir, REPORT_NAME), 'a+') as writer:
+        writer.write('{:s}: heads per layer {}, scored on {:s}\n'.format(args.task_name, heads_per_layer, score_part))
+        for layer_index, layer_importance in enumerate(importance):
+            writer.write('layer {:d} importance: {}\n'.format(layer_index, \
+                ' '.join('{:.3f}'.format(x) for x in layer_importance.tolist())))
+
+        for part, (rs_full, rs_pruned) in results.items():
+            num_sents = len(eval_dataloaders[part].dataset)
+            report = '{:s} {:s}: sents/s: {:.1f} -> {:.1f} ({:.2f}x), cws_F1: {:.3f} -> {:.3f} ({:+.3f}), ' \
+                     'pos_F1: {:.3f} -> {:.3f} ({:+.3f})'.format(args.task_name, part, \
+                num_sents/(rs_full[0]*60.), num_sents/(rs_pruned[0]*60.), rs_full[0]/rs_pruned[0], \
+                rs_full[3], rs_pruned[3], rs_pruned[3]-rs_full[3], rs_full[8], rs_pruned[8], rs_pruned[8]-rs_full[8])
+
+            logger.info(report)
+            writer.write(report + '\n')
+
+    return results
+
+
+def set_local_Ontonotes_param():
+    return {'task_name': 'ontonotes_cws_pos2.0',
+            'model_type': 'sequencelabeling',
+            'data_dir': '/Users/haiqinyang/Downloads/datasets/ontonotes-release-5.0/ontonote_data/proc_data/'
+                        '4nerpos_update/valid/feat_with_dict/',
+            'vocab_file': './src/BERT/models/multi_cased_L-12_H-768_A-12/vocab.txt',
+            'bert_config_file': './src/BERT/models/multi_cased_L-12_H-768_A-12/bert_config.json',
+            'output_dir': '/Users/haiqinyang/Downloads/datasets/ontonotes-release-5.0/ontonote_data/proc_data/eval/ontonotes/CWSPOS2/pruned/',
+            'bert_model': '/Users/haiqinyang/Downloads/datasets/ontonotes-release-5.0/ontonote_data/proc_data/eval/ontonotes/CWSPOS2/dict/l12/cws_F1_weights_epoch16.pt',
+            'do_lower_case': False,
+            'train_batch_size': 32,
+            'max_seq_length': 128,
+            'init_checkpoint': '/Users/haiqinyang/Downloads/codes/pytorch-pretrained-BERT-master/models/multi_cased_L-12_H-768_A-12/',
+            'bert_model_dir': '/Users/haiqinyang/Downloads/codes/pytorch-pretrained-BERT-master/models/multi_cased_L-12_H-768_A-12/',
+            'no_cuda': True,
+            'method': 'fine_tune',
+            'do_mask_as_whole': True,
+            'dict_file': './resource/dict.txt',
+            'num_heads_kept': 8,
+            'override_output': True,
+            }
+
+
+TEST_FLAG = False
+#TEST_FLAG = True
+
+def main(**kwargs):
+    if TEST_FLAG:
+        kwargs = set_local_Ontonotes_param()
+    else:
+        print('load parameters from .sh')
+
+    args._parse(kwargs)
+    prune_and_evaluate(args)
+
+
+if __name__=='__main__':
+    import fire
+    fire.Fire(main)
@@ -0,0 +1,127 @@
+#!/anaconda3/envs/haiqin370/bin/ python3
+# -*- coding: utf-8 -*-
+"""
+Created on at 15:02 2019-07-02
+@author: haiqinyang
+
+Feature: int8 export of BertMLCWSPOS_with_Dict with an accuracy regression report
+
+Scenario:
+    The fine-tuned model, args.bert_model, is evaluated on the CPU on the stored evaluation sets of args.task_name,
+    then quantized by dynamic int8 quantization, saved as pytorch_model_int8.pt in args.output_dir and evaluated
+    again. The F1 scores of outputFscoreUsedBIO/outputPOSFscoreUsedBIO, their deltas and the speedups are
+    written to quantization_report.txt. See Test_MLCWSPOS_Dict_Quantize.sh for OntoNotes, MSR and PKU.
+    The artifact is loaded by InferenceSession.from_checkpoint(..., quantized=True).
+"""
+import os
+
+import torch
+
+from src.config import args
+from src.preprocess import CWS_POS, CWS_BMEO, get_eval_stored_with_dict_dataloaders
+from src.quantization import quantize_model, save_quantized_model, QUANTIZED_WEIGHTS_NAME
+from src.head_pruning import match_pruned_heads
+from BertMLCWSPOS_With_Dict_DataloaderTest import load_CWS_POS_model, do_eval
+
+import logging
+logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                    datefmt = '%m/%d/%Y %H:%M:%S',
+                    level = logging.INFO)
+logger = logging.getLogger(__name__)
+
+REPORT_NAME = 'quantization_report.txt'
+
+
+def quantize_and_evaluate(args):
+    processors = {
+        **dict.fromkeys(['ontonotes_cws_pos', 'ontonotes_cws_pos2.0'], lambda: \
+            CWS_POS(nopunc=args.nopunc, drop_columns=['full_pos', 'bert_ner', 'src_ner', 'src_seg', 'text_seg'],
+                    pos_tags_file='./resource/pos_tags.txt')),
+        **dict.fromkeys(['msr', 'pku', 'as', 'cityu'], lambda: \
+            CWS_BMEO(nopunc=args.nopunc, drop_columns=['src_seg', 'text_seg']))
+    }
+
+    task_name = args.task_name.lower()
+    if task_name not in processors:
+        raise ValueError("Task not found: %s" % (task_name))
+    if args.bert_model is None:
+        raise RuntimeError('Quantizing a model without fine-tuned weights, bert_model, is not supported...!')
+
+    processor = processors[task_name]()
+    CWS_label_list = processor.get_labels()
+    if hasattr(processor, 'get_POS_labels'):
+        POS_label_list = processor.get_POS_labels()
+    else: # the CWS datasets have no POS tags, the POS head keeps the size of the OntoNotes one
+        POS_label_list = CWS_POS(pos_tags_file='./resource/pos_tags.txt').get_POS_labels()
+
+    # dynamic quantization only runs on the CPU, so both models are evaluated there
+    args.no_cuda = True
+    eval_dataloaders = get_eval_stored_with_dict_dataloaders(processor, args)
+
+    model, device = load_CWS_POS_model(CWS_label_list, POS_label_list, args)
+    state_dict = torch.load(args.bert_model, map_location='cpu')
+    match_pruned_heads(model, state_dict).load_state_dict(state_dict) # bert_model may have pruned heads
+
+    # results: [eval_time, cws_loss, pos_loss, cws_F1, cws_P, cws_R, cws_Acc, cws_Tags, pos_F1, ...], see do_eval
+    results = {}
+    for part, eval_dataloader in eval_dataloaders.items():
+        results[part] = [do_eval(model, eval_dataloader, device, args, type=part+'_float32')]
+
+    quantize_model(model)
+    save_quantized_model(model, os.path.join(args.output_dir, QUANTIZED_WEIGHTS_NAME))
+
+    for part, eval_dataloader in eval_dataloaders.items():
+        results[part].append(do_eval(model, eval_dataloader, device, args, type=part+'_int8'))
+
+    with open(os.path.join(args.output_dir, REPORT_NAME), 'a+') as writer:
+        for part, (rs_fp32, rs_int8) in results.items():
+            num_sents = len(eval_dataloaders[part].dataset)
+            report = '{:s} {:s}: sents/s: {:.1f} -> {:.1f} ({:.2f}x), cws_F1: {:.3f} -> {:.3f} ({:+.3f}), ' \
+                     'pos_F1: {:.3f} -> {:.3f} ({:+.3f})'.format(args.task_name, part, \
+                num_sents/(rs_fp32[0]*60.), num_sents/(rs_int8[0]*60.), rs_fp32[0]/rs_int8[0], \
+                rs_fp32[3], rs_int8[3], rs_int8[3]-rs_fp32[3], rs_fp32[8], rs_int8[8], rs_int8[8]-rs_fp32[8])
+
+            logger.info(report)
+            writer.write(report + '\n')
+
+    return results
+
+
+def set_local_Ontonotes_param():
+    return {'task_name': 'ontonotes_cws_pos2.0',
+            'model_type': 'sequencelabeling',
+            'data_dir': '/Users/haiqinyang/Downloads/datasets/ontonotes-release-5.0/ontonote_data/proc_data/'
+                        '4nerpos_update/valid/feat_with_dict/',
+            'vocab_file': './src/BERT/models/multi_cased_L-12_H-768_A-12/vocab.txt',
+            'bert_config_file': './src/BERT/models/multi_cased_L-12_H-768_A-12/bert_config.json',
+            'output_dir': '/Users/haiqinyang/Downloads/datasets/ontonotes-release-5.0/ontonote_data/proc_data/eval/ontonotes/CWSPOS2/int8/',
+            'bert_model': '/Users/haiqinyang/Downloads/datasets/ontonotes-release-5.0/ontonote_data/proc_data/eval/ontonotes/CWSPOS2/dict/l12/cws_F1_weights_epoch16.pt',
+            'do_lower_case': False,
+            'train_batch_size': 32,
+            'max_seq_length': 128,
+            'init_checkpoint': '/Users/haiqinyang/Downloads/codes/pytorch-pretrained-BERT-master/models/multi_cased_L-12_H-768_A-12/',
+            'bert_model_dir': '/Users/haiqinyang/Downloads/codes/pytorch-pretrained-BERT-master/models/multi_cased_L-12_H-768_A-12/',
+            'no_cuda': True,
+            'method': 'fine_tune',
+            'do_mask_as_whole': True,
+            'dict_file': './resource/dict.txt',
+            'override_output': True,
+            }
+
+
+TEST_FLAG = False
+#TEST_FLAG = True
+
+def main(**kwargs):
+    if TEST_FLAG:
+        kwargs = set_local_Ontonotes_param()
+    else:
+        print('load parameters from .sh')
+
+    args._parse(kwargs)
+    quantize_and_evaluate(args)
+
+
+if __name__=='__main__':
+    import fire
+    fire.Fire(main)
@@ -0,0 +1,178 @@
+#!/anaconda3/envs/haiqin370/bin/ python3
+# -*- coding: utf-8 -*-
+"""
+Created on at 10:12 2019-06-24
+@author: haiqinyang
+
+Feature: local HTTP service of BertMLCWSPOS_with_Dict with micro-batching
+
+Scenario:
+    Concurrent requests are put on an asyncio queue and coalesced into one batch of up to batch_size texts,
+    or whatever has arrived before the max-wait deadline. Each batch is decoded by a single call of
+    cutlist_noUNK and the results are sent back to the callers.
+
+    POST /segment  {"texts": ["text1", "text2", ...]} or {"text": "text1"}
+        -> {"results": [["word / POS", ...], ...]}
+    GET  /stats    -> queue depth, batch fill ratio, counters of the chunk cache
+"""
+import asyncio
+import json
+import time
+
+from src.config import args
+from BertMLCWSPOS_With_Dict_Demo import preload, set_local_eval_param, set_server_eval_param
+
+import logging
+logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                    datefmt = '%m/%d/%Y %H:%M:%S',
+                    level = logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher(object):
+    """Coalesce the texts of concurrent requests into batches of the model."""
+    def __init__(self, model, batch_size, max_wait=0.01):
+        self.model = model
+        self.batch_size = batch_size
+        self.max_wait = max_wait # seconds
+        self.queue = asyncio.Queue()
+
+        self.num_batches = 0
+        self.num_texts = 0
+        self.decode_time = 0.
+
+    async def segment(self, texts):
+        loop = asyncio.get_event_loop()
+        futures = []
+        for text in texts:
+            future = loop.create_future()
+            await self.queue.put((text, future))
+            futures.append(future)
+
+        return await asyncio.gather(*futures)
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0: break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            texts = [text for text, _ in batch]
+            st = time.time()
+            try:
+                # decode in a worker thread, so that the event loop keeps accepting requests
+                results = await loop.run_in_executor(None, self.model.cutlist_noUNK, texts)
+                # zip would leave the futures of the missing results unresolved, and their clients waiting
+                if len(results) != len(texts):
+                    raise RuntimeError('cutlist_noUNK returned {} results for {} texts'.format(len(results), len(texts)))
+            except Exception as e:
+                logger.exception('Failed to decode a batch of {} texts'.format(len(texts)))
+                for _, future in batch:
+                    if not future.done(): future.set_exception(e)
+                continue
+
+            self.decode_time += time.time() - st
+            self.num_batches += 1
+            self.num_texts += len(texts)
+
+            for (_, future), rs in zip(batch, results):
+                if not future.done(): future.set_result(rs)
+
+    def stats(self):
+        stat = {'queue_depth': self.queue.qsize(),
+                'batch_size': self.batch_size,
+                'num_batches': self.num_batches,
+                'num_texts': self.num_texts,
+                'batch_fill_ratio': self.num_texts / (self.num_batches*self.batch_size) if self.num_batches else 0.,
+                'avg_decode_time': self.decode_time / self.num_batches if self.num_batches else 0.}
+
+        chunk_cache = getattr(self.model, 'chunk_cache', None)
+        if chunk_cache is not None:
+            stat['chunk_cache'] = chunk_cache.stats()
+
+        return stat
+
+
+async def write_response(writer, status, body):
+    data = json.dumps(body, ensure_ascii=False).encode('utf8')
+    writer.write(('HTTP/1.1 {}\r\nContent-Type: application/json; charset=utf-8\r\n'
+                  'Content-Length: {}\r\nConnection: close\r\n\r\n').format(status, len(data)).encode('latin1'))
+    writer.write(data)
+    await writer.drain()
+    writer.close()
+
+
+def make_handler(batcher):
+    async def handle(reader, writer):
+        try:
+            request_line = (await reader.readline()).decode('latin1').split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin1').strip()
+                if not line: break
+                k, _, v = line.partition(':')
+                headers[k.strip().lower()] = v.strip()
+
+            if len(request_line) < 2:
+                await write_response(writer, '400 Bad Request', {'error': 'bad request line'})
+                return
+            method, path = request_line[0], request_line[1]
+
+            if method == 'GET' and path == '/stats':
+                await write_response(writer, '200 OK', batcher.stats())
+            elif method == 'POST' and path == '/segment':
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                query = json.loads(body.decode('utf8')) if body else {}
+                if not isinstance(query, dict):
+                    raise ValueError('the body must be a json object with "texts" or "text"')
+                texts = query['texts'] if 'texts' in query else [query.get('text', '')]
+                # a string would be segmented per character, and the other items skipped by cutlist_noUNK
+                if not isinstance(texts, list) or not all(isinstance(t, str) for t in texts):
+                    raise ValueError('"texts" must be a list of strings, "text" a string')
+
+                results = await batcher.segment(texts)
+                await write_response(writer, '200 OK', {'results': results})
+            else:
+                await write_response(writer, '404 Not Found', {'error': 'unknown path: ' + path})
+        except (ValueError, KeyError) as e:
+            await write_response(writer, '400 Bad Request', {'error': str(e)})
+        except Exception as e:
+            logger.exception('Failed to serve the request')
+            await write_response(writer, '500 Internal Server Error', {'error': str(e)})
+
+    return handle
+
+
+async def serve(model, host, port, batch_size, max_wait):
+    batcher = MicroBatcher(model, batch_size, max_wait)
+    asyncio.ensure_future(batcher.run())
+
+    server = await asyncio.start_server(make_handler(batcher), host, port)
+    logger.info('Serving on {}:{}, batch_size {}, max wait {:.3f} s'.format(host, port, batch_size, max_wait))
+
+    async with server:
+        await server.serve_forever()
+
+
+LOCAL_FLAG = False
+LOCAL_FLAG = True
+
+if __name__=='__main__':
+    if LOCAL_FLAG:
+        kwargs = set_local_eval_param()
+    else:
+        kwargs = set_server_eval_param()
+
+    args._parse(kwargs)
+
+    model = preload(args)
+    asyncio.run(serve(model, args.server_host, args.server_port, args.eval_batch_size, args.server_max_wait_ms/1000.))
@@ -35,7 +35,7 @@ from src.BERT.modeling import BertConfig
 # `BertConfig`. To create a models from a Google pretrained models use
 # `models = BertVariant.from_pretrained(PRETRAINED_MODEL_NAME)`
 
-from src.customize_modeling import BertVariant
+from src.customize_modeling import BertVariant, freeze_except_exits
 from tensorboardX import SummaryWriter
 
 import logging
@@ -103,7 +103,9 @@ def load_model(label_list, args):
 #    }
 #    models = models[args.fclassifier]()
 
-    model = BertVariant(bert_config, len(label_list), method=args.method, fclassifier=args.fclassifier)
+    model = BertVariant(bert_config, len(label_list), method=args.method, fclassifier=args.fclassifier,
+                        early_exit=args.early_exit)
+    model.exit_threshold = args.exit_threshold
 
     if args.bert_model_dir is None:
         raise RuntimeError('Evaluating a random initialized models is not supported...!')
@@ -139,6 +141,13 @@ def load_model(label_list, args):
             logger.info("Weights from pretrained models not used in {}: {}".format(
                 model.__class__.__name__, unexpected_keys))
 
+    if args.early_exit_posthoc:
+        if args.bert_model is None:
+            raise RuntimeError('Training the exit classifiers needs the fine-tuned weights, bert_model!')
+
+        # the exit classifiers are not in the fine-tuned weights
+        model.load_state_dict(torch.load(args.bert_model, map_location='cpu'), strict=False)
+
     model.to(device)
     if args.local_rank != -1:
         model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.local_rank],
@@ -330,6 +339,9 @@ def do_eval(model, eval_dataloader, device, args, times=None, type='test'):
     eval_time = (time.time() - st) / 60.
     model.train()
 
+    base_model = model.module if hasattr(model, 'module') else model
+    exit_info = base_model.exit_report() if base_model.early_exit else None
+
     logger.info('Eval time: %.2fmin' % eval_time)
     output_eval_file = os.path.join(args.output_dir, type+"_eval_results.txt")
 
@@ -358,6 +370,10 @@ def do_eval(model, eval_dataloader, device, args, times=None, type='test'):
                                eval_time, avg_loss, score[0], score[1], score[2], score[3], sInfo[-1]))
             results = [eval_time, avg_loss, score[0], score[1], score[2], score[3], sInfo[-1]]
 
+        if exit_info is not None: # histogram of the early exits
+            logger.info(type + ': ' + exit_info)
+            writer.write(type + ': ' + exit_info + '\n')
+
     return results
 
 
@@ -419,6 +435,9 @@ def train_4CWS(args):
             for param in model.bert.parameters():
                 param.requires_grad = False
 
+        if args.early_exit_posthoc:
+            param_optimizer = freeze_except_exits(model.module if hasattr(model, 'module') else model)
+
     optimizer_grouped_parameters = [
         {'params': [p for n, p in param_optimizer if n not in no_decay], 'weight_decay_rate': 0.01},
         {'params': [p for n, p in param_optimizer if n in no_decay], 'weight_decay_rate': 0.0}
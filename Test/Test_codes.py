@@ -780,6 +780,710 @@ def test_words2dict_tuple():
         word_mat[i][j] = 1
 
 
+def test_extract_embedding_bag():
+    # compare extract_embedding_bag with extract_embedding_speed: outputs, gradients, time and peak memory
+    from src.BERT.modeling import BertConfig
+    from src.customize_modeling import BertMLEmbeddings
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    config = BertConfig(119547)
+    embeddings = BertMLEmbeddings(config).to(device)
+
+    # extract_embedding_speed needs several GB at the batch size of training, keep it smaller on the CPU
+    batch_size = 128 if device.type == 'cuda' else 16
+    max_seq_len, max_chunk_per_word = 128, 64
+    num_subwords = torch.randint(0, 5, (batch_size, max_seq_len)) # 0: padded words
+    token_ids = torch.zeros(batch_size, max_seq_len, max_chunk_per_word, dtype=torch.long)
+    for i in range(batch_size):
+        for j in range(max_seq_len):
+            token_ids[i, j, :num_subwords[i, j]] = torch.randint(1, config.vocab_size, (int(num_subwords[i, j]),))
+    token_ids = token_ids.to(device)
+
+    outputs, grads = [], []
+    for extract in [embeddings.extract_embedding_speed, embeddings.extract_embedding_bag]:
+        embeddings.zero_grad()
+        if device.type == 'cuda':
+            torch.cuda.reset_max_memory_allocated()
+
+        st = time.time()
+        words_embeddings = extract(token_ids)
+        words_embeddings.sum().backward()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+            print('{}: {:.3f}s, peak memory {:.1f}MB'.format(extract.__name__, time.time()-st,
+                                                             torch.cuda.max_memory_allocated()/2**20))
+        else:
+            print('{}: {:.3f}s'.format(extract.__name__, time.time()-st))
+
+        outputs.append(words_embeddings.detach())
+        grads.append(embeddings.word_embeddings.weight.grad.clone())
+
+    # row 0, i.e., [PAD], gets NaN gradients from the padded words in extract_embedding_speed
+    assert torch.allclose(outputs[0], outputs[1], atol=1e-6)
+    assert torch.allclose(grads[0][1:], grads[1][1:], atol=1e-6)
+
+
+
+def test_ragged_cand_indexes():
+    # dense and ragged cand indexes of the same sentences: bytes per sentence, bytes per batch and outputs of BertMLModel
+    from torch.utils.data.dataloader import default_collate
+    from src.BERT.modeling import BertConfig
+    from src.customize_modeling import BertMLModel
+    from src.preprocess import tokenize_text_with_cand_indexes_to_words, collate_csr
+
+    vocab_file = './src/BERT/models/multi_cased_L-12_H-768_A-12/vocab.txt'
+    tokenizer = BertTokenizer(vocab_file=vocab_file, do_lower_case=False)
+    texts = ['款款好看的美甲，简直能搞疯“选择综合症”诶！', 'Taiwan的公视今天主办的台北市长candidate defence，',
+             '目前由２３２位院士（Ｆｅｌｌｏｗ及Ｆｏｕｎｄｉｎｇ　Ｆｅｌｌｏｗ）']
+    max_length = 128
+
+    batches = []
+    for ragged, collate in [(False, default_collate), (True, collate_csr)]:
+        examples = [tokenize_text_with_cand_indexes_to_words(text, max_length, tokenizer, ragged=ragged)[:2]
+                    for text in texts]
+        batch = collate([(tuple(token), cand_index) for token, cand_index in examples])
+        print('ragged={}: {} bytes per sentence, {} bytes per batch'.format(ragged,
+            sum(x.nbytes for x in examples[0][1]), sum(x.numel()*x.element_size() for x in batch[1])))
+        batches.append(batch)
+
+    config = BertConfig(119547, hidden_size=64, num_hidden_layers=2, num_attention_heads=4, intermediate_size=128)
+    model = BertMLModel(config)
+    model.eval()
+
+    input_ids, segment_ids, input_mask = batches[0][0]
+    outputs, grads = [], []
+    for batch in batches:
+        model.zero_grad()
+        output = model(input_ids, segment_ids, input_mask, False, *batch[1])[0]
+        output.sum().backward()
+        outputs.append(output.detach())
+        grads.append([p.grad.clone() for p in model.parameters() if p.grad is not None])
+
+    assert torch.equal(outputs[0], outputs[1])
+    assert len(grads[0]) == len(grads[1]) and all(torch.equal(a, b) for a, b in zip(*grads))
+
+    # DataParallel scatters every input by rows, so the rows of the ragged batch carry their own offsets
+    with torch.no_grad():
+        inputs = [input_ids, segment_ids, input_mask] + list(batches[1][1])
+        scattered = [model(*chunk[:3], False, *chunk[3:])[0] for chunk in zip(*[x.chunk(2) for x in inputs])]
+    assert torch.allclose(torch.cat(scattered), outputs[1], atol=1e-6)
+
+def test_pack_sequences():
+    # the same sentences in one padded row each and packed into full rows: rows, padding and outputs of the CRF
+    from src.TorchCRF import CRF
+    from src.utilis import pack_sequences, pack_row, unpack_tags
+
+    lengths = [5, 12, 3, 30, 7, 9, 2, 17]
+    max_length = 32
+    num_tags = 6
+
+    rows = pack_sequences(lengths, max_length)
+    print('{} rows, padding: {} -> {} tokens'.format(len(rows), len(lengths)*max_length-sum(lengths),
+                                                    len(rows)*max_length-sum(lengths)))
+
+    crf = CRF(num_tags, batch_first=True)
+    emissions = [torch.randn(n, num_tags) for n in lengths]
+    tags = [torch.randint(num_tags, (n,)) for n in lengths]
+
+    llh = sum(crf(e.unsqueeze(0), t.unsqueeze(0)) for e, t in zip(emissions, tags))
+    best_tags_list = [crf.decode(e.unsqueeze(0))[0] for e in emissions]
+
+    packed = [pack_row([(emissions[i], tags[i], torch.ones(lengths[i], dtype=torch.uint8)) for i in row],
+                       [lengths[i] for i in row], max_length) for row in rows]
+    packed_emissions, packed_tags, packed_mask = [torch.stack([torch.from_numpy(p[0][k]) for p in packed]) for k in range(3)]
+    pack_ids = torch.stack([torch.from_numpy(p[1]) for p in packed])
+
+    packed_llh = crf(packed_emissions, packed_tags, packed_mask, pack_ids=pack_ids)
+    packed_best_tags_list = unpack_tags(crf.decode(packed_emissions, packed_mask, pack_ids),
+                                        [[lengths[i] for i in row] for row in rows])
+    order = [i for row in rows for i in row]
+
+    print('log likelihood: {:.5f} vs {:.5f}'.format(llh.item(), packed_llh.item()))
+    assert torch.allclose(llh, packed_llh)
+    assert all(best_tags_list[i] == t for i, t in zip(order, packed_best_tags_list))
+
+class BatchBenchmark(object):
+    """Batch shared by the speed tests: the device, cuda if available, the batch size, the sequence length and the
+    number of timed runs, with random lengths, the first one max_seq_len, and their mask.
+    time(fn) is the mean time of fn over num_runs calls after a warm-up call, report(info, *args) prints info
+    followed by the batch shape."""
+    def __init__(self, batch_size=32, max_seq_len=128, num_runs=5, min_length=1):
+        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.batch_size, self.max_seq_len, self.num_runs = batch_size, max_seq_len, num_runs
+
+        self.lengths = torch.randint(min_length, max_seq_len+1, (batch_size,), device=self.device)
+        self.lengths[0] = max_seq_len
+        self.mask = (torch.arange(max_seq_len, device=self.device).unsqueeze(0) < self.lengths.unsqueeze(1)).byte()
+
+    def time(self, fn):
+        fn() # warm up
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize()
+        st = time.time()
+        for _ in range(self.num_runs):
+            fn()
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize()
+
+        return (time.time()-st)/self.num_runs
+
+    def report(self, info, *args):
+        print((info + ' per batch of {}x{}').format(*(args + (self.batch_size, self.max_seq_len))))
+
+def test_MHMLA_speed():
+    # time of the layer mixing of MHMLA, sum_last4 and cat_last4, alone and in BertVariantCWSPOS with its biLSTM
+    from src.BERT.modeling import BertConfig
+    from src.customize_modeling import BertVariantCWSPOS
+
+    bench = BatchBenchmark()
+    config = BertConfig(119547, num_hidden_layers=12)
+
+    input_ids = torch.randint(1, config.vocab_size, (bench.batch_size, bench.max_seq_len), device=bench.device)
+    input_mask = torch.ones_like(input_ids)
+
+    for method in ['fine_tune', 'sum_last4', 'cat_last4', 'MHMLA']:
+        model = BertVariantCWSPOS(config, method=method).to(bench.device)
+        model.eval()
+
+        with torch.no_grad():
+            encoded_layers, _ = model.bert(input_ids, None, input_mask, output_all_encoded_layers=True)
+
+            # the mixing only, on the stored encoder outputs
+            if method == 'MHMLA':
+                mixing_fn = lambda: model.MHMLA(encoded_layers)
+            elif method == 'sum_last4':
+                mixing_fn = lambda: sum(encoded_layers[-4:])
+            elif method == 'cat_last4':
+                mixing_fn = lambda: torch.cat(encoded_layers[-4:], 2)
+            else:
+                mixing_fn = lambda: encoded_layers[-1]
+
+            times = [bench.time(lambda: model._compute_bert_feats(input_ids, None, input_mask)), bench.time(mixing_fn)]
+
+        bench.report('{}: features {:.3f}s, layer mixing {:.4f}s', method, times[0], times[1])
+
+def test_output_layers():
+    # memory of the layer outputs kept by BertModel for sum_last4 and cat_last4, all layers vs output_layers
+    from src.BERT.modeling import BertConfig, BertModel
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model = BertModel(BertConfig(119547)).to(device)
+    model.eval()
+    input_ids = torch.randint(1, 119547, (32, 128), device=device)
+
+    for layer_reduction in ['sum', 'cat']:
+        for output_layers in [None, slice(-4, None)]:
+            if device.type == 'cuda':
+                torch.cuda.reset_max_memory_allocated()
+
+            with torch.no_grad():
+                if output_layers is None: # the old way, all the layers are kept
+                    encoded_layers, _ = model(input_ids, output_all_encoded_layers=True)
+                    kept = sum(t.numel()*t.element_size() for t in encoded_layers)
+                    features = sum(encoded_layers[-4:]) if layer_reduction == 'sum' else torch.cat(encoded_layers[-4:], 2)
+                else:
+                    features, _ = model(input_ids, output_layers=output_layers, layer_reduction=layer_reduction)
+                    kept = features.numel()*features.element_size()
+
+            info = '{} last4, output_layers={}: {:.1f}MB of layer outputs'.format(layer_reduction, output_layers, kept/2**20)
+            if device.type == 'cuda':
+                info += ', peak memory {:.1f}MB'.format(torch.cuda.max_memory_allocated()/2**20)
+            print(info)
+
+def test_sparse_qkv_speed():
+    # grouped query/key/value projections: equal to the dense ones without their off-diagonal blocks and reloaded
+    # by InferenceSession.from_checkpoint, then the FLOPs and the time of the projections and of the encoder
+    import copy
+    import tempfile
+    import torch.nn.functional as F
+    from src.BERT.modeling import BertConfig
+    from src.customize_modeling import BertVariantCWSPOS, BertCWSPOS, GroupedLinear, use_sparse_qkv, \
+        sparse_qkv_layers
+    from src.inference_session import InferenceSession
+
+    bench = BatchBenchmark()
+    config = BertConfig(119547, num_hidden_layers=12)
+
+    input_ids = torch.randint(1, config.vocab_size, (bench.batch_size, bench.max_seq_len), device=bench.device)
+    input_mask = torch.ones_like(input_ids)
+    hidden_states = torch.randn(bench.batch_size, bench.max_seq_len, config.hidden_size, device=bench.device)
+
+    dense = BertVariantCWSPOS(config).to(bench.device)
+    sparse = use_sparse_qkv(copy.deepcopy(dense), keep_bottom_layers=4)
+    num_sparse = config.num_hidden_layers - 4
+
+    linear = dense.bert.encoder.layer[-1].attention.self.query
+    head_of = torch.arange(config.hidden_size, device=bench.device) // (config.hidden_size // config.num_attention_heads)
+    block_diagonal = (head_of.unsqueeze(1) == head_of.unsqueeze(0)).float()
+    with torch.no_grad():
+        grouped = GroupedLinear.from_dense(linear, config.num_attention_heads)
+        assert torch.allclose(grouped(hidden_states), F.linear(hidden_states, linear.weight*block_diagonal, linear.bias),
+                              atol=1e-5)
+
+    # a checkpoint saved after use_sparse_qkv is converted and loaded the same way
+    small_config = BertConfig(119547, hidden_size=64, num_hidden_layers=4, num_attention_heads=4, intermediate_size=128)
+    vocab_file = './src/BERT/models/multi_cased_L-12_H-768_A-12/vocab.txt'
+    texts = ['款款好看的美甲，简直能搞疯“选择综合症”诶！', 'Taiwan的公视今天主办的台北市长candidate defence，']
+    model = use_sparse_qkv(BertCWSPOS('cpu', small_config, vocab_file, 64, batch_size=4), keep_bottom_layers=2)
+    model.eval()
+    with tempfile.NamedTemporaryFile(suffix='.pt') as f:
+        torch.save(model.state_dict(), f.name)
+        assert sparse_qkv_layers(torch.load(f.name)) == [2, 3]
+        session = InferenceSession.from_checkpoint(BertCWSPOS, f.name, small_config, vocab_file, 64, \
+                                                   device=torch.device('cpu'), batch_size=4)
+    with torch.no_grad():
+        assert session.cutlist_noUNK(texts) == model.cutlist_noUNK(texts)
+
+    # multiply-adds of query/key/value per token, the grouped projections are num_attention_heads times smaller
+    dense_flops = 3 * config.hidden_size**2 * config.num_hidden_layers
+    sparse_flops = 3 * config.hidden_size**2 * (4 + num_sparse/config.num_attention_heads)
+    print('qkv multiply-adds per token: dense {:.1f}M, sparse {:.1f}M ({:.1f}x)'.format(
+        dense_flops/1e6, sparse_flops/1e6, dense_flops/sparse_flops))
+
+    for name, model in [('dense', dense), ('sparse', sparse)]:
+        model.eval()
+        self_attention = model.bert.encoder.layer[-1].attention.self
+        if name == 'dense':
+            qkv_fn = lambda: (self_attention.query(hidden_states), self_attention.key(hidden_states), \
+                              self_attention.value(hidden_states))
+        else:
+            qkv_fn = lambda: self_attention.qkv(hidden_states)
+
+        with torch.no_grad():
+            times = [bench.time(qkv_fn), \
+                     bench.time(lambda: model.bert(input_ids, None, input_mask, output_all_encoded_layers=False))]
+
+        bench.report('{}: qkv of one layer {:.4f}s, encoder {:.3f}s', name, times[0], times[1])
+
+def test_prune_heads_speed():
+    # BertVariantCWSPOS with 12, 8 and 4 heads per layer, the pruned heads chosen at random: the pruned encoder equals
+    # the full one with those heads masked, its state dict is loaded through match_pruned_heads, and the encoder time
+    import copy
+    from src.BERT.modeling import BertConfig
+    from src.customize_modeling import BertVariantCWSPOS
+    from src.head_pruning import prune_heads, head_mask_hook, match_pruned_heads
+
+    bench = BatchBenchmark()
+    config = BertConfig(119547, num_hidden_layers=12)
+    head_size = config.hidden_size // config.num_attention_heads
+
+    input_ids = torch.randint(1, config.vocab_size, (bench.batch_size, bench.max_seq_len), device=bench.device)
+    input_mask = torch.ones_like(input_ids)
+    full = BertVariantCWSPOS(config).to(bench.device)
+    full.eval()
+
+    for num_heads_kept in [12, 8, 4]:
+        model = copy.deepcopy(full)
+        heads = {l: torch.randperm(12)[:12-num_heads_kept].tolist() for l in range(config.num_hidden_layers)}
+        prune_heads(model, heads)
+        model.eval()
+
+        state_dict = model.state_dict()
+        reloaded = match_pruned_heads(copy.deepcopy(full), state_dict)
+        reloaded.load_state_dict(state_dict)
+        reloaded.eval()
+
+        handles = []
+        for l, layer in enumerate(full.bert.encoder.layer):
+            head_mask = torch.ones(config.num_attention_heads, device=bench.device)
+            head_mask[heads[l]] = 0.
+            handles.append(layer.attention.self.register_forward_hook(head_mask_hook(head_mask, head_size)))
+
+        with torch.no_grad():
+            pruned_output, _ = model.bert(input_ids[:2], None, input_mask[:2], output_all_encoded_layers=False)
+            masked_output, _ = full.bert(input_ids[:2], None, input_mask[:2], output_all_encoded_layers=False)
+            reloaded_output, _ = reloaded.bert(input_ids[:2], None, input_mask[:2], output_all_encoded_layers=False)
+        for handle in handles:
+            handle.remove()
+        assert torch.allclose(pruned_output, masked_output, atol=1e-5)
+        assert torch.allclose(reloaded_output, pruned_output, atol=1e-6)
+
+        with torch.no_grad():
+            encoder_time = bench.time(lambda: model.bert(input_ids, None, input_mask, output_all_encoded_layers=False))
+
+        num_params = sum(p.numel() for p in model.bert.encoder.parameters())
+        bench.report('{} heads per layer, {:.1f}M encoder parameters: encoder {:.3f}s', \
+                     num_heads_kept, num_params/1e6, encoder_time)
+
+def test_prune_ffn_speed():
+    # BertVariantCWSPOS with the feed-forward blocks pruned by magnitude: the pruned encoder equals the full one with
+    # the dropped intermediate neurons zeroed, it is reloaded from export_pruned_model, and its time and size
+    import copy
+    import os
+    import tempfile
+    from src.BERT.modeling import BertConfig, WEIGHTS_NAME
+    from src.customize_modeling import BertVariantCWSPOS
+    from src.ffn_pruning import prune_ffn, compute_neuron_importance, export_pruned_model, CONFIG_NAME
+
+    bench = BatchBenchmark()
+    config = BertConfig(119547, num_hidden_layers=12)
+
+    input_ids = torch.randint(1, config.vocab_size, (bench.batch_size, bench.max_seq_len), device=bench.device)
+    input_mask = torch.ones_like(input_ids)
+    full = BertVariantCWSPOS(config).to(bench.device)
+    full.eval()
+    importance = compute_neuron_importance(full, 'magnitude')
+
+    for intermediate_size in [3072, 2048, 1024]:
+        model = prune_ffn(copy.deepcopy(full), intermediate_size)
+        model.eval()
+
+        # a dropped neuron has no effect once its column of BertOutput.dense is zeroed
+        zeroed = copy.deepcopy(full)
+        with torch.no_grad():
+            for layer, layer_importance in zip(zeroed.bert.encoder.layer, importance):
+                dropped = torch.ones_like(layer_importance, dtype=torch.bool)
+                dropped[torch.topk(layer_importance, intermediate_size)[1]] = False
+                layer.output.dense.weight[:, dropped] = 0.
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            export_pruned_model(model, output_dir)
+            exported_config = BertConfig.from_json_file(os.path.join(output_dir, CONFIG_NAME))
+            assert exported_config.intermediate_size == intermediate_size
+            reloaded = BertVariantCWSPOS(exported_config).to(bench.device)
+            reloaded.load_state_dict(torch.load(os.path.join(output_dir, WEIGHTS_NAME), map_location=bench.device))
+            reloaded.eval()
+
+        with torch.no_grad():
+            pruned_output, _ = model.bert(input_ids[:2], None, input_mask[:2], output_all_encoded_layers=False)
+            zeroed_output, _ = zeroed.bert(input_ids[:2], None, input_mask[:2], output_all_encoded_layers=False)
+            reloaded_output, _ = reloaded.bert(input_ids[:2], None, input_mask[:2], output_all_encoded_layers=False)
+        assert torch.allclose(pruned_output, zeroed_output, atol=1e-5)
+        assert torch.allclose(reloaded_output, pruned_output, atol=1e-6)
+
+        with torch.no_grad():
+            encoder_time = bench.time(lambda: model.bert(input_ids, None, input_mask, output_all_encoded_layers=False))
+
+        num_params = sum(p.numel() for p in model.bert.encoder.parameters())
+        bench.report('intermediate_size {}, {:.1f}M encoder parameters: encoder {:.3f}s', \
+                     intermediate_size, num_params/1e6, encoder_time)
+
+def test_viterbi_speed():
+    # time of CRF.decode with the batched trace back, for the CWS and the POS tags
+    from src.TorchCRF import CRF
+
+    bench = BatchBenchmark()
+    mask = bench.mask
+
+    for num_tags in [6, 110]:
+        crf = CRF(num_tags, batch_first=True).to(bench.device)
+        emissions = torch.randn(bench.batch_size, bench.max_seq_len, num_tags, device=bench.device)
+
+        with torch.no_grad():
+            best_tags, seq_lengths = crf.decode_padded(emissions, mask)
+            assert crf.decode(emissions, mask) == [t[:l] for t, l in zip(best_tags.tolist(), seq_lengths.tolist())]
+
+            times = [bench.time(lambda: decode_fn(emissions, mask)) for decode_fn in [crf.decode, crf.decode_padded]]
+
+        bench.report('{} tags: decode {:.4f}s, decode_padded {:.4f}s', num_tags, times[0], times[1])
+
+def test_crf_normalizer_speed():
+    # CRF log likelihood and its gradient, the normalizer by one step per timestep vs by the parallel scan
+    from src.TorchCRF import CRF
+
+    bench = BatchBenchmark()
+    mask = bench.mask
+
+    def llh_backward(crf, emissions, tags):
+        llh = crf(emissions, tags, mask, reduction='none')
+        llh.sum().backward()
+        return llh.detach()
+
+    for num_tags in [4, 6, 110]:
+        crf = CRF(num_tags, batch_first=True).to(bench.device)
+        emissions = torch.randn(bench.batch_size, bench.max_seq_len, num_tags, device=bench.device, requires_grad=True)
+        tags = torch.randint(0, num_tags, (bench.batch_size, bench.max_seq_len), device=bench.device)
+
+        llhs, times = [], []
+        for parallel_scan in [False, True]:
+            crf.parallel_scan = parallel_scan
+            llhs.append(llh_backward(crf, emissions, tags))
+            times.append(bench.time(lambda: llh_backward(crf, emissions, tags)))
+
+        assert torch.allclose(llhs[0], llhs[1], rtol=1e-4)
+        bench.report('{} tags: forward+backward {:.4f}s by step, {:.4f}s by scan', num_tags, times[0], times[1])
+
+def test_constrained_decoding_speed():
+    # time of CRF.decode and of the Softmax decoding with and without the transition constraints, and the
+    # fraction of the decoded sequences which are valid paths of BMES and of the POS tags
+    from src.TorchCRF import CRF, TransitionConstraints, constrained_argmax
+    from src.customize_modeling import default_tag_labels
+
+    bench = BatchBenchmark(min_length=2)
+    mask = bench.mask
+
+    def num_valid(tags_list, constraints):
+        return sum(constraints.allowed_start[tags[0]].item() and constraints.allowed_end[tags[-1]].item() and \
+                   all(constraints.allowed[a, b].item() for a, b in zip(tags[:-1], tags[1:])) for tags in tags_list)
+
+    for num_tags in [6, 110]:
+        constraints = TransitionConstraints(default_tag_labels(num_tags))
+        crf = CRF(num_tags, batch_first=True).to(bench.device)
+        emissions = torch.randn(bench.batch_size, bench.max_seq_len, num_tags, device=bench.device)
+
+        decoders = [('crf', lambda: crf.decode(emissions, mask)), ('softmax', lambda: emissions.max(dim=2)[1].tolist()), \
+                    ('constrained crf', lambda: crf.decode(emissions, mask)), \
+                    ('constrained softmax', lambda: constrained_argmax(emissions, mask, constraints))]
+        with torch.no_grad():
+            for name, decode_fn in decoders:
+                crf.constraints = constraints if name == 'constrained crf' else None
+                decode_time = bench.time(decode_fn)
+
+                tags_list = [tags[:l] for tags, l in zip(decode_fn(), bench.lengths.tolist())]
+                bench.report('{} tags, {}: {}/{} valid paths, {:.4f}s', num_tags, name, \
+                             num_valid(tags_list, constraints), bench.batch_size, decode_time)
+
+def test_crf_nbest_marginals_speed():
+    # time of the token marginals and of the 5-best paths of the whole batch, against CRF.decode
+    from src.TorchCRF import CRF
+
+    bench = BatchBenchmark()
+    mask, nbest = bench.mask, 5
+
+    for num_tags in [6, 110]:
+        crf = CRF(num_tags, batch_first=True).to(bench.device)
+        emissions = torch.randn(bench.batch_size, bench.max_seq_len, num_tags, device=bench.device)
+
+        with torch.no_grad():
+            paths, log_probs = crf.decode_nbest(emissions, mask, nbest)
+            assert [p[0] for p in paths] == crf.decode(emissions, mask)
+            marginals = crf.compute_marginals(emissions, mask)
+            assert torch.allclose(marginals.sum(2), mask.float(), atol=1e-4)
+
+            times = [bench.time(decode_fn) for decode_fn in [lambda: crf.decode(emissions, mask), \
+                     lambda: crf.compute_marginals(emissions, mask), lambda: crf.decode_nbest(emissions, mask, nbest)]]
+
+        bench.report('{} tags, highest best path probability {:.3f}: decode {:.4f}s, marginals {:.4f}s ({:.1f}x), '
+                     '{}-best {:.4f}s ({:.1f}x)', num_tags, log_probs[:, 0].exp().max().item(), times[0], times[1], \
+                     times[1]/times[0], nbest, times[2], times[2]/times[0])
+
+def test_crf_memory_efficient():
+    # CRF loss and gradients by the autograd graph vs by CRFNormalizer: equal in float64, with one sequence per row
+    # and with packed rows, then the time and the bytes kept for the backward pass in float32
+    from src.TorchCRF import CRF
+
+    bench = BatchBenchmark(num_runs=3)
+    mask = bench.mask
+    # packed rows of sequences of up to 50 tokens, see pack_row
+    pack_ids = (torch.arange(bench.max_seq_len, device=bench.device) // 50 + 1).unsqueeze(0) * mask.long()
+
+    def llh_and_grads(crf, emissions, tags, pack_ids=None):
+        emissions.grad = None
+        crf.zero_grad()
+        llh = crf(emissions, tags, mask, pack_ids=pack_ids)
+        (-llh).backward()
+        return [llh.detach(), emissions.grad.clone()] + [p.grad.clone() for p in crf.parameters()]
+
+    def count_bytes(saved_bytes):
+        def pack(tensor):
+            saved_bytes.append(tensor.numel() * tensor.element_size())
+            return tensor
+        return pack
+
+    for num_tags in [6, 110]:
+        crf = CRF(num_tags, batch_first=True).to(bench.device)
+        tags = torch.randint(0, num_tags, (bench.batch_size, bench.max_seq_len), device=bench.device)
+
+        crf.double()
+        emissions = torch.randn(bench.batch_size, bench.max_seq_len, num_tags, device=bench.device, \
+                                dtype=torch.double, requires_grad=True)
+        for row_pack_ids in [None, pack_ids]:
+            results = []
+            for memory_efficient in [False, True]:
+                crf.memory_efficient = memory_efficient
+                results.append(llh_and_grads(crf, emissions, tags, row_pack_ids))
+            assert all(torch.allclose(a, b) for a, b in zip(*results))
+
+        crf.float()
+        emissions = emissions.detach().float().requires_grad_()
+        times, saved = [], []
+        for memory_efficient in [False, True]:
+            crf.memory_efficient = memory_efficient
+            saved_bytes = []
+            with torch.autograd.graph.saved_tensors_hooks(count_bytes(saved_bytes), lambda tensor: tensor):
+                crf(emissions, tags, mask)
+            saved.append(sum(saved_bytes))
+            times.append(bench.time(lambda: llh_and_grads(crf, emissions, tags)))
+
+        bench.report('{} tags: saved for backward {:.1f}MB vs {:.1f}MB, forward+backward {:.4f}s vs {:.4f}s', \
+                     num_tags, saved[0]/2**20, saved[1]/2**20, times[0], times[1])
+
+def test_tags_to_spans():
+    # words and POS of tags_to_spans and spans_to_words vs the reconstruction from digit strings they replaced
+    from src.config import segType, posType
+    from src.utilis import clean_cws_tags, bio2pos_index, tags_to_spans, spans_to_words
+
+    def old_cws_output(rs, lang_status=None):
+        cws_decode_output = ''.join(str(v) for v in rs)
+        cws_decode_output = cws_decode_output.replace(str(segType.BMES_label_map['[START]']), str(segType.BMES_label_map['S']))
+        cws_decode_output = cws_decode_output.replace(str(segType.BMES_label_map['[END]']), str(segType.BMES_label_map['S']))
+        if lang_status is not None:
+            cws_decode_output_l = list(cws_decode_output)
+            for ii, ls_ii in enumerate(lang_status[:len(rs)]):
+                if ls_ii==1: cws_decode_output_l[ii] = str(segType.BMES_label_map['S'])
+            cws_decode_output = ''.join(cws_decode_output_l)
+        return cws_decode_output
+
+    def old_words(text, cws_tag, pos_tag):
+        result_str, result_pos = '', ''
+        tmp_pos = []
+        seg_start = False
+        for idx in range(len(cws_tag)):
+            tt = text[idx].replace('##', '')
+            int_ti = int(cws_tag[idx])
+            pos_tag_i = pos_tag[idx]
+            if int_ti == segType.BMES_label_map['B']:
+                result_str += ' ' + tt
+                seg_start = True
+                result_pos += pos_tag_i + ' '
+                tmp_pos = [pos_tag_i]
+            elif int_ti > segType.BMES_label_map['M']:
+                result_str += tt + ' '
+                if tmp_pos == []:
+                    result_pos += pos_tag_i + ' '
+                tmp_pos = []
+                seg_start = False
+            else:
+                result_str += tt
+                tmp_pos.append(pos_tag_i)
+                if not seg_start:
+                    seg_start = True
+                    result_pos += pos_tag_i + ' '
+        return result_str.strip().split(), result_pos.strip().split()
+
+    B, M, E, S = [segType.BMES_label_map[t] for t in ['B', 'M', 'E', 'S']]
+    START, END = segType.BMES_label_map['[START]'], segType.BMES_label_map['[END]']
+    # the tokens of each chunk, its raw cws tags, BIO pos tags and lang_status, the second chunk is empty
+    chunks = [(['我', '们', '在', 'Tai', '##wan', '看', '了'], [B, E, S, B, E, START, M],
+               [5, 6, 8, 20, 21, 2, 9], [0, 0, 0, 1, 1, 0, 0]),
+              ([], [], [], []),
+              (['球', '赛', 'game', '##s', '，', '很', '好'], [M, E, B, M, END, S, B],
+               [11, 12, 30, 31, 1, 40, 41], [0, 0, 1, 1, 0, 0, 0]),
+              (['看'], [E], [50], [0])]
+
+    for with_lang in [False, True]:
+        lang_list = [c[3] for c in chunks] if with_lang else [None]*len(chunks)
+
+        old_text = sum([c[0] for c in chunks], [])
+        cws_tag = ''.join(old_cws_output(c[1], lang) for c, lang in zip(chunks, lang_list))
+        pos_tag = ' '.join(' '.join(posType.POS_label_map[(v-2)//3] if v > 2 else posType.POS_label_map[35]
+                                    for v in c[2]) for c in chunks).split()
+        expected = old_words(old_text, cws_tag, pos_tag)
+
+        chunk_list, offset_list = [], []
+        for c in chunks:
+            units = [t.replace('##', '') for t in c[0]]
+            ends = np.cumsum([len(u) for u in units], dtype=np.int64)
+            chunk_list.append(''.join(units))
+            offset_list.append(np.stack([ends-[len(u) for u in units], ends], axis=1) if units else np.zeros((0, 2), dtype=np.int64))
+
+        cws_tag_list = [clean_cws_tags(c[1], lang) for c, lang in zip(chunks, lang_list)]
+        pos_tag_list = [bio2pos_index(c[2]) for c in chunks]
+        word_spans, word_pos = tags_to_spans(chunk_list, offset_list, cws_tag_list, pos_tag_list)
+        words, pos_ls = spans_to_words(''.join(chunk_list), word_spans, word_pos.tolist())
+
+        assert words == expected[0], (words, expected[0])
+        assert [posType.POS_label_map[p] for p in pos_ls] == expected[1], (pos_ls, expected[1])
+        print('lang_status={}: {}'.format(with_lang, ' '.join(w+'/'+posType.POS_label_map[p] for w, p in zip(words, pos_ls))))
+
+    # no tokens at all
+    word_spans, word_pos = tags_to_spans(['', ''], [np.zeros((0, 2), dtype=np.int64)]*2, [[], []], [[], []])
+    assert word_spans.shape == (0, 2) and len(word_pos) == 0
+    assert spans_to_words('', word_spans, word_pos.tolist()) == ([], [])
+
+def test_tokenize_with_offsets():
+    # tokenize_with_offsets of both tokenizers: the same tokens as tokenize, each covering its surface form in text
+    import unicodedata
+    from src.tokenization import FullTokenizer
+    from src.config import UNK_TOKEN
+
+    vocab_file = './src/BERT/models/multi_cased_L-12_H-768_A-12/vocab.txt'
+    texts = ['款款好看的美甲，简直能搞疯“选择综合症”诶！', 'Taiwan的公视今天主办的台北市长CandiDate DEFENCE，',
+             'Café Noël, résumé naïve ÅNGSTRÖM', '目前由２３２位院士（Ｆｅｌｌｏｗ及Ｆｏｕｎｄｉｎｇ　Ｆｅｌｌｏｗ）',
+             '一个[UNK]字  和 \t两个空格💅\x00的 unbelievably', '']
+
+    def normalize(text, do_lower_case):
+        if not do_lower_case: return text
+        return ''.join(c for c in unicodedata.normalize('NFD', text.lower()) if unicodedata.category(c) != 'Mn')
+
+    for do_lower_case in [False, True]:
+        for tokenizer in [FullTokenizer(vocab_file, do_lower_case), BertTokenizer(vocab_file, do_lower_case)]:
+            num_unk = 0
+            for text in texts:
+                tokens, offsets = tokenizer.tokenize_with_offsets(text)
+                assert tokens == tokenizer.tokenize(text), (text, tokens, tokenizer.tokenize(text))
+                assert len(offsets) == len(tokens)
+
+                for token, (start, end) in zip(tokens, offsets):
+                    assert 0 <= start < end <= len(text), (token, start, end)
+                    if token == UNK_TOKEN:
+                        num_unk += 1
+                    elif token == '[unused1]': # a space, see src/tokenization.py
+                        assert text[start:end] == ' '
+                    else:
+                        assert normalize(text[start:end], do_lower_case) == token.replace('##', '', 1), \
+                            (token, text[start:end])
+            print('{}, do_lower_case={}: {} [UNK]'.format(type(tokenizer).__name__, do_lower_case, num_unk))
+
+def test_cutlist_paths():
+    # the faster paths of cutlist_noUNK give the results of a plain call on the same texts:
+    # segment_stream, the length buckets, the chunk cache and InferenceSession with and without tracing
+    from src.BERT.modeling import BertConfig
+    from src.customize_modeling import BertCWSPOS, BertMLCWSPOS_with_Dict, set_chunk_cache
+    from src.inference_session import InferenceSession
+
+    vocab_file = './src/BERT/models/multi_cased_L-12_H-768_A-12/vocab.txt'
+    config = BertConfig(119547, hidden_size=32, num_hidden_layers=2, num_attention_heads=4, intermediate_size=64)
+    max_length = 64
+    texts = ['款款好看的美甲，简直能搞疯“选择综合症”诶！。这是一组超级温柔又带点设计感的美甲💅。', '',
+             'Taiwan的公视今天主办的台北市长candidate defence，', '#春季美甲##显白美甲#',
+             '目前由２３２位院士（Ｆｅｌｌｏｗ及Ｆｏｕｎｄｉｎｇ　Ｆｅｌｌｏｗ）' * 3, '#春季美甲##显白美甲#']
+
+    torch.manual_seed(0)
+    models = [BertCWSPOS('cpu', config, vocab_file, max_length, 6, 110, batch_size=4, fclassifier='Softmax', \
+                         pclassifier='Softmax'),
+              BertMLCWSPOS_with_Dict('cpu', config, vocab_file, max_length, 6, 110, batch_size=4, \
+                                     do_mask_as_whole=True, dict_file='./resource/dict.txt')]
+
+    for model in models:
+        model.eval()
+
+        # the hidden states of a random encoder share a large common part, remove it so that the tags vary
+        hidden = []
+        handle = model.hidden2CWStag.register_forward_hook(
+            lambda module, inputs, output: hidden.append(inputs[0].reshape(-1, inputs[0].size(-1))))
+        with torch.no_grad():
+            model.cutlist_noUNK(texts)
+            handle.remove()
+            hidden_mean = torch.cat(hidden).mean(0)
+            for classifier in [model.hidden2CWStag, model.hidden2POStag]:
+                classifier.weight.normal_(0, 1.)
+                classifier.bias.copy_(-classifier.weight @ hidden_mean)
+
+            expected = model.cutlist_noUNK(texts)
+
+            # windows of 2 chunks
+            assert list(model.segment_stream(iter(texts), window_size=2)) == expected
+
+            # other buckets and paddings
+            assert [model.cutlist_noUNK([text])[0] for text in texts] == expected
+            assert model.cutlist_noUNK(texts[::-1]) == expected[::-1]
+
+            # decoded once, then read from the chunk cache
+            set_chunk_cache(model)
+            assert model.cutlist_noUNK(texts) == expected
+            assert model.cutlist_noUNK(texts) == expected
+            stats = model.chunk_cache.stats()
+            assert stats['hits'] > 0
+            set_chunk_cache(model, 0)
+
+        for trace_encoder in [False, True]:
+            session = InferenceSession(model, trace_encoder=trace_encoder)
+            assert session.cutlist_noUNK(texts) == expected
+            assert session.cutlist_noUNK(texts[::-1]) == expected[::-1]
+
+        print('{}: {} words, chunk cache {}'.format(type(model).__name__, sum(len(rs) for rs in expected), stats))
+
 if __name__ == '__main__':
     #test_BertCRF_constructor()
     #test_BasicTokenizer()
@@ -831,4 +1535,36 @@ if __name__ == '__main__':
     # test_chunk_list()
     # test_restore_unknown_tokens_with_pos()
 
-    test_words2dict_tuple()
+    #test_words2dict_tuple()
+
+    #test_extract_embedding_bag()
+
+    #test_ragged_cand_indexes()
+
+    #test_pack_sequences()
+
+    #test_MHMLA_speed()
+
+    #test_output_layers()
+
+    #test_sparse_qkv_speed()
+
+    #test_prune_heads_speed()
+
+    #test_prune_ffn_speed()
+
+    #test_viterbi_speed()
+
+    #test_crf_normalizer_speed()
+
+    #test_constrained_decoding_speed()
+
+    #test_crf_nbest_marginals_speed()
+
+    #test_crf_memory_efficient()
+
+    #test_tags_to_spans()
+
+    #test_tokenize_with_offsets()
+
+    test_cutlist_paths()
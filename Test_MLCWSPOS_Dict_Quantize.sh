@@ -0,0 +1,27 @@
+#!/bin/sh
+# int8 export and F1 regression report, appended to quantization_report.txt of each output_dir
+for i in ontonotes_cws_pos2.0,../data/ontonotes5/4nerpos_update/test/feat_with_dict/,./tmp/ontonotes/CWSPOS2/cased2/valid/feat_with_dict/l12/cws_F1_weights_epoch16.pt \
+         msr,../data/4CWS/feat_with_dict/,./tmp/4CWS/MSR/Softmax/fine_tune/l12/cws_F1_weights_epoch16.pt \
+         pku,../data/4CWS/feat_with_dict/,./tmp/4CWS/PKU/Softmax/fine_tune/l12/cws_F1_weights_epoch16.pt
+do
+    IFS=",";
+    set -- $i;
+    echo $1, $2, $3;
+
+    python BertMLCWSPOS_With_Dict_Quantize.py \
+        --task_name $1 \
+        --model_type sequencelabeling \
+        --data_dir $2 \
+        --output_dir ./tmp/int8/$1/ \
+        --bert_model $3 \
+        --bert_model_dir ../models/multi_cased_L-12_H-768_A-12/ \
+        --vocab_file ./src/BERT/models/multi_cased_L-12_H-768_A-12/vocab.txt \
+        --do_lower_case False \
+        --max_seq_length 128 \
+        --init_checkpoint ../models/multi_cased_L-12_H-768_A-12/ \
+        --override_output True \
+        --method fine_tune \
+        --do_mask_as_whole True \
+        --train_batch_size 32 \
+        --no_cuda True
+done
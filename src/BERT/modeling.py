@@ -183,10 +183,11 @@ class BertEmbeddings(nn.Module):
         self.LayerNorm = BertLayerNorm(config)
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
 
-    def forward(self, input_ids, token_type_ids=None):
-        seq_length = input_ids.size(1)
-        position_ids = torch.arange(seq_length, dtype=torch.long, device=input_ids.device)
-        position_ids = position_ids.unsqueeze(0).expand_as(input_ids)
+    def forward(self, input_ids, token_type_ids=None, position_ids=None):
+        if position_ids is None:
+            seq_length = input_ids.size(1)
+            position_ids = torch.arange(seq_length, dtype=torch.long, device=input_ids.device)
+            position_ids = position_ids.unsqueeze(0).expand_as(input_ids)
         if token_type_ids is None:
             token_type_ids = torch.zeros_like(input_ids)
 
@@ -235,6 +236,7 @@ class BertSelfAttention(nn.Module):
         attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
         attention_scores = attention_scores / math.sqrt(self.attention_head_size)
         # Apply the attention mask is (precomputed for all layers in BertModel forward() function)
+        # [batch_size, 1, 1, seq_length], or block-diagonal [batch_size, 1, seq_length, seq_length] for packed sequences
         attention_scores = attention_scores + attention_mask
 
         # Normalize the attention scores to probabilities.
@@ -324,7 +326,11 @@ class BertEncoder(nn.Module):
         layer = BertLayer(config)
         self.layer = nn.ModuleList([copy.deepcopy(layer) for _ in range(config.num_hidden_layers)])    
 
-    def forward(self, hidden_states, attention_mask, output_all_encoded_layers=True):
+    def forward(self, hidden_states, attention_mask, output_all_encoded_layers=True, output_layers=None, \
+                layer_reduction=None, layer_transform=None):
+        if output_layers is not None:
+            return self.forward_selected(hidden_states, attention_mask, output_layers, layer_reduction, layer_transform)
+
         all_encoder_layers = []
         for layer_module in self.layer:
             hidden_states = layer_module(hidden_states, attention_mask)
@@ -334,6 +340,54 @@ class BertEncoder(nn.Module):
             all_encoder_layers.append(hidden_states)
         return all_encoder_layers
 
+    def selected_layers(self, output_layers):
+        # indexes of the layers in output_layers, a slice or a list of indexes, negative ones counted from the top
+        layer_indexes = range(len(self.layer))
+        if isinstance(output_layers, slice):
+            return list(layer_indexes[output_layers])
+
+        return [layer_indexes[l] for l in output_layers]
+
+    def forward_selected(self, hidden_states, attention_mask, output_layers, layer_reduction=None, layer_transform=None):
+        """
+        Retain only the outputs of the layers in output_layers, e.g., slice(-4, None) for the last four layers,
+        each passed through layer_transform if any, e.g., a dropout.
+        layer_reduction: None: the list of the retained outputs; 'sum': their running sum;
+            'cat': their concatenation along the last dimension, in the order of the layers, written in place.
+        Return the retained outputs, or their reduction, and the output of the last layer.
+        """
+        if layer_reduction not in (None, 'sum', 'cat'):
+            raise ValueError('Unknown layer_reduction: %s' % layer_reduction)
+
+        keep_layers = self.selected_layers(output_layers)
+        if layer_reduction == 'cat':
+            positions = {l: k for k, l in enumerate(sorted(keep_layers))}
+        else:
+            positions = {l: k for k, l in enumerate(keep_layers)}
+
+        retained = [None] * len(keep_layers)
+        reduced = None
+        for l, layer_module in enumerate(self.layer):
+            hidden_states = layer_module(hidden_states, attention_mask)
+            if l not in positions:
+                continue
+
+            output = layer_transform(hidden_states) if layer_transform is not None else hidden_states
+            if layer_reduction == 'sum':
+                reduced = output if reduced is None else reduced + output
+            elif layer_reduction == 'cat':
+                hidden_size = output.size(-1)
+                if reduced is None:
+                    reduced = output.new_empty(output.shape[:-1] + (hidden_size*len(keep_layers),))
+                reduced[..., positions[l]*hidden_size:(positions[l]+1)*hidden_size] = output
+            else:
+                retained[positions[l]] = output
+
+        if layer_reduction is None:
+            return retained, hidden_states
+
+        return reduced, hidden_states
+
 
 class BertPooler(nn.Module):
     def __init__(self, config):
@@ -553,6 +607,24 @@ class PreTrainedBertModel(nn.Module):
         return model
 
 
+def packed_position_ids(pack_ids):
+    # the positions restart from 0 at the first token of each packed sequence
+    positions = torch.arange(pack_ids.size(1), dtype=torch.long, device=pack_ids.device).unsqueeze(0).expand_as(pack_ids)
+
+    starts = torch.ones_like(pack_ids, dtype=torch.bool)
+    starts[:, 1:] = pack_ids[:, 1:].ne(pack_ids[:, :-1])
+    start_positions, _ = torch.where(starts, positions, torch.zeros_like(positions)).cummax(dim=1)
+
+    return positions - start_positions
+
+
+def packed_attention_mask(pack_ids):
+    # [batch_size, 1, seq_length, seq_length], 1 if both tokens are in the same packed sequence
+    same_sequence = pack_ids.unsqueeze(2).eq(pack_ids.unsqueeze(1)) & pack_ids.unsqueeze(1).ne(0)
+
+    return same_sequence.unsqueeze(1)
+
+
 class BertModel(PreTrainedBertModel):
     """BERT models ("Bidirectional Embedding Representations from a Transformer").
 
@@ -571,6 +643,13 @@ class BertModel(PreTrainedBertModel):
             input sequence length in the current batch. It's the mask that we typically use for attention when
             a batch has varying length sentences.
         `output_all_encoded_layers`: boolean which controls the content of the `encoded_layers` output as described below. Default: `True`.
+        `pack_ids`: an optional torch.LongTensor of shape [batch_size, sequence_length] when several sequences are
+            packed into each row, the 1-based index of the sequence of each token in its row, 0 for padding. The
+            tokens only attend to the tokens of their own sequence and the positions restart at each sequence.
+        `output_layers`: optional, only retain the outputs of these layers, a slice or a list of indexes, e.g.,
+            slice(-4, None) for the last four layers; `output_all_encoded_layers` is then ignored.
+            `layer_reduction`: None, 'sum' or 'cat', and `layer_transform`, e.g., a dropout: see
+            BertEncoder.forward_selected. The other layer outputs are dropped as soon as the next layer is computed.
 
     Outputs: Tuple of (encoded_layers, pooled_output)
         `encoded_layers`: controled by `output_all_encoded_layers` argument:
@@ -579,6 +658,7 @@ class BertModel(PreTrainedBertModel):
                 encoded-hidden-state is a torch.FloatTensor of size [batch_size, sequence_length, hidden_size],
             - `output_all_encoded_layers=False`: outputs only the full sequence of hidden-states corresponding
                 to the last attention block of shape [batch_size, sequence_length, hidden_size],
+            - `output_layers` is set: the list of the retained layer outputs, or their sum or concatenation,
         `pooled_output`: a torch.FloatTensor of size [batch_size, hidden_size] which is the output of a
             classifier pretrained on top of the hidden state associated to the first character of the
             input (`CLF`) to train on the Next-Sentence task (see BERT's paper).
@@ -604,7 +684,8 @@ class BertModel(PreTrainedBertModel):
         self.pooler = BertPooler(config)
         self.apply(self.init_bert_weights)
 
-    def forward(self, input_ids, token_type_ids=None, attention_mask=None, output_all_encoded_layers=True):
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None, output_all_encoded_layers=True, pack_ids=None, \
+                output_layers=None, layer_reduction=None, layer_transform=None):
         if attention_mask is None:
             attention_mask = torch.ones_like(input_ids)
         if token_type_ids is None:
@@ -615,7 +696,13 @@ class BertModel(PreTrainedBertModel):
         # So we can broadcast to [batch_size, num_heads, from_seq_length, to_seq_length]
         # this attention mask is more simple than the triangular masking of causal attention
         # used in OpenAI GPT, we just need to prepare the broadcast dimension here.
-        extended_attention_mask = attention_mask.unsqueeze(1).unsqueeze(2)
+        # The packed sequences have a block-diagonal mask of [batch_size, 1, from_seq_length, to_seq_length].
+        if pack_ids is not None:
+            extended_attention_mask = packed_attention_mask(pack_ids)
+            position_ids = packed_position_ids(pack_ids)
+        else:
+            extended_attention_mask = attention_mask.unsqueeze(1).unsqueeze(2)
+            position_ids = None
 
         # Since attention_mask is 1.0 for positions we want to attend and 0.0 for
         # masked positions, this operation will create a tensor which is 0.0 for
@@ -625,7 +712,12 @@ class BertModel(PreTrainedBertModel):
         extended_attention_mask = extended_attention_mask.to(dtype=next(self.parameters()).dtype) # fp16 compatibility
         extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
 
-        embedding_output = self.embeddings(input_ids, token_type_ids)
+        embedding_output = self.embeddings(input_ids, token_type_ids, position_ids)
+        if output_layers is not None:
+            encoded_layers, sequence_output = self.encoder(embedding_output, extended_attention_mask, \
+                output_layers=output_layers, layer_reduction=layer_reduction, layer_transform=layer_transform)
+            return encoded_layers, self.pooler(sequence_output)
+
         encoded_layers = self.encoder(embedding_output,
                                       extended_attention_mask,
                                       output_all_encoded_layers=output_all_encoded_layers)
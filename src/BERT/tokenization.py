@@ -86,6 +86,17 @@ class BertTokenizer(object):
                 split_tokens.append(sub_token)
         return split_tokens
 
+    def tokenize_with_offsets(self, text):
+        """Tokenizes text like tokenize, and returns the tokens and the (start, end) offsets of every token
+        in text, so that text[start:end] is the original surface form of the token."""
+        split_tokens = []
+        offsets = []
+        for token, char_offsets in self.basic_tokenizer.tokenize_with_offsets(text):
+            for sub_token, start, end in self.wordpiece_tokenizer.tokenize_with_offsets(token, char_offsets):
+                split_tokens.append(sub_token)
+                offsets.append((start, end))
+        return split_tokens, offsets
+
     def convert_tokens_to_ids(self, tokens):
         """Converts a sequence of tokens into ids using the models."""
         ids = []
@@ -166,6 +177,58 @@ class BasicTokenizer(object):
         output_tokens = whitespace_tokenize(" ".join(split_tokens))
         return output_tokens
 
+    def tokenize_with_offsets(self, text):
+        """Tokenizes a piece of text like tokenize, in one pass over text.
+        Returns a list of (token, char_offsets), where char_offsets[k] is the index in text of the k-th char of token.
+        """
+        # _clean_text, _tokenize_chinese_chars and whitespace_tokenize
+        orig_tokens = []
+        chars = []
+        char_offsets = []
+        for i, char in enumerate(text):
+            cp = ord(char)
+            if cp == 0 or cp == 0xfffd or _is_control(char):
+                continue
+
+            if _is_whitespace(char) or self._is_chinese_char(cp):
+                if chars:
+                    orig_tokens.append((''.join(chars), char_offsets))
+                    chars = []
+                    char_offsets = []
+                if not _is_whitespace(char):
+                    orig_tokens.append((char, [i]))
+            else:
+                chars.append(char)
+                char_offsets.append(i)
+        if chars:
+            orig_tokens.append((''.join(chars), char_offsets))
+
+        output_tokens = []
+        for token, char_offsets in orig_tokens:
+            if self.do_lower_case:
+                norm_chars = []
+                norm_offsets = []
+                for char, offset in zip(token, char_offsets):
+                    for norm_char in self._run_strip_accents(char.lower()):
+                        norm_chars.append(norm_char)
+                        norm_offsets.append(offset)
+                token = ''.join(norm_chars)
+                char_offsets = norm_offsets
+
+            # _run_split_on_punc
+            start_new_word = True
+            for char, offset in zip(token, char_offsets):
+                if _is_punctuation(char):
+                    output_tokens.append((char, [offset]))
+                    start_new_word = True
+                else:
+                    if start_new_word:
+                        output_tokens.append(('', []))
+                    start_new_word = False
+                    output_tokens[-1] = (output_tokens[-1][0]+char, output_tokens[-1][1]+[offset])
+
+        return output_tokens
+
     def _run_strip_accents(self, text):
         """Strips accents from a piece of text."""
         text = unicodedata.normalize("NFD", text)
@@ -305,6 +368,34 @@ class WordpieceTokenizer(object):
                 output_tokens.extend(sub_tokens)
         return output_tokens
 
+    def tokenize_with_offsets(self, token, char_offsets):
+        """Tokenizes a single token from BasicTokenizer.tokenize_with_offsets into its word pieces.
+        Returns a list of (sub_token, start, end), the offsets of the chars covered by every sub_token."""
+        chars = list(token)
+        unk_output = [(self.unk_token, char_offsets[0], char_offsets[-1]+1)]
+        if len(chars) > self.max_input_chars_per_word:
+            return unk_output
+
+        start = 0
+        sub_tokens = []
+        while start < len(chars):
+            end = len(chars)
+            cur_substr = None
+            while start < end:
+                substr = "".join(chars[start:end])
+                if start > 0:
+                    substr = "##" + substr
+                if substr in self.vocab:
+                    cur_substr = substr
+                    break
+                end -= 1
+            if cur_substr is None:
+                return unk_output
+            sub_tokens.append((cur_substr, char_offsets[start], char_offsets[end-1]+1))
+            start = end
+
+        return sub_tokens
+
 
 def _is_whitespace(char):
     """Checks whether `chars` is a whitespace character."""
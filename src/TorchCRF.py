@@ -1,7 +1,616 @@
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+
+
+BOUNDARY_TAGS = ('[START]', '[END]')
+# tags after which a word is complete, so that a new word or the end of the sentence can follow
+WORD_END_PREFIXES = ('[START]', 'E', 'S', 'I', 'O')
+# penalty of the start and end tags which are not allowed, finite so that a one-timestep sequence is still decoded
+DISALLOWED_SCORE = -10000.
+# below this number of tags, the dense search, the disallowed transitions masked, costs less than the blocks
+MIN_PRUNED_TAGS = 32
+
+
+def allowed_transitions(labels: List[str]) -> Tuple[torch.BoolTensor, torch.BoolTensor, torch.BoolTensor]:
+    """Allowed tags of a label scheme, e.g., ``SegType.BMES_idx_to_label_map`` or ``POSType.BIO_idx_to_label_map``.
+
+    Arguments
+    ---------
+    labels : List[str]
+        The tags in index order, e.g., ['[START]', '[END]', 'B', 'M', 'E', 'S'] or ['[START]', '[END]',
+        'B-AD', 'I-AD', 'O-AD', ...], where O-X tags a one-character word of type X.
+
+    Returns
+    -------
+    Tuple[:class:`~torch.BoolTensor`, :class:`~torch.BoolTensor`, :class:`~torch.BoolTensor`]
+        The tags allowed at the first and at the last timestep, of size ``(num_tags,)``, and
+        the allowed transitions, of size ``(num_tags, num_tags)``, where entry (i, j) is
+        whether tag j can follow tag i. E.g., B->B, M->S or B-VV->I-NN are not allowed.
+    """
+    parsed = []
+    for label in labels:
+        if label in BOUNDARY_TAGS:
+            parsed.append((label, ''))
+            continue
+        prefix, _, tag_type = label.partition('-')
+        if prefix not in ('B', 'M', 'E', 'S', 'I', 'O'):
+            raise ValueError(f'unknown tag of a BMES or BIO scheme: {label}')
+        parsed.append((prefix, tag_type))
+
+    def can_follow(prev, cur):
+        (prev_prefix, prev_type), (cur_prefix, cur_type) = prev, cur
+        if cur_prefix == '[START]':
+            return prev_prefix == '[END]'
+        if cur_prefix in ('[END]', 'B', 'S', 'O'):
+            return prev_prefix in WORD_END_PREFIXES
+        if cur_prefix in ('M', 'E'):
+            return prev_prefix in ('B', 'M')
+        # I-X continues a word of type X
+        return prev_prefix in ('B', 'I') and prev_type == cur_type
+
+    allowed = torch.tensor([[can_follow(prev, cur) for cur in parsed] for prev in parsed], dtype=torch.bool)
+
+    prefixes = [prefix for prefix, _ in parsed]
+    if '[START]' in prefixes:
+        allowed_start = torch.tensor([prefix == '[START]' for prefix in prefixes], dtype=torch.bool)
+    else:
+        allowed_start = torch.tensor([prefix in ('B', 'S', 'O') for prefix in prefixes], dtype=torch.bool)
+    if '[END]' in prefixes:
+        allowed_end = torch.tensor([prefix == '[END]' for prefix in prefixes], dtype=torch.bool)
+    else:
+        allowed_end = torch.tensor([prefix in WORD_END_PREFIXES[1:] for prefix in prefixes], dtype=torch.bool)
+
+    return allowed_start, allowed_end, allowed
+
+
+class TransitionConstraints:
+    """Allowed tags of a label scheme, as used by the Viterbi decoding, see :func:`allowed_transitions`.
+
+    The disallowed start and end tags get a large negative score. The disallowed transitions
+    are removed from the search: the tags sharing the same allowed predecessors, e.g., B-*, O-*
+    and [END] of the POS tags, are searched as one dense block, and each of the other tags,
+    e.g., I-X after B-X or I-X, only looks at its own few predecessors. For the 110 POS tags, a
+    step then scores 73x73 + 37x2 transitions instead of 110x110, and its paths are always valid.
+
+    Arguments
+    ---------
+    labels : List[str]
+        The tags in index order, see :func:`allowed_transitions`.
+    pruned : bool, optional
+        Whether the search is pruned to the blocks, else the disallowed transitions are only
+        masked, which is faster for a few tags, e.g., BMES. Default = at least 32 tags.
+    """
+
+    def __init__(self, labels: List[str], pruned: Optional[bool] = None) -> None:
+        self.labels = list(labels)
+        self.num_tags = len(self.labels)
+        self.pruned = self.num_tags >= MIN_PRUNED_TAGS if pruned is None else pruned
+        self.allowed_start, self.allowed_end, self.allowed = allowed_transitions(self.labels)
+
+        # group the tags by their allowed predecessors
+        groups = {}
+        for tag in range(self.num_tags):
+            predecessors = tuple(self.allowed[:, tag].nonzero().squeeze(1).tolist())
+            if not predecessors:
+                raise ValueError(f'tag {self.labels[tag]} cannot follow any tag')
+            groups.setdefault(predecessors, []).append(tag)
+
+        # (predecessors, tags) of the groups of several tags
+        self.blocks = [(torch.tensor(predecessors), torch.tensor(tags))
+                       for predecessors, tags in groups.items() if len(tags) > 1]
+        # the tags alone in their group and their predecessors, padded by repeating the first one,
+        # which changes no maximum
+        # shape: (num_single_tags,), (num_single_tags, max_num_predecessors)
+        singles = [(predecessors, tags[0]) for predecessors, tags in groups.items() if len(tags) == 1]
+        max_num_predecessors = max([len(predecessors) for predecessors, _ in singles], default=1)
+        self.single_tags = torch.tensor([tag for _, tag in singles], dtype=torch.long)
+        self.single_predecessors = torch.tensor(
+            [list(predecessors) + [predecessors[0]] * (max_num_predecessors - len(predecessors))
+             for predecessors, _ in singles], dtype=torch.long).view(len(singles), max_num_predecessors)
+
+        # the tensors on each device, see tensors
+        self._device_tensors = {}
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}(num_tags={self.num_tags}, pruned={self.pruned}, ' \
+               f'blocks={[(len(predecessors), len(tags)) for predecessors, tags in self.blocks]}, ' \
+               f'single_tags={len(self.single_tags)})'
+
+    def tensors(self, device: torch.device, dtype: torch.dtype) -> Tuple[torch.Tensor, torch.Tensor, torch.BoolTensor,
+                                                                         list, torch.LongTensor, torch.LongTensor]:
+        # the start and end penalties, the allowed transitions, the blocks and the single tags, moved to device once
+        key = (device, dtype)
+        if key not in self._device_tensors:
+            start_penalty = torch.zeros(self.num_tags, dtype=dtype).masked_fill(~self.allowed_start, DISALLOWED_SCORE)
+            end_penalty = torch.zeros(self.num_tags, dtype=dtype).masked_fill(~self.allowed_end, DISALLOWED_SCORE)
+            self._device_tensors[key] = (start_penalty.to(device), end_penalty.to(device), self.allowed.to(device),
+                                         [(predecessors.to(device), tags.to(device))
+                                          for predecessors, tags in self.blocks],
+                                         self.single_tags.to(device), self.single_predecessors.to(device))
+
+        return self._device_tensors[key]
+
+
+def viterbi_decode(emissions: torch.FloatTensor,
+                   mask: torch.ByteTensor,
+                   start_transitions: torch.Tensor,
+                   end_transitions: torch.Tensor,
+                   transitions: torch.Tensor,
+                   seq_starts: Optional[torch.Tensor] = None,
+                   constraints: Optional[TransitionConstraints] = None) -> Tuple[torch.LongTensor, torch.LongTensor]:
+    """Find the most likely tag sequences of a batch using Viterbi algorithm.
+
+    Arguments
+    ---------
+    emissions : :class:`~torch.Tensor`
+        Emission score tensor of size ``(seq_length, batch_size, num_tags)``.
+    mask : :class:`~torch.ByteTensor`
+        Mask tensor of size ``(seq_length, batch_size)``.
+    start_transitions, end_transitions, transitions : :class:`~torch.Tensor`
+        Scores of size ``(num_tags,)``, ``(num_tags,)`` and ``(num_tags, num_tags)``, see :class:`CRF`.
+    seq_starts : :class:`~torch.Tensor`, optional
+        Where a new packed sequence starts, of size ``(seq_length, batch_size)``, see :meth:`CRF._sequence_starts`.
+    constraints : :class:`TransitionConstraints`, optional
+        Only decode the paths allowed by the label scheme.
+
+    Returns
+    -------
+    Tuple[:class:`~torch.LongTensor`, :class:`~torch.LongTensor`]
+        The best tags, of size ``(seq_length, batch_size)``, padded with 0, and the length of each sequence.
+    """
+    assert emissions.dim() == 3 and mask.dim() == 2
+    assert emissions.shape[:2] == mask.shape
+    assert mask[0].all()
+
+    seq_length, batch_size, num_tags = emissions.shape
+
+    pruned = constraints is not None and constraints.pruned
+    if constraints is not None:
+        start_penalty, end_penalty, allowed, blocks, single_tags, single_predecessors = \
+            constraints.tensors(emissions.device, emissions.dtype)
+        start_transitions = start_transitions + start_penalty
+        end_transitions = end_transitions + end_penalty
+        if pruned:
+            # Transition scores of each block, (num_predecessors, num_block_tags), and of the allowed
+            # predecessors of the single tags, (num_single_tags, max_num_predecessors)
+            block_transitions = [transitions.index_select(0, predecessors).index_select(1, tags)
+                                 for predecessors, tags in blocks]
+            single_transitions = transitions[single_predecessors, single_tags.unsqueeze(1)]
+        else:
+            transitions = transitions.masked_fill(~allowed, float('-inf'))
+
+    # Start transition and first emission
+    # shape: (batch_size, num_tags)
+    score = start_transitions + emissions[0]
+    # shape: (seq_length - 1, batch_size, num_tags)
+    history = torch.empty((seq_length - 1, batch_size, num_tags), dtype=torch.long, device=emissions.device)
+
+    # score is a tensor of size (batch_size, num_tags) where for every batch,
+    # value at column j stores the score of the best tag sequence so far that ends
+    # with tag j
+    # history saves where the best tags candidate transitioned from; this is used
+    # when we trace back the best tag sequence
+
+    # Viterbi algorithm recursive case: we compute the score of the best tag sequence
+    # for every possible next tag
+    for i in range(1, seq_length):
+        if not pruned:
+            # Broadcast viterbi score for every possible next tag
+            # shape: (batch_size, num_tags, 1)
+            broadcast_score = score.unsqueeze(2)
+
+            # Broadcast emission score for every possible current tag
+            # shape: (batch_size, 1, num_tags)
+            broadcast_emission = emissions[i].unsqueeze(1)
+
+            # Compute the score tensor of size (batch_size, num_tags, num_tags) where
+            # for each sample, entry at row i and column j stores the score of the best
+            # tag sequence so far that ends with transitioning from tag i to tag j and emitting
+            # shape: (batch_size, num_tags, num_tags)
+            next_score = broadcast_score + transitions + broadcast_emission
+
+            # Find the maximum score over all possible current tag
+            # shape: (batch_size, num_tags)
+            next_score, indices = next_score.max(dim=1)
+        else:
+            # Only the allowed predecessors of each next tag
+            # shape: (batch_size, num_tags)
+            next_score = torch.empty_like(score)
+            indices = torch.empty((batch_size, num_tags), dtype=torch.long, device=emissions.device)
+
+            for (predecessors, tags), block_transition in zip(blocks, block_transitions):
+                # The tags of a block share their predecessors: entry at row p and column j stores the
+                # score of the best tag sequence so far that ends with transitioning from the p-th
+                # predecessor to the j-th tag of the block
+                # shape: (batch_size, num_predecessors, num_block_tags)
+                block_score = score.index_select(1, predecessors).unsqueeze(2) + block_transition
+                # shape: (batch_size, num_block_tags)
+                block_score, block_indices = block_score.max(dim=1)
+                next_score.index_copy_(1, tags, block_score)
+                indices.index_copy_(1, tags, predecessors[block_indices])
+
+            if single_tags.numel() > 0:
+                # shape: (batch_size, num_single_tags, max_num_predecessors)
+                single_score = score.index_select(1, single_predecessors.view(-1)).view(
+                    batch_size, single_tags.size(0), -1) + single_transitions
+                # shape: (batch_size, num_single_tags)
+                single_score, single_indices = single_score.max(dim=2)
+                next_score.index_copy_(1, single_tags, single_score)
+                indices.index_copy_(1, single_tags, single_predecessors.gather(1, single_indices.t()).t())
+
+            # Emit at the next tags
+            # shape: (batch_size, num_tags)
+            next_score += emissions[i]
+
+        if seq_starts is not None:
+            # Close the packed sequence ending at i - 1 at its best end tag and start a new one at i
+            # shape: (batch_size, 1)
+            restart_score, restart_indices = (score + end_transitions).max(dim=1, keepdim=True)
+            restart = seq_starts[i].unsqueeze(1)
+            next_score = torch.where(restart, restart_score + start_transitions + emissions[i], next_score)
+            indices = torch.where(restart, restart_indices.expand_as(indices), indices)
+
+        # Set score to the next score if this timestep is valid (mask == 1)
+        # and save the index that produces the next score
+        # shape: (batch_size, num_tags)
+        score = torch.where(mask[i].unsqueeze(1).bool(), next_score, score)
+        history[i - 1] = indices
+
+    # End transition score
+    # shape: (batch_size, num_tags)
+    score = score + end_transitions
+
+    # Now, trace back the best paths of the whole batch at once
+
+    # shape: (batch_size,)
+    lengths = mask.long().sum(dim=0)
+    seq_ends = lengths - 1
+    # The tag which maximizes the score at the last valid timestep of each sample
+    # shape: (batch_size,)
+    _, best_last_tags = score.max(dim=1)
+
+    # shape: (seq_length, batch_size)
+    best_tags = torch.empty((seq_length, batch_size), dtype=torch.long, device=emissions.device)
+    best_tag = best_last_tags
+    for i in range(seq_length - 1, -1, -1):
+        # A sample starts its trace back at its last valid timestep; the tags after it are padding
+        best_tag = torch.where(seq_ends <= i, best_last_tags, best_tag)
+        best_tags[i] = best_tag
+        if i > 0:
+            # Where the best tag at timestep i comes from
+            # shape: (batch_size,)
+            best_tag = history[i - 1].gather(1, best_tag.unsqueeze(1)).squeeze(1)
+
+    best_tags = best_tags * mask.long()
+    return best_tags, lengths
+
+
+def constrained_argmax(logits: torch.Tensor, mask: torch.ByteTensor,
+                       constraints: TransitionConstraints) -> List[List[int]]:
+    """Decode the tags of a Softmax classifier, the path of the highest probability allowed by constraints.
+
+    Arguments
+    ---------
+    logits : :class:`~torch.Tensor`
+        Score tensor of size ``(batch_size, seq_length, num_tags)``.
+    mask : :class:`~torch.ByteTensor`
+        Mask tensor of size ``(batch_size, seq_length)``.
+    constraints : :class:`TransitionConstraints`
+        The allowed tags of the label scheme.
+
+    Returns
+    -------
+    List[List[int]]
+        The tags of each sequence, the same as the argmax where the argmax is a valid path.
+    """
+    if logits.size(2) != constraints.num_tags:
+        raise ValueError(f'expected last dimension of logits is {constraints.num_tags}, got {logits.size(2)}')
+
+    # The sum of the log probabilities of the tags, with no transition score
+    # shape: (seq_length, batch_size, num_tags)
+    emissions = F.log_softmax(logits, dim=2).transpose(0, 1)
+    zeros = emissions.new_zeros(constraints.num_tags)
+    best_tags, lengths = viterbi_decode(emissions, mask.transpose(0, 1), zeros, zeros,
+                                        emissions.new_zeros(constraints.num_tags, constraints.num_tags),
+                                        constraints=constraints)
+
+    best_tags = best_tags.transpose(0, 1).tolist()
+    return [tags[:length] for tags, length in zip(best_tags, lengths.tolist())]
+
+
+def constrained_marginals(logits: torch.Tensor, mask: torch.ByteTensor,
+                          constraints: TransitionConstraints) -> torch.Tensor:
+    """Marginal probability of each tag of a Softmax classifier, over the paths allowed by constraints.
+
+    Arguments are the same as :func:`constrained_argmax`.
+
+    Returns
+    -------
+    :class:`~torch.Tensor`
+        The probabilities, of the size of ``logits``, 0 at the invalid timesteps.
+    """
+    if logits.size(2) != constraints.num_tags:
+        raise ValueError(f'expected last dimension of logits is {constraints.num_tags}, got {logits.size(2)}')
+
+    # shape: (seq_length, batch_size, num_tags)
+    emissions = F.log_softmax(logits, dim=2).transpose(0, 1)
+    zeros = emissions.new_zeros(constraints.num_tags)
+    marginals = token_marginals(emissions, mask.transpose(0, 1), zeros, zeros,
+                                emissions.new_zeros(constraints.num_tags, constraints.num_tags),
+                                constraints=constraints)
+    return marginals.transpose(0, 1)
+
+
+def masked_scores(start_transitions: torch.Tensor, end_transitions: torch.Tensor, transitions: torch.Tensor,
+                  constraints: Optional[TransitionConstraints] = None) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    # the start, end and transition scores with the disallowed tags of constraints penalized and the disallowed
+    # transitions masked, as used by the dense searches
+    if constraints is None:
+        return start_transitions, end_transitions, transitions
+
+    start_penalty, end_penalty, allowed = constraints.tensors(transitions.device, transitions.dtype)[:3]
+    return start_transitions + start_penalty, end_transitions + end_penalty, \
+        transitions.masked_fill(~allowed, float('-inf'))
+
+
+def forward_scores(emissions: torch.Tensor, mask: torch.ByteTensor,
+                   start_transitions: torch.Tensor, end_transitions: torch.Tensor, transitions: torch.Tensor,
+                   seq_starts: Optional[torch.Tensor] = None) -> torch.Tensor:
+    """Forward scores of the forward algorithm, the log of the summed scores of the tag sequences so far.
+
+    Arguments are the same as :func:`viterbi_decode`.
+
+    Returns
+    -------
+    :class:`~torch.Tensor`
+        The score of the tag sequences ending with tag j at timestep i, of size
+        ``(seq_length, batch_size, num_tags)``; the invalid timesteps keep the previous scores.
+    """
+    mask = mask.bool()
+
+    # Start transition and first emission
+    # shape: (batch_size, num_tags)
+    scores = [start_transitions + emissions[0]]
+    for i in range(1, emissions.size(0)):
+        score = scores[-1]
+        # Sum (log-sum-exp) over the current tags
+        # shape: (batch_size, num_tags)
+        next_score = torch.logsumexp(score.unsqueeze(2) + transitions + emissions[i].unsqueeze(1), dim=1)
+
+        if seq_starts is not None:
+            # Close the packed sequence ending at i - 1 and start a new one at i
+            restart_score = torch.logsumexp(score + end_transitions, dim=1, keepdim=True) \
+                            + start_transitions + emissions[i]
+            next_score = torch.where(seq_starts[i].unsqueeze(1), restart_score, next_score)
+
+        scores.append(torch.where(mask[i].unsqueeze(1), next_score, score))
+
+    return torch.stack(scores)
+
+
+def token_marginals(emissions: torch.Tensor, mask: torch.ByteTensor,
+                    start_transitions: torch.Tensor, end_transitions: torch.Tensor, transitions: torch.Tensor,
+                    seq_starts: Optional[torch.Tensor] = None,
+                    constraints: Optional[TransitionConstraints] = None) -> torch.Tensor:
+    """Marginal probability of each tag at each timestep, by the forward-backward algorithm over the whole batch.
+
+    Arguments are the same as :func:`viterbi_decode`.
+
+    Returns
+    -------
+    :class:`~torch.Tensor`
+        Probability of tag j at timestep i, of size ``(seq_length, batch_size, num_tags)``,
+        0 at the invalid timesteps.
+    """
+    assert emissions.dim() == 3 and mask.dim() == 2
+    assert emissions.shape[:2] == mask.shape
+    assert mask[0].all()
+
+    start_transitions, end_transitions, transitions = masked_scores(start_transitions, end_transitions,
+                                                                    transitions, constraints)
+    mask = mask.bool()
+    # shape: (seq_length, batch_size, num_tags)
+    alphas = forward_scores(emissions, mask, start_transitions, end_transitions, transitions, seq_starts)
+
+    # Backward scores: the log of the summed scores of the tag sequences after timestep i, given tag j
+    # at i; the end transition at the last valid timestep
+    # shape: (batch_size, num_tags)
+    end_score = end_transitions.expand_as(alphas[0])
+    betas = [end_score]
+    for i in range(emissions.size(0) - 2, -1, -1):
+        # shape: (batch_size, num_tags)
+        next_score = betas[-1] + emissions[i + 1]
+        # Sum (log-sum-exp) over the next tags
+        # shape: (batch_size, num_tags)
+        score = torch.logsumexp(transitions + next_score.unsqueeze(1), dim=2)
+
+        if seq_starts is not None:
+            # The packed sequence ends at i and the next one starts at i + 1
+            restart_score = end_transitions + torch.logsumexp(start_transitions + next_score, dim=1, keepdim=True)
+            score = torch.where(seq_starts[i + 1].unsqueeze(1), restart_score, score)
+
+        betas.append(torch.where(mask[i + 1].unsqueeze(1), score, end_score))
+    betas.reverse()
+
+    # Normalize the scores of the tag sequences through each tag, at each timestep
+    # shape: (seq_length, batch_size, num_tags)
+    marginals = torch.softmax(alphas + torch.stack(betas), dim=2)
+    return marginals * mask.unsqueeze(2).to(marginals.dtype)
+
+
+def viterbi_nbest(emissions: torch.Tensor, mask: torch.ByteTensor,
+                  start_transitions: torch.Tensor, end_transitions: torch.Tensor, transitions: torch.Tensor,
+                  nbest: int,
+                  constraints: Optional[TransitionConstraints] = None) -> Tuple[torch.LongTensor, torch.Tensor]:
+    """Find the nbest most likely tag sequences of a batch, by keeping the nbest best scores of each tag.
+
+    Arguments are the same as :func:`viterbi_decode`, without packed sequences.
+
+    Returns
+    -------
+    Tuple[:class:`~torch.LongTensor`, :class:`~torch.Tensor`]
+        The tags, of size ``(seq_length, batch_size, nbest)``, padded with 0, and their scores,
+        of size ``(batch_size, nbest)``, best first; -inf if a sequence has less than nbest paths.
+    """
+    assert emissions.dim() == 3 and mask.dim() == 2
+    assert emissions.shape[:2] == mask.shape
+    assert mask[0].all()
+    if nbest < 1:
+        raise ValueError(f'invalid nbest: {nbest}')
+
+    start_transitions, end_transitions, transitions = masked_scores(start_transitions, end_transitions,
+                                                                    transitions, constraints)
+    seq_length, batch_size, num_tags = emissions.shape
+    mask = mask.bool()
+
+    # score[b, j, r] is the score of the r-th best tag sequence so far ending with tag j
+    # shape: (batch_size, num_tags, nbest)
+    score = emissions.new_full((batch_size, num_tags, nbest), float('-inf'))
+    score[:, :, 0] = start_transitions + emissions[0]
+    # history saves the flat index, previous tag * nbest + previous rank, of each sequence
+    # shape: (seq_length - 1, batch_size, num_tags, nbest)
+    history = torch.empty((seq_length - 1, batch_size, num_tags, nbest), dtype=torch.long, device=emissions.device)
+    # At the invalid timesteps every sequence comes from itself
+    # shape: (num_tags, nbest)
+    keep_indices = torch.arange(num_tags * nbest, device=emissions.device).view(num_tags, nbest)
+
+    num_previous = min(nbest, num_tags)
+    for i in range(1, seq_length):
+        # Score of extending the best sequence ending with tag k by tag j and emitting
+        # shape: (batch_size, num_tags (j), num_tags (k))
+        head_score = score[:, :, 0].unsqueeze(1) + transitions.t() + emissions[i].unsqueeze(2)
+        # The scores of each tag are sorted, so the nbest next sequences can only extend the tags of
+        # the nbest best extensions
+        # shape: (batch_size, num_tags (j), num_previous (k))
+        head_score, previous_tags = head_score.topk(num_previous, dim=2)
+
+        # Score of extending the r-th sequence ending with each of these tags k by tag j and emitting
+        # shape: (batch_size, num_tags (j), num_previous (k) * nbest (r))
+        previous_score = score.gather(1, previous_tags.view(batch_size, -1, 1).expand(-1, -1, nbest))
+        next_score = previous_score.view(batch_size, num_tags, num_previous, nbest) \
+            + transitions.t().expand(batch_size, -1, -1).gather(2, previous_tags).unsqueeze(3) \
+            + emissions[i].view(batch_size, num_tags, 1, 1)
+
+        # shape: (batch_size, num_tags, nbest)
+        next_score, indices = next_score.view(batch_size, num_tags, -1).topk(nbest, dim=2)
+        indices = previous_tags.gather(2, indices // nbest) * nbest + indices % nbest
+        valid = mask[i].view(batch_size, 1, 1)
+        score = torch.where(valid, next_score, score)
+        history[i - 1] = torch.where(valid, indices, keep_indices)
+
+    # End transition score, then the nbest sequences of all the tags
+    # shape: (batch_size, nbest)
+    best_scores, best_indices = (score + end_transitions.unsqueeze(1)).reshape(batch_size, -1).topk(nbest, dim=1)
+
+    # Trace back the nbest paths of the whole batch at once
+    # shape: (seq_length, batch_size, nbest)
+    best_tags = torch.empty((seq_length, batch_size, nbest), dtype=torch.long, device=emissions.device)
+    for i in range(seq_length - 1, -1, -1):
+        best_tags[i] = best_indices // nbest
+        if i > 0:
+            best_indices = history[i - 1].reshape(batch_size, -1).gather(1, best_indices)
+
+    best_tags = best_tags * mask.unsqueeze(2).long()
+    return best_tags, best_scores
+
+
+class CRFNormalizer(torch.autograd.Function):
+    """Log partition function of a CRF, whose gradient is computed by the forward-backward algorithm.
+
+    The forward pass runs without any autograd graph and only keeps the forward scores, of size
+    ``(seq_length, batch_size, num_tags)``. The backward pass computes the backward scores one
+    timestep at a time, and the gradients from the marginals: of the emissions, the token marginals;
+    of the transitions, the sum of the pairwise marginals; of the start and end transitions, the
+    marginals of the first and last tags. The memory of the loss is then O(seq_length * num_tags)
+    per sequence instead of O(seq_length * num_tags^2) for the graph of :meth:`CRF._compute_normalizer`.
+
+    CRFNormalizer.apply(emissions, mask, seq_starts, start_transitions, end_transitions, transitions)
+    returns the log partition function of each sequence, of size ``(batch_size,)``, with
+    the arguments of :func:`viterbi_decode`.
+    """
+
+    @staticmethod
+    def forward(ctx, emissions: torch.Tensor, mask: torch.ByteTensor, seq_starts: Optional[torch.Tensor],
+                start_transitions: torch.Tensor, end_transitions: torch.Tensor,
+                transitions: torch.Tensor) -> torch.Tensor:
+        # shape: (seq_length, batch_size, num_tags)
+        alphas = forward_scores(emissions, mask, start_transitions, end_transitions, transitions, seq_starts)
+        # The forward scores of the invalid timesteps are the ones of the last valid timestep
+        # shape: (batch_size,)
+        log_z = torch.logsumexp(alphas[-1] + end_transitions, dim=1)
+
+        ctx.save_for_backward(emissions, mask, seq_starts, start_transitions, end_transitions, transitions,
+                              alphas, log_z)
+        return log_z
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, grad_log_z: torch.Tensor):
+        emissions, mask, seq_starts, start_transitions, end_transitions, transitions, alphas, log_z = \
+            ctx.saved_tensors
+        seq_length, batch_size, num_tags = emissions.shape
+        mask = mask.bool()
+        # shape: (batch_size, 1)
+        grad_log_z = grad_log_z.unsqueeze(1)
+        log_z = log_z.unsqueeze(1)
+
+        grad_emissions = torch.zeros_like(emissions)
+        grad_transitions = torch.zeros_like(transitions)
+        # Marginals of the last tag of each sequence
+        # shape: (num_tags,)
+        grad_start_transitions = torch.zeros_like(start_transitions)
+        grad_end_transitions = ((alphas[-1] + end_transitions - log_z).exp() * grad_log_z).sum(dim=0)
+
+        # Backward scores at the last valid timestep, then from the ones of the next timestep
+        # shape: (batch_size, num_tags)
+        end_score = end_transitions.expand(batch_size, num_tags)
+        beta = end_score
+        for i in range(seq_length - 1, -1, -1):
+            if i < seq_length - 1:
+                # shape: (batch_size, num_tags)
+                next_score = beta + emissions[i + 1]
+                # Transition from i to i + 1 within a sequence
+                # shape: (batch_size, 1, 1)
+                transition_steps = mask[i + 1]
+                if seq_starts is not None:
+                    transition_steps = transition_steps & ~seq_starts[i + 1]
+                transition_steps = transition_steps.view(batch_size, 1, 1)
+
+                # Pairwise marginals of tag j at i and tag k at i + 1
+                # shape: (batch_size, num_tags, num_tags)
+                pair_score = alphas[i].unsqueeze(2) + transitions + next_score.unsqueeze(1)
+                pair_marginals = (pair_score - log_z.unsqueeze(2)).masked_fill(~transition_steps, float('-inf')).exp()
+                grad_transitions += (pair_marginals * grad_log_z.unsqueeze(2)).sum(dim=0)
+
+                # shape: (batch_size, num_tags)
+                score = torch.logsumexp(transitions + next_score.unsqueeze(1), dim=2)
+                if seq_starts is not None:
+                    # The packed sequence ends at i and the next one starts at i + 1
+                    restart = seq_starts[i + 1].unsqueeze(1)
+                    # shape: (batch_size, 1)
+                    next_start_score = torch.logsumexp(start_transitions + next_score, dim=1, keepdim=True)
+                    previous_end_score = torch.logsumexp(alphas[i] + end_transitions, dim=1, keepdim=True)
+                    weights = grad_log_z * restart.to(grad_log_z.dtype)
+                    grad_end_transitions += ((alphas[i] + end_transitions + next_start_score - log_z).exp()
+                                             * weights).sum(dim=0)
+                    grad_start_transitions += ((previous_end_score + start_transitions + next_score - log_z).exp()
+                                               * weights).sum(dim=0)
+                    score = torch.where(restart, end_transitions + next_start_score, score)
+
+                beta = torch.where(mask[i + 1].unsqueeze(1), score, end_score)
+
+            # Marginals of the tags at i
+            # shape: (batch_size, num_tags)
+            marginals = (alphas[i] + beta - log_z).exp() * mask[i].unsqueeze(1).to(emissions.dtype)
+            grad_emissions[i] = marginals * grad_log_z
+
+        # Marginals of the first tag of each sequence
+        grad_start_transitions += grad_emissions[0].sum(dim=0)
+
+        return grad_emissions, None, None, grad_start_transitions, grad_end_transitions, grad_transitions
 
 
 class CRF(nn.Module):
@@ -18,6 +627,20 @@ class CRF(nn.Module):
         Number of tags.
     batch_first : bool, optional
         Whether the first dimension corresponds to the size of a minibatch.
+    parallel_scan : bool, optional
+        Whether ``forward`` computes the partition function by a tree of log-semiring
+        matrix products, O(log seq_length) sequential steps, instead of one step per timestep.
+    memory_efficient : bool, optional
+        Whether ``forward`` computes the partition function by :class:`CRFNormalizer`, whose
+        backward pass recomputes what it needs from the forward scores instead of keeping the
+        graph of every timestep. The gradients are the same. It has precedence over ``parallel_scan``.
+
+    Several sequences can be packed into one row of the batch by passing ``pack_ids`` to
+    ``forward`` and ``decode``: each packed sequence then gets its own start and end
+    transitions and no transition is scored between two consecutive sequences.
+
+    Setting ``constraints`` to a :class:`TransitionConstraints` restricts ``decode`` to the
+    paths allowed by the label scheme, e.g., no B->B of BMES; the log likelihood is unchanged.
 
     Attributes
     ----------
@@ -27,6 +650,8 @@ class CRF(nn.Module):
         End transition score tensor of size ``(num_tags,)``.
     transitions : :class:`~torch.nn.Parameter`
         Transition score tensor of size ``(num_tags, num_tags)``.
+    constraints : :class:`TransitionConstraints`, optional
+        The allowed tags of the decoding, not saved in the state dict. Default = None.
 
     References
     ----------
@@ -38,15 +663,19 @@ class CRF(nn.Module):
     .. _Viterbi algorithm: https://en.wikipedia.org/wiki/Viterbi_algorithm
     """
 
-    def __init__(self, num_tags: int, batch_first: bool = False) -> None:
+    def __init__(self, num_tags: int, batch_first: bool = False, parallel_scan: bool = False,
+                 memory_efficient: bool = False) -> None:
         if num_tags <= 0:
             raise ValueError(f'invalid number of tags: {num_tags}')
         super().__init__()
         self.num_tags = num_tags
         self.batch_first = batch_first
+        self.parallel_scan = parallel_scan
+        self.memory_efficient = memory_efficient
         self.start_transitions = nn.Parameter(torch.empty(num_tags))
         self.end_transitions = nn.Parameter(torch.empty(num_tags))
         self.transitions = nn.Parameter(torch.empty(num_tags, num_tags))
+        self.constraints = None
 
         self.reset_parameters()
 
@@ -69,6 +698,7 @@ class CRF(nn.Module):
             tags: torch.LongTensor,
             mask: Optional[torch.ByteTensor] = None,
             reduction: str = 'sum',
+            pack_ids: Optional[torch.LongTensor] = None,
     ) -> torch.Tensor:
         """Compute the conditional log likelihood of a sequence of tags given emission scores.
 
@@ -88,6 +718,10 @@ class CRF(nn.Module):
             'none': no reduction will be applied. 'sum': the output will be summed over batches.
             'mean': the output will be averaged over batches. 'token_mean': the output will be
             averaged over tokens.
+        pack_ids : :class:`~torch.LongTensor`, optional
+            Index of the packed sequence of each timestep, of the size of ``mask``. A new
+            sequence starts wherever it changes. The log likelihood is then the sum over the
+            packed sequences of each row.
 
         Returns
         -------
@@ -105,11 +739,21 @@ class CRF(nn.Module):
             emissions = emissions.transpose(0, 1)
             tags = tags.transpose(0, 1)
             mask = mask.transpose(0, 1)
+            if pack_ids is not None:
+                pack_ids = pack_ids.transpose(0, 1)
 
+        # shape: (seq_length, batch_size)
+        seq_starts = self._sequence_starts(pack_ids, mask)
         # shape: (batch_size,)
-        numerator = self._compute_score(emissions, tags, mask)
+        numerator = self._compute_score(emissions, tags, mask, seq_starts)
         # shape: (batch_size,)
-        denominator = self._compute_normalizer(emissions, mask)
+        if getattr(self, 'memory_efficient', False):
+            denominator = CRFNormalizer.apply(emissions, mask, seq_starts, self.start_transitions,
+                                              self.end_transitions, self.transitions)
+        elif self.parallel_scan:
+            denominator = self._compute_normalizer_scan(emissions, mask, seq_starts)
+        else:
+            denominator = self._compute_normalizer(emissions, mask, seq_starts)
         # shape: (batch_size,)
         llh = numerator - denominator
 
@@ -123,7 +767,8 @@ class CRF(nn.Module):
         return llh.sum() / mask.float().sum()
 
     def decode(self, emissions: torch.Tensor,
-               mask: Optional[torch.ByteTensor] = None) -> List[List[int]]:
+               mask: Optional[torch.ByteTensor] = None,
+               pack_ids: Optional[torch.LongTensor] = None) -> List[List[int]]:
         """Find the most likely tag sequence using Viterbi algorithm.
 
         Arguments
@@ -134,11 +779,101 @@ class CRF(nn.Module):
         mask : :class:`~torch.ByteTensor`, optional
             Mask tensor of size ``(seq_length, batch_size)`` if ``batch_first`` is ``False``,
             ``(batch_size, seq_length)`` otherwise.
+        pack_ids : :class:`~torch.LongTensor`, optional
+            Index of the packed sequence of each timestep, of the size of ``mask``.
 
         Returns
         -------
         List[List[int]]
-            List of list containing the best tag sequence for each batch.
+            List of list containing the best tag sequence for each batch. The tags of the
+            sequences packed in a row are concatenated.
+        """
+        best_tags, lengths = self.decode_padded(emissions, mask, pack_ids)
+        if not self.batch_first:
+            best_tags = best_tags.transpose(0, 1)
+
+        # a single copy to the host for the whole batch
+        # shape: (batch_size, seq_length)
+        best_tags = best_tags.tolist()
+        return [tags[:length] for tags, length in zip(best_tags, lengths.tolist())]
+
+    def decode_padded(self, emissions: torch.Tensor,
+                      mask: Optional[torch.ByteTensor] = None,
+                      pack_ids: Optional[torch.LongTensor] = None) -> Tuple[torch.LongTensor, torch.LongTensor]:
+        """Find the most likely tag sequence using Viterbi algorithm, without leaving the device.
+
+        Arguments are the same as :meth:`decode`.
+
+        Returns
+        -------
+        Tuple[:class:`~torch.LongTensor`, :class:`~torch.LongTensor`]
+            The best tags, of the size of ``mask``, padded with 0 after the end of each
+            sequence, and the length of each sequence, of size ``(batch_size,)``.
+        """
+        self._validate(emissions, mask=mask)
+        if mask is None:
+            mask = emissions.new_ones(emissions.shape[:2], dtype=torch.uint8)
+
+        if self.batch_first:
+            emissions = emissions.transpose(0, 1)
+            mask = mask.transpose(0, 1)
+            if pack_ids is not None:
+                pack_ids = pack_ids.transpose(0, 1)
+
+        best_tags, lengths = self._viterbi_decode(emissions, mask, self._sequence_starts(pack_ids, mask))
+        if self.batch_first:
+            best_tags = best_tags.transpose(0, 1)
+
+        return best_tags, lengths
+
+    def compute_marginals(self, emissions: torch.Tensor,
+                          mask: Optional[torch.ByteTensor] = None,
+                          pack_ids: Optional[torch.LongTensor] = None) -> torch.Tensor:
+        """Compute the marginal probability of each tag at each timestep by the forward-backward algorithm.
+
+        Arguments are the same as :meth:`decode`.
+
+        Returns
+        -------
+        :class:`~torch.Tensor`
+            The probabilities, of the size of ``emissions``, 0 after the end of each sequence;
+            under ``constraints``, if any.
+        """
+        self._validate(emissions, mask=mask)
+        if mask is None:
+            mask = emissions.new_ones(emissions.shape[:2], dtype=torch.uint8)
+
+        if self.batch_first:
+            emissions = emissions.transpose(0, 1)
+            mask = mask.transpose(0, 1)
+            if pack_ids is not None:
+                pack_ids = pack_ids.transpose(0, 1)
+
+        marginals = token_marginals(emissions, mask, self.start_transitions, self.end_transitions, self.transitions,
+                                    self._sequence_starts(pack_ids, mask), getattr(self, 'constraints', None))
+        if self.batch_first:
+            marginals = marginals.transpose(0, 1)
+
+        return marginals
+
+    def decode_nbest(self, emissions: torch.Tensor,
+                     mask: Optional[torch.ByteTensor] = None,
+                     nbest: int = 5) -> Tuple[List[List[List[int]]], torch.Tensor]:
+        """Find the nbest most likely tag sequences using the k-best Viterbi algorithm.
+
+        Arguments
+        ---------
+        emissions, mask :
+            The same as :meth:`decode`; the sequences cannot be packed.
+        nbest : int, optional
+            Number of tag sequences of each batch.
+
+        Returns
+        -------
+        Tuple[List[List[List[int]]], :class:`~torch.Tensor`]
+            The tag sequences of each batch, best first, the first one is the one of :meth:`decode`,
+            and their log probabilities, of size ``(batch_size, nbest)``. A sequence with less than
+            nbest possible paths has less tag sequences, and -inf log probabilities after them.
         """
         self._validate(emissions, mask=mask)
         if mask is None:
@@ -148,7 +883,38 @@ class CRF(nn.Module):
             emissions = emissions.transpose(0, 1)
             mask = mask.transpose(0, 1)
 
-        return self._viterbi_decode(emissions, mask)
+        constraints = getattr(self, 'constraints', None)
+        best_tags, best_scores = viterbi_nbest(emissions, mask, self.start_transitions, self.end_transitions,
+                                               self.transitions, nbest, constraints)
+
+        # Log partition function of the same scores
+        # shape: (batch_size,)
+        start_transitions, end_transitions, transitions = masked_scores(self.start_transitions, self.end_transitions,
+                                                                        self.transitions, constraints)
+        alphas = forward_scores(emissions, mask, start_transitions, end_transitions, transitions)
+        log_probs = best_scores - torch.logsumexp(alphas[-1] + end_transitions, dim=1, keepdim=True)
+
+        # a single copy to the host for the whole batch
+        # shape: (batch_size, nbest, seq_length)
+        best_tags = best_tags.permute(1, 2, 0).tolist()
+        lengths = mask.long().sum(dim=0).tolist()
+        num_paths = torch.isfinite(log_probs).long().sum(dim=1).tolist()
+        return [[tags[:length] for tags in paths[:n]] for paths, length, n in zip(best_tags, lengths, num_paths)], \
+            log_probs
+
+    @staticmethod
+    def _sequence_starts(
+            pack_ids: Optional[torch.LongTensor],
+            mask: torch.ByteTensor) -> Optional[torch.Tensor]:
+        # pack_ids, mask: (seq_length, batch_size)
+        # the valid timesteps after the first one where a new packed sequence starts
+        if pack_ids is None:
+            return None
+
+        seq_starts = torch.zeros_like(mask, dtype=torch.bool)
+        seq_starts[1:] = pack_ids[1:].ne(pack_ids[:-1]) & mask[1:].bool()
+
+        return seq_starts
 
     def _validate(
             self,
@@ -180,7 +946,8 @@ class CRF(nn.Module):
 
     def _compute_score(
             self, emissions: torch.Tensor, tags: torch.LongTensor,
-            mask: torch.ByteTensor) -> torch.Tensor:
+            mask: torch.ByteTensor,
+            seq_starts: Optional[torch.Tensor] = None) -> torch.Tensor:
         # emissions: (seq_length, batch_size, num_tags)
         # tags: (seq_length, batch_size)
         # mask: (seq_length, batch_size)
@@ -193,19 +960,21 @@ class CRF(nn.Module):
         seq_length, batch_size = tags.shape
         mask = mask.float()
 
-        # Start transition score and first emission
+        # Emission score of every tag, gathered at once; the first timestep is always valid
         # shape: (batch_size,)
         score = self.start_transitions[tags[0]]
-        score += emissions[0, torch.arange(batch_size), tags[0]]
-
-        for i in range(1, seq_length):
-            # Transition score to next tag, only added if next timestep is valid (mask == 1)
-            # shape: (batch_size,)
-            score += self.transitions[tags[i - 1], tags[i]] * mask[i]
+        score += (emissions.gather(2, tags.unsqueeze(2)).squeeze(2) * mask).sum(dim=0)
 
-            # Emission score for next tag, only added if next timestep is valid (mask == 1)
-            # shape: (batch_size,)
-            score += emissions[i, torch.arange(batch_size), tags[i]] * mask[i]
+        # Transition score of every pair of consecutive tags, only added if the second
+        # timestep is valid (mask == 1)
+        # shape: (seq_length - 1, batch_size)
+        transitions = self.transitions[tags[:-1], tags[1:]]
+        if seq_starts is not None:
+            # a packed sequence ends at i - 1 and the next one starts at i
+            transitions = torch.where(seq_starts[1:],
+                                      self.end_transitions[tags[:-1]] + self.start_transitions[tags[1:]],
+                                      transitions)
+        score += (transitions * mask[1:]).sum(dim=0)
 
         # End transition score
         # shape: (batch_size,)
@@ -218,7 +987,8 @@ class CRF(nn.Module):
         return score
 
     def _compute_normalizer(
-            self, emissions: torch.Tensor, mask: torch.ByteTensor) -> torch.Tensor:
+            self, emissions: torch.Tensor, mask: torch.ByteTensor,
+            seq_starts: Optional[torch.Tensor] = None) -> torch.Tensor:
         # emissions: (seq_length, batch_size, num_tags)
         # mask: (seq_length, batch_size)
         assert emissions.dim() == 3 and mask.dim() == 2
@@ -256,6 +1026,13 @@ class CRF(nn.Module):
             # shape: (batch_size, num_tags)
             next_score = torch.logsumexp(next_score, dim=1)
 
+            if seq_starts is not None:
+                # Close the packed sequence ending at i - 1 and start a new one at i
+                # shape: (batch_size, num_tags)
+                restart_score = torch.logsumexp(score + self.end_transitions, dim=1, keepdim=True) \
+                                + self.start_transitions + emissions[i]
+                next_score = torch.where(seq_starts[i].unsqueeze(1), restart_score, next_score)
+
             # Set score to the next score if this timestep is valid (mask == 1)
             # shape: (batch_size, num_tags)
             score = torch.where(mask[i].unsqueeze(1), next_score, score)
@@ -268,79 +1045,69 @@ class CRF(nn.Module):
         # shape: (batch_size,)
         return torch.logsumexp(score, dim=1)
 
-    def _viterbi_decode(self, emissions: torch.FloatTensor,
-                        mask: torch.ByteTensor) -> List[List[int]]:
+    @staticmethod
+    def _log_matmul(a: torch.Tensor, b: torch.Tensor) -> torch.Tensor:
+        # matrix product in the log semiring, logsumexp_k(a[..., i, k] + b[..., k, j]), through an exp/matmul
+        # shifted by the maxima of the rows of a and of the columns of b; the sums below the smallest float,
+        # e.g., of the impossible transitions, are clamped to it to keep the gradients finite
+        a_max = a.max(dim=-1, keepdim=True)[0]
+        b_max = b.max(dim=-2, keepdim=True)[0]
+        product = torch.matmul(torch.exp(a - a_max), torch.exp(b - b_max))
+        return torch.log(product.clamp(min=torch.finfo(product.dtype).tiny)) + a_max + b_max
+
+    def _compute_normalizer_scan(
+            self, emissions: torch.Tensor, mask: torch.ByteTensor,
+            seq_starts: Optional[torch.Tensor] = None) -> torch.Tensor:
         # emissions: (seq_length, batch_size, num_tags)
         # mask: (seq_length, batch_size)
+        # same as _compute_normalizer, the product of the transition matrices of the timesteps is reduced
+        # pairwise, so the number of sequential steps is log2(seq_length)
         assert emissions.dim() == 3 and mask.dim() == 2
         assert emissions.shape[:2] == mask.shape
         assert emissions.size(2) == self.num_tags
         assert mask[0].all()
 
-        seq_length, batch_size = mask.shape
+        # Score of moving from tag j at timestep i - 1 to tag k at timestep i and emitting
+        # shape: (seq_length - 1, batch_size, num_tags, num_tags)
+        matrices = self.transitions + emissions[1:].unsqueeze(2)
+        if seq_starts is not None:
+            # Close the packed sequence ending at i - 1 and start a new one at i
+            restart = self.end_transitions.unsqueeze(1) + self.start_transitions + emissions[1:].unsqueeze(2)
+            matrices = torch.where(seq_starts[1:, :, None, None], restart, matrices)
 
-        # Start transition and first emission
-        # shape: (batch_size, num_tags)
-        score = self.start_transitions + emissions[0]
-        history = []
+        # The invalid timesteps (mask == 0) keep the score, the identity of the log semiring
+        # shape: (num_tags, num_tags)
+        identity = torch.full((self.num_tags, self.num_tags), float('-inf'), device=emissions.device,
+                              dtype=emissions.dtype)
+        identity.fill_diagonal_(0.)
+        matrices = torch.where(mask[1:, :, None, None].bool(), matrices, identity)
 
-        # score is a tensor of size (batch_size, num_tags) where for every batch,
-        # value at column j stores the score of the best tag sequence so far that ends
-        # with tag j
-        # history saves where the best tags candidate transitioned from; this is used
-        # when we trace back the best tag sequence
+        while matrices.size(0) > 1:
+            if matrices.size(0) % 2 == 1:
+                matrices = torch.cat([matrices, identity.expand((1,) + matrices.shape[1:])], dim=0)
+            matrices = self._log_matmul(matrices[0::2], matrices[1::2])
 
-        # Viterbi algorithm recursive case: we compute the score of the best tag sequence
-        # for every possible next tag
-        for i in range(1, seq_length):
-            # Broadcast viterbi score for every possible next tag
-            # shape: (batch_size, num_tags, 1)
-            broadcast_score = score.unsqueeze(2)
-
-            # Broadcast emission score for every possible current tag
-            # shape: (batch_size, 1, num_tags)
-            broadcast_emission = emissions[i].unsqueeze(1)
-
-            # Compute the score tensor of size (batch_size, num_tags, num_tags) where
-            # for each sample, entry at row i and column j stores the score of the best
-            # tag sequence so far that ends with transitioning from tag i to tag j and emitting
-            # shape: (batch_size, num_tags, num_tags)
-            next_score = broadcast_score + self.transitions + broadcast_emission
-
-            # Find the maximum score over all possible current tag
-            # shape: (batch_size, num_tags)
-            next_score, indices = next_score.max(dim=1)
-
-            # Set score to the next score if this timestep is valid (mask == 1)
-            # and save the index that produces the next score
-            # shape: (batch_size, num_tags)
-            score = torch.where(mask[i].unsqueeze(1), next_score, score)
-            history.append(indices)
-
-        # End transition score
+        # Start transition and first emission, then the end transition
         # shape: (batch_size, num_tags)
-        score += self.end_transitions
-
-        # Now, compute the best path for each sample
+        score = self.start_transitions + emissions[0]
+        if matrices.size(0) == 1:
+            # shape: (batch_size, num_tags)
+            score = torch.logsumexp(score.unsqueeze(2) + matrices[0], dim=1)
+        score = score + self.end_transitions
 
+        # Sum (log-sum-exp) over all possible tags
         # shape: (batch_size,)
-        seq_ends = mask.long().sum(dim=0) - 1
-        best_tags_list = []
-
-        for idx in range(batch_size):
-            # Find the tag which maximizes the score at the last timestep; this is our best tag
-            # for the last timestep
-            _, best_last_tag = score[idx].max(dim=0)
-            best_tags = [best_last_tag.item()]
-
-            # We trace back where the best last tag comes from, append that to our best tag
-            # sequence, and trace it back again, and so on
-            for hist in reversed(history[:seq_ends[idx]]):
-                best_last_tag = hist[idx][best_tags[-1]]
-                best_tags.append(best_last_tag.item())
+        return torch.logsumexp(score, dim=1)
 
-            # Reverse the order because we start from the last timestep
-            best_tags.reverse()
-            best_tags_list.append(best_tags)
+    def _viterbi_decode(self, emissions: torch.FloatTensor,
+                        mask: torch.ByteTensor,
+                        seq_starts: Optional[torch.Tensor] = None) -> Tuple[torch.LongTensor, torch.LongTensor]:
+        # emissions: (seq_length, batch_size, num_tags)
+        # mask: (seq_length, batch_size)
+        assert emissions.size(2) == self.num_tags
+        constraints = getattr(self, 'constraints', None)
+        if constraints is not None and constraints.num_tags != self.num_tags:
+            raise ValueError(f'constraints of {constraints.num_tags} tags for a CRF of {self.num_tags} tags')
 
-        return best_tags_list
+        return viterbi_decode(emissions, mask, self.start_transitions, self.end_transitions, self.transitions,
+                              seq_starts, constraints)
@@ -21,6 +21,8 @@ class Config:
     nopunc = False
     do_mask_as_whole = True
     dict_file = './resource/dict.txt'
+    ragged_cand_indexes = True # store the subword ids of the words as flat ids and offsets, see indexes2csr
+    pack_sequences = False # pack the short training sentences and the chunks to decode into full rows, see PackedDataset
 
     ##3.Training configs
     init_checkpoint = None #
@@ -33,9 +35,14 @@ class Config:
     warmup_proportion = 0.1
     num_hidden_layers = 0
     projected_size = 6
-    method = 'fine_tune' # 'last_layer', 'cat_last4', 'sum_last4', 'sum_all'
+    method = 'fine_tune' # 'last_layer', 'cat_last4', 'sum_last4', 'sum_all', 'MHMLA'
     fclassifier = 'Softmax' # or 'CRF', fclassifier is the classifier for word segmentation
     pclassifier = 'CRF' # 'Softmax' is suggested, pclassifier is the classifier for part-of-speech
+    sparse_qkv = False # grouped query/key/value, one group per head, above the bottom layers, see use_sparse_qkv
+    keep_dense_qkv_layers = 4 # the bottom layers keeping their dense query/key/value with sparse_qkv
+    crf_parallel_scan = False # CRF partition function by a parallel scan, see TorchCRF.CRF, for GPUs with few tags
+    crf_memory_efficient = False # CRF loss gradient by forward-backward, no per-timestep graph, see TorchCRF.CRFNormalizer
+    constrained_decoding = False # decode only the transitions allowed by BMES and the POS tags, see use_transition_constraints
 
     ##4.Devices
     no_cuda = False
@@ -56,6 +63,40 @@ class Config:
     modification = None
     model_type = None
 
+    #6.Inference options
+    chunk_cache_size = 0 # size of the LRU cache of decoded chunks, 0: no cache
+    server_host = '127.0.0.1'
+    server_port = 8000
+    server_max_wait_ms = 10 # max time to wait for filling a batch of the server
+    num_workers = 1 # number of CPU worker processes for decoding files, see src/inference_pool.py
+    threads_per_worker = 0 # 0: the number of cores assigned to each worker
+    long_window_size = 0 # >0: segment with overlapping windows of this many tokens, see cutlist_long_documents
+    long_stride = 0 # 0: half of long_window_size
+    trace_encoder = False # run the encoder through TorchScript graphs, see src/inference_session.py
+
+    #7.Distillation options, see src/distillation.py
+    teacher_model = None # fine-tuned weights of the teacher
+    teacher_num_hidden_layers = 12
+    teacher_logits_dir = None # where the teacher emissions of the training set are stored, None: run the teacher online
+    distill_temperature = 2.
+    distill_alpha = 0.5 # weight of the loss on the hard labels, 1-distill_alpha for the soft emissions
+    distill_hidden_weight = 0. # >0: match the outputs of the teacher layers, needs the teacher online
+
+    #8.Early exit options, see BertVariant
+    early_exit = False # put an exit classifier on each encoder layer
+    early_exit_posthoc = False # only train the exit classifiers of the fine-tuned bert_model
+    exit_threshold = 1. # decode at the first layer whose CWS confidence on all tokens of the batch exceeds it, 1: no exit
+
+    #9.Head pruning options, see src/head_pruning.py
+    num_heads_kept = 8 # heads kept in every encoder layer, or a list of one number per layer
+    head_importance_batches = 0 # dev batches used to score the heads, 0: all
+
+    #10.Feed-forward pruning options, see src/ffn_pruning.py
+    ffn_intermediate_size = 2048 # width of the feed-forward blocks after pruning
+    ffn_criterion = 'magnitude' # 'magnitude' of the weights or 'activation' statistics on the dev set
+    ffn_importance_batches = 0 # dev batches used by the activation criterion, 0: all
+    ffn_recovery_epochs = 0 # epochs of fine-tuning after pruning, 0: none
+
     def _parse(self, kwargs, verbose=True):
         state_dict = self._state_dict()
         for k, v in kwargs.items():
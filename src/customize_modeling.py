@@ -1,15 +1,18 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import math
+import hashlib
 from .BERT.modeling import PreTrainedBertModel, BertModel, BertLayerNorm, BertEncoder, BertPooler
-from .TorchCRF import CRF
+from .TorchCRF import CRF, TransitionConstraints, constrained_argmax, constrained_marginals
 from .preprocess import read_dict, tokenize_list, define_words_set, tokenize_list_with_cand_indexes_lang_status, \
-            tokenize_list_with_cand_indexes_lang_status_dict_vec
+            tokenize_list_with_cand_indexes_lang_status_dict_vec, stack_csr
 from .tokenization import FullTokenizer
 from .BERT.tokenization import BertTokenizer
 import numpy as np
-from .utilis import unpackTuple, restore_unknown_tokens, restore_unknown_tokens_with_pos, append_to_buff, \
-    split_text_by_punc, extract_pos, restore_unknown_tokens_without_unused_with_pos
+from .utilis import unpackTuple, append_to_buff, split_text_by_punc, extract_pos, stream_cutlist, \
+    decode_chunks, LRUCache, bio2pos_index, clean_cws_tags, tokenize_with_offsets, tags_to_spans, spans_to_words, \
+    bucket_by_length, sliding_windows, pack_sequences, pack_row, unpack_tags, word_confidences
 import re
 import copy
 from .config import segType, posType, MAX_GRAM_LEN
@@ -19,13 +22,14 @@ import pdb
 
 
 class BertSelfAttention(nn.Module):
-    def __init__(self, config):
+    # grouped: head h only projects the h-th slice of the hidden states, see BertGroupedQKV and use_sparse_qkv
+    def __init__(self, config, grouped=False):
         super(BertSelfAttention, self).__init__()
         if config.hidden_size % config.num_attention_heads != 0:
             raise ValueError(
                 "The hidden size (%d) is not a multiple of the number of attention "
                 "heads (%d)" % (config.hidden_size, config.num_attention_heads))
-        self.qkv = BertQKV(config)
+        self.qkv = BertGroupedQKV(config) if grouped else BertQKV(config)
         self.attention_head = BertAttentionHead(config)
 
     def forward(self, hidden_states, attention_mask):
@@ -106,8 +110,12 @@ class BertAttentionHead(nn.Module):
 
 
 class GroupedLinear(nn.Module):
+    """Block-diagonal linear layer: the input and the output are split into groups, and output group g only
+    depends on input group g. Its weight is [groups, in_features/groups, out_features/groups], i.e.,
+    1/groups of the weights and of the FLOPs of nn.Linear(in_features, out_features).
+    """
     def __init__(self, in_features, out_features, groups=1, config=None):
-        super(BertGroupedQKVLinear, self).__init__()
+        super(GroupedLinear, self).__init__()
         assert in_features % groups == 0
         assert out_features % groups == 0
         self.groups = groups
@@ -121,7 +129,21 @@ class GroupedLinear(nn.Module):
             self.weight.data.normal_(mean=0.0, std=config.initializer_range)
             self.bias.data.zero_()
 
+    @classmethod
+    def from_dense(cls, linear, groups):
+        # keep the diagonal blocks of the weight of linear, an nn.Linear
+        grouped = cls(linear.in_features, linear.out_features, groups)
+        in_size, out_size = grouped.input_group_size, grouped.output_group_size
+
+        with torch.no_grad():
+            for g in range(groups):
+                grouped.weight[g] = linear.weight[g*out_size:(g+1)*out_size, g*in_size:(g+1)*in_size].t()
+            grouped.bias.copy_(linear.bias.view(groups, 1, out_size))
+
+        return grouped.to(linear.weight.device)
+
     def forward(self, x):
+        # x: [batch_size, seq_len, in_features]
         multihead_input_shape = x.shape[:-1] + (self.groups, self.input_group_size)
         output_shape = x.shape[:-1] + (self.out_features,)
         x = x.view(*multihead_input_shape).permute(0, 2, 1, 3)
@@ -142,47 +164,161 @@ def cut_transformers(model, keep_bottom_layers=6):
     return model
 
 
-def use_sparse_qkv(model, keep_bottom_layers=4):
-    for layer_index, layer in enumerate(model.bert.encoder.layer):
-        if layer_index >= keep_bottom_layers:
-            new_attention = customize_modeling.BertSelfAttention(model.bert.config)
-            #layer.attention.self.qkv = BertGroupedQKV(models.bert.config)
-            layer.attention.self = new_attention
+def grouped_self_attention_from_dense(self_attention, config):
+    # BertSelfAttention(config, grouped=True) initialized from the diagonal blocks of a dense BERT self attention
+    new_attention = BertSelfAttention(config, grouped=True)
+    for name in ['query', 'key', 'value']:
+        setattr(new_attention.qkv, name, GroupedLinear.from_dense(getattr(self_attention, name), config.num_attention_heads))
+    new_attention.attention_head.dropout = self_attention.dropout
+
+    return new_attention.to(self_attention.query.weight.device)
+
+
+def sparse_qkv_layers(state_dict):
+    # the encoder layers with grouped query/key/value in state_dict, e.g., a checkpoint saved after use_sparse_qkv
+    return sorted(int(re.search(r'encoder\.layer\.(\d+)\.', k).group(1)) for k in state_dict
+                  if re.search(r'encoder\.layer\.\d+\.attention\.self\.qkv\.query\.weight$', k)
+                  and state_dict[k].dim() == 3)
+
+
+def use_sparse_qkv(model, keep_bottom_layers=4, layers=None):
+    """
+    Replace the query/key/value projections of the encoder layers above the keep_bottom_layers bottom ones,
+    or of the layers in layers if any, by grouped ones, one group per head, initialized from the dense weights.
+    The grouped projections have 1/num_attention_heads of the weights and of the FLOPs of the dense ones.
+    Fine-tune after the conversion. To load a checkpoint saved after it, convert the model the same way first,
+    e.g., use_sparse_qkv(model, layers=sparse_qkv_layers(state_dict)).
+    """
+    if layers is None:
+        layers = range(keep_bottom_layers, len(model.bert.encoder.layer))
+
+    for layer_index in layers:
+        layer = model.bert.encoder.layer[layer_index]
+        if not isinstance(layer.attention.self, BertSelfAttention):
+            layer.attention.self = grouped_self_attention_from_dense(layer.attention.self, model.bert.config)
     return model
 
 
+def default_tag_labels(num_tags):
+    # the tags of segType or posType in index order, by their number, e.g., BMES for 6 tags, None if none matches
+    for label_map in [segType.BMES_idx_to_label_map, segType.BIO_idx_to_label_map, posType.BIO_idx_to_label_map]:
+        if len(label_map) == num_tags:
+            return [label_map[i] for i in range(num_tags)]
+
+    return None
+
+
+def use_transition_constraints(model, CWS_labels=None, POS_labels=None):
+    """
+    Decode the tags of model, by its CRFs or by a constrained argmax of its Softmax classifiers, only along the
+    transitions allowed by the label schemes, e.g., no B->B or M->S of BMES and no B-VV->I-NN of the POS tags, see
+    TransitionConstraints. CWS_labels, POS_labels: the tags in index order, e.g., processor.get_labels(), default =
+    the maps of segType and posType of the same size. The training loss is unchanged.
+    """
+    model = getattr(model, 'module', model) # DataParallel
+    if hasattr(model, 'num_tags'): # BertVariant
+        heads = [('constraints', 'classifier', model.num_tags, CWS_labels)]
+    else:
+        heads = [('CWS_constraints', 'CWSclassifier', model.num_CWStags, CWS_labels),
+                 ('POS_constraints', 'POSclassifier', model.num_POStags, POS_labels)]
+
+    for name, classifier_name, num_tags, labels in heads:
+        if labels is None:
+            labels = default_tag_labels(num_tags)
+        if labels is None or len(labels) != num_tags:
+            raise ValueError('No labels of {} tags for the {}!'.format(num_tags, classifier_name))
+
+        constraints = TransitionConstraints(labels)
+        setattr(model, name, constraints) # the Softmax classifier
+        if isinstance(getattr(model, classifier_name, None), CRF):
+            getattr(model, classifier_name).constraints = constraints
+
+    return model
+
+
+def tag_confidences(logits, mask, tags_list, classifier=None, constraints=None):
+    """
+    Marginal probability of each decoded tag of tags_list, a list per sequence, by the forward-backward algorithm
+    of classifier if it is a CRF, else by the softmax of logits, under constraints if any. The probabilities of
+    the whole batch are computed and gathered on the device, then copied to the host at once.
+    """
+    if isinstance(classifier, CRF):
+        marginals = classifier.compute_marginals(logits, mask)
+    elif constraints is not None:
+        marginals = constrained_marginals(logits, mask, constraints)
+    else:
+        marginals = F.softmax(logits, dim=2)
+
+    batch_size, seq_len = mask.shape
+    tags = torch.tensor([t + [0]*(seq_len-len(t)) for t in tags_list], dtype=torch.long, device=logits.device)
+    confidences = marginals.gather(2, tags.view(batch_size, seq_len, 1)).squeeze(2).tolist()
+
+    return [c[:len(t)] for c, t in zip(confidences, tags_list)]
+
+
 class MultiHeadMultiLayerAttention(nn.Module):
-    def __init__(self, config):
+    """Mix the outputs of the encoder layers with a per-token, per-head attention over the layers.
+
+    For token t and head h, layer i gets the score a_{t,h,i} = w_h . ReLU(W_i x_{t,i} + b_i)[h], where [h] is the
+    slice of head h, and the output of head h is sum_i softmax_i(a_{t,h,i}) x_{t,i}[h]. All layers and heads are
+    computed at once by batched matmuls on the stacked layer outputs.
+
+    Params:
+        `config`: a BertConfig.
+        `num_layers`: the number of top encoder layers mixed. Default = config.num_hidden_layers.
+    Inputs:
+        `hidden_states`: the list of the encoder layer outputs, each of [batch_size, seq_len, hidden_size].
+    Outputs:
+        the mixed features of [batch_size, seq_len, hidden_size].
+    """
+    def __init__(self, config, num_layers=None):
         super(MultiHeadMultiLayerAttention, self).__init__()
-        self.num_hidden_layers = config.num_hidden_layers
-        self.dense_k = nn.Linear(config.hidden_size, config.hidden_size)
+        self.config = config
+        self.num_layers = num_layers if num_layers is not None else config.num_hidden_layers
+        self.num_attention_heads = config.num_attention_heads
+        self.attention_head_size = int(config.hidden_size / config.num_attention_heads)
+
+        # key projections of the layers, [num_layers, hidden_size, hidden_size], and the query of each head
+        self.key_weight = nn.Parameter(torch.empty(self.num_layers, config.hidden_size, config.hidden_size))
+        self.key_bias = nn.Parameter(torch.empty(self.num_layers, config.hidden_size))
+        self.query = nn.Parameter(torch.empty(self.num_attention_heads, self.attention_head_size))
         self.activation = nn.ReLU()
-        self.layer_k = nn.ModuleList([copy.deepcopy(self.dense_k) for _ in range(config.num_hidden_layers)])
-        self.dense_a = nn.Linear(config.num_hidden_layers, 1)
-        self.layer_a = nn.ModuleList([copy.deepcopy(self.dense_a) for _ in range(config.num_hidden_layers)])
-        self.apply(self.init_weights)
+        self.dropout = nn.Dropout(config.hidden_dropout_prob)
+        self.init_weights()
 
-    def init_weights(self, module):
+    def init_weights(self):
         """ Initialize the weights.
         """
-        if isinstance(module, (nn.Linear, nn.Embedding)):
-            # do not use truncated_normal as TF for initialization            #
-            module.weight.data.normal_(mean=0.0, std=self.config.initializer_range)
-        elif isinstance(module, nn.Linear) and module.bias is not None:
-            module.bias.data.zero_()
+        # do not use truncated_normal as TF for initialization
+        self.key_weight.data.normal_(mean=0.0, std=self.config.initializer_range)
+        self.key_bias.data.zero_()
+        self.query.data.normal_(mean=0.0, std=self.config.initializer_range)
 
     def forward(self, hidden_states):
-        all_encoder_layers = []
-        attention_weights = []
-        for i in range(self.num_hidden_layers):
-            hidden_state_i = hidden_states[i]
-            hidden_state_i = self.layer_k[i](hidden_state_i)
-            all_encoder_layers.append(hidden_state_i)
+        # [batch_size, seq_len, num_layers, hidden_size]
+        layers = torch.stack(hidden_states[-self.num_layers:], dim=2)
+        batch_size, seq_len, num_layers, hidden_size = layers.shape
+
+        # [num_layers, batch_size*seq_len, hidden_size]
+        keys = torch.baddbmm(self.key_bias.unsqueeze(1), layers.view(-1, num_layers, hidden_size).transpose(0, 1),
+                             self.key_weight)
+        keys = self.activation(keys).view(num_layers, batch_size, seq_len, self.num_attention_heads, -1)
 
-            hidden_state_i = self.activation(hidden_state_i)
-            attention_weight = self.layer_a[i](hidden_state_i)
-            attention_weights.append()
-        return
+        # [batch_size, seq_len, num_heads, num_layers]
+        scores = torch.einsum('nblhd,hd->blhn', keys, self.query)
+        attention_probs = F.softmax(scores, dim=-1)
+
+        # [batch_size, seq_len, num_heads, head_size]
+        values = layers.view(batch_size, seq_len, num_layers, self.num_attention_heads, -1).transpose(2, 3)
+        mixed = torch.matmul(attention_probs.unsqueeze(3), values).squeeze(3)
+
+        return self.dropout(mixed.reshape(batch_size, seq_len, hidden_size))
+
+
+# the encoder layers retained by the methods combining several layers and their reduction, see BertModel
+LAYER_SELECTION = {'sum_last4': (slice(-4, None), 'sum'),
+                   'sum_all': (slice(None), 'sum'),
+                   'cat_last4': (slice(-4, None), 'cat')}
 
 
 class BertVariant(PreTrainedBertModel):
@@ -191,12 +327,24 @@ class BertVariant(PreTrainedBertModel):
     models = BertVariant(config, num_tags)
     logits = models(input_ids, token_type_ids, input_mask)
     ```
+
+    With early_exit=True, a linear exit classifier is put on each encoder layer below the last one and trained
+    with the model, or alone after fine-tuning, see freeze_except_exits. In eval mode, decode stops at the first
+    layer where the lowest CWS confidence, i.e., max softmax probability, of the valid tokens of the batch
+    exceeds exit_threshold, which can be changed at any time, the chunk cache keys include it, see
+    compute_model_fingerprint. exit_threshold >= 1: all layers are used.
+    The sentences decoded at each layer are counted in exit_counts, see exit_report.
+
+    With pack_ids, see BertModel, several sequences are packed into each row of the batch, each with its own
+    [CLS] and [SEP]. The CRF then starts and ends each of them, and the tags of a row are concatenated in
+    best_tags_list. The early exits are skipped for packed batches.
     """
-    def __init__(self, config, num_tags=4, method='fine_tune', fclassifier='Softmax'):
+    def __init__(self, config, num_tags=4, method='fine_tune', fclassifier='Softmax', early_exit=False):
         super(BertVariant, self).__init__(config)
         self.num_tags = num_tags
         self.method = method
         self.fclassifier = fclassifier
+        self.early_exit = early_exit
         self.bert = BertModel(config)
         self.dropout = nn.Dropout(self.config.hidden_dropout_prob)
 
@@ -216,6 +364,7 @@ class BertVariant(PreTrainedBertModel):
             last_hidden_size = self.config.hidden_size*2
         elif self.method == 'MHMLA':
             self.MHMLA = MultiHeadMultiLayerAttention(config)
+            last_hidden_size = self.config.hidden_size
 
         # Maps the output of BERT into tag space.
         self.hidden2tag = nn.Linear(last_hidden_size, num_tags)
@@ -223,54 +372,81 @@ class BertVariant(PreTrainedBertModel):
         if self.fclassifier == 'CRF':
             self.classifier = CRF(num_tags, batch_first=True)
 
+        if self.early_exit:
+            if method != 'fine_tune':
+                raise ValueError('early_exit is only supported for method=fine_tune, not %s' % method)
+
+            # exits of the layers 1, ..., num_hidden_layers-1, the last layer exits through hidden2tag
+            self.exit2tag = nn.ModuleList([nn.Linear(self.config.hidden_size, num_tags)
+                                           for _ in range(self.config.num_hidden_layers-1)])
+
+        self.exit_threshold = 1.
+        self.exit_counts = np.zeros(self.config.num_hidden_layers, dtype=np.int64)
+        self.constraints = None # the allowed tags of the Softmax decoding, see use_transition_constraints
+
         self.apply(self.init_bert_weights)
 
-    def forward(self, input_ids, token_type_ids=None, attention_mask=None, labels=None):
-        logits = self._compute_bert_feats(input_ids, token_type_ids, attention_mask)
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None, labels=None, pack_ids=None):
+        if self.early_exit:
+            logits, exit_logits = self._compute_bert_feats(input_ids, token_type_ids, attention_mask, \
+                                                           return_exit_logits=True, pack_ids=pack_ids)
+        else:
+            logits = self._compute_bert_feats(input_ids, token_type_ids, attention_mask, pack_ids=pack_ids)
 
         mask = attention_mask.byte()
         if labels is None:
             raise RuntimeError('Input: labels, is missing!')
         else:
-            loss = self._compute_loss(logits, mask, labels)
+            loss = self._compute_loss(logits, mask, labels, pack_ids)
+
+            if self.early_exit:
+                loss_fct = nn.CrossEntropyLoss()
+                for exit_logit in exit_logits:
+                    loss += loss_fct(exit_logit.view(-1, self.num_tags), labels.view(-1))
         return loss
 
-    def decode(self, input_ids, token_type_ids=None, attention_mask=None, labels=None):
-        logits = self._compute_bert_feats(input_ids, token_type_ids, attention_mask)
+    def decode(self, input_ids, token_type_ids=None, attention_mask=None, labels=None, pack_ids=None):
+        if self.early_exit and self.exit_threshold < 1. and not self.training and pack_ids is None:
+            logits = self._compute_early_exit_feats(input_ids, token_type_ids, attention_mask)
+        else:
+            logits = self._compute_bert_feats(input_ids, token_type_ids, attention_mask, pack_ids=pack_ids)
+            self.exit_counts[-1] += input_ids.size(0)
 
         loss = logits
 
         mask = attention_mask.byte()
         if labels is not None:
-            loss = self._compute_loss(logits, mask, labels)
+            loss = self._compute_loss(logits, mask, labels, pack_ids)
 
         if self.fclassifier == 'CRF':
-            best_tags_list = self.classifier.decode(logits, mask)
+            best_tags_list = self.classifier.decode(logits, mask, pack_ids)
         elif self.fclassifier == 'Softmax':
-            best_tags_list = self._decode_Softmax(logits, mask)
+            best_tags_list = self._decode_Softmax(logits, mask, self.constraints)
 
         return loss, best_tags_list
 
-    def _compute_bert_feats(self, input_ids, token_type_ids=None, attention_mask=None):
-        if self.method in ['last_layer', 'fine_tune']:
+    def _compute_bert_feats(self, input_ids, token_type_ids=None, attention_mask=None, return_exit_logits=False, \
+                            pack_ids=None):
+        if self.method in ['last_layer', 'fine_tune'] and not return_exit_logits:
             output_all_encoded_layers = False
-        else: # sum_last4, sum_all, cat_last4, 'MHMLA'
+        else: # sum_last4, sum_all, cat_last4, 'MHMLA', or the exits
             output_all_encoded_layers = True
 
-        sequence_output, _ = self.bert(input_ids, token_type_ids, attention_mask, output_all_encoded_layers=output_all_encoded_layers)
-
-        if self.method == 'sum_last4':
-            feat_used = self.dropout(sequence_output[-1])
-            for l in range(-2, -5, -1):
-                feat_used += self.dropout(sequence_output[l])
-        elif self.method == 'sum_all':
-            feat_used = self.dropout(sequence_output[-1])
-            for l in range(-2, -13, -1):
-                feat_used += self.dropout(sequence_output[l])
-        elif self.method == 'cat_last4':
-            feat_used = self.dropout(sequence_output[-4])
-            for l in range(-3, 0):
-                feat_used = torch.cat((feat_used, self.dropout(sequence_output[l])), 2)
+        output_layers, layer_reduction = LAYER_SELECTION.get(self.method, (None, None))
+        sequence_output, _ = self.bert(input_ids, token_type_ids, attention_mask, output_all_encoded_layers=output_all_encoded_layers, \
+                                       pack_ids=pack_ids, output_layers=output_layers, layer_reduction=layer_reduction, \
+                                       layer_transform=self.dropout)
+        if pack_ids is not None and hasattr(self, 'biLSTM'):
+            # the biLSTM would run across the packed sequences
+            raise ValueError('pack_ids is not supported for method=%s' % self.method)
+
+        if return_exit_logits: # method is fine_tune
+            exit_logits = [exit2tag(self.dropout(encoded_layer))
+                           for exit2tag, encoded_layer in zip(self.exit2tag, sequence_output[:-1])]
+            sequence_output = sequence_output[-1]
+
+        if self.method in LAYER_SELECTION: # the sum or the concat of the layers after dropout
+            feat_used = sequence_output
         elif self.method in ['last_layer', 'fine_tune']:
             feat_used = sequence_output
             feat_used = self.dropout(feat_used)
@@ -282,21 +458,70 @@ class BertVariant(PreTrainedBertModel):
 
         bert_feats = self.hidden2tag(feat_used)
 
+        if return_exit_logits:
+            return bert_feats, exit_logits
+
         return bert_feats
 
-    def _compute_loss(self, logits, mask, labels):
+    def _compute_early_exit_feats(self, input_ids, token_type_ids=None, attention_mask=None):
+        # run the encoder layer by layer up to the first exit confident on every valid token of the batch
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+
+        # same additive attention mask as BertModel
+        extended_attention_mask = attention_mask.unsqueeze(1).unsqueeze(2)
+        extended_attention_mask = extended_attention_mask.to(dtype=next(self.parameters()).dtype)
+        extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
+
+        valid = attention_mask.ne(0)
+        hidden_states = self.bert.embeddings(input_ids, token_type_ids)
+        num_layers = len(self.bert.encoder.layer)
+
+        for l, layer_module in enumerate(self.bert.encoder.layer):
+            hidden_states = layer_module(hidden_states, extended_attention_mask)
+
+            if l == num_layers-1:
+                bert_feats = self.hidden2tag(self.dropout(hidden_states))
+                break
+
+            bert_feats = self.exit2tag[l](self.dropout(hidden_states))
+            confidence, _ = F.softmax(bert_feats, dim=-1).max(dim=-1)
+            if torch.masked_select(confidence, valid).min() > self.exit_threshold:
+                break
+
+        self.exit_counts[l] += input_ids.size(0)
+
+        return bert_feats
+
+    def exit_report(self, reset=True):
+        # the fractions of the sentences decoded at each layer since the last reset and the mean number of layers
+        num_sents = max(self.exit_counts.sum(), 1)
+        fractions = self.exit_counts / num_sents
+        mean_layers = (fractions * np.arange(1, len(fractions)+1)).sum()
+
+        report = 'exit threshold: {:.3f}, mean layers: {:.2f}/{:d}, exits: {}'.format(self.exit_threshold, \
+            mean_layers, len(fractions), ' '.join(['l{:d}:{:.3f}'.format(l+1, f) for l, f in enumerate(fractions)]))
+
+        if reset:
+            self.exit_counts[:] = 0
+
+        return report
+
+    def _compute_loss(self, logits, mask, labels, pack_ids=None):
         # mask is a ByteTensor
 
         if self.fclassifier == 'Softmax':
             loss_fct = nn.CrossEntropyLoss()
             loss = loss_fct(logits.view(-1, self.num_tags), labels.view(-1))
         elif self.fclassifier == 'CRF':
-            loss = -self.classifier(logits, labels, mask)
+            loss = -self.classifier(logits, labels, mask, pack_ids=pack_ids)
 
         return loss
 
-    def _decode_Softmax(self, logits, mask):
-        # mask is a ByteTensor
+    def _decode_Softmax(self, logits, mask, constraints=None):
+        # mask is a ByteTensor; constraints: the allowed tags, see use_transition_constraints
+        if constraints is not None:
+            return constrained_argmax(logits, mask, constraints)
 
         batch_size, _ = mask.shape
 
@@ -310,6 +535,233 @@ class BertVariant(PreTrainedBertModel):
         return best_tags_list
 
 
+def freeze_except_exits(model):
+    # post-hoc training of the exit classifiers of a fine-tuned BertVariant, the other weights are kept
+    if not getattr(model, 'early_exit', False):
+        raise ValueError('The model has no exit classifiers, build it with early_exit=True!')
+
+    for name, param in model.named_parameters():
+        param.requires_grad = name.startswith('exit2tag.')
+
+    return [(n, p) for n, p in model.named_parameters() if p.requires_grad]
+
+
+def weights_signature(model):
+    # the weight tensors with their in-place version counters, which load_state_dict and the optimizers bump,
+    # and the packed weights of the quantized layers, which are not parameters and are replaced by load_state_dict
+    signature = [(id(t), t._version) for t in list(model.parameters()) + list(model.buffers())]
+    for module in model.modules():
+        signature += [id(module.__dict__[name]) for name in ('_packed_params', 'param') if name in module.__dict__]
+
+    return tuple(signature)
+
+
+def weights_digest(state_dict):
+    # sha1 of the names, shapes and values of the tensors of state_dict, whose values can be tuples of tensors,
+    # e.g., the packed weights of a quantized Linear; unlike a sum of the weights, permuted weights differ
+    sha1 = hashlib.sha1()
+
+    def update(name, value):
+        if isinstance(value, (tuple, list)):
+            for i, v in enumerate(value): update('{}.{}'.format(name, i), v)
+        elif torch.is_tensor(value):
+            value = (value.dequantize() if value.is_quantized else value).detach().cpu()
+            if value.dtype == torch.bfloat16: value = value.float() # not in numpy
+            sha1.update('{}:{}:{};'.format(name, value.dtype, tuple(value.shape)).encode('utf8'))
+            sha1.update(value.contiguous().numpy())
+
+    for name, value in state_dict.items():
+        update(name, value)
+
+    return sha1.hexdigest()
+
+
+def compute_model_fingerprint(model):
+    """
+    Identify the current weights and decode settings of model, so that its chunk cache never returns the results
+    of other weights or settings, e.g., after load_state_dict, quantize_model, use_transition_constraints or a change
+    of pack_sequences or exit_threshold. Called by cutlist_noUNK on every call; the digest of the weights is only
+    recomputed when weights_signature changes. Return None if model has no chunk cache.
+    The chunk cache is keyed by this fingerprint and the raw text chunk, not a normalized form of it, since the
+    cached token offsets point into the raw chunk.
+    """
+    if model.chunk_cache is None:
+        return None
+
+    signature = weights_signature(model)
+    if getattr(model, 'weights_digest', (None,))[0] != signature:
+        model.weights_digest = (signature, weights_digest(model.state_dict()))
+
+    constraints = [getattr(model, name, None) for name in ('constraints', 'CWS_constraints', 'POS_constraints')]
+    return (type(model).__name__, model.max_length, model.weights_digest[1], \
+            getattr(model, 'quantized', False), getattr(model, 'pack_sequences', False), \
+            getattr(model, 'exit_threshold', None), tuple(None if c is None else tuple(c.labels) for c in constraints))
+
+
+def set_chunk_cache(model, max_size=100000, chunk_cache=None):
+    """
+    Put a bounded LRU cache of decoded chunks in front of model._seg_wordslist, used by cutlist_noUNK.
+    chunk_cache can be shared by several models, since the keys include the model fingerprint, which is computed
+    on each call, see compute_model_fingerprint. max_size=0 removes the cache. The counters are reported by
+    model.chunk_cache.stats().
+    """
+    if max_size == 0 and chunk_cache is None:
+        model.chunk_cache = None
+        return None
+
+    model.chunk_cache = chunk_cache if chunk_cache is not None else LRUCache(max_size)
+
+    return model.chunk_cache
+
+
+def to_input_tensor(model, name, data):
+    """
+    Convert a batch of inputs, e.g., a list of input ids, into a tensor on model.device.
+    If model.input_buffers is a dict, the tensor is a view of a buffer kept there under name, which is only
+    reallocated when a larger batch arrives, so that the batches do not allocate new input tensors.
+    The buffers are reused by the next batch, so one model should not decode several batches concurrently.
+    """
+    data = np.array(data)
+    if model.input_buffers is None:
+        return torch.from_numpy(data).to(model.device)
+
+    data = torch.from_numpy(data)
+    buffer = model.input_buffers.get(name)
+    if buffer is None or buffer.numel() < data.numel() or buffer.dtype != data.dtype:
+        buffer = torch.empty(data.numel(), dtype=data.dtype, device=model.device)
+        model.input_buffers[name] = buffer
+
+    input_tensor = buffer[:data.numel()].view(data.shape)
+    input_tensor.copy_(data)
+
+    return input_tensor
+
+
+def decode_packed_wordslist(model, lword, max_length, num_outputs=1):
+    """
+    Decode the token lists of lword packed into rows of up to max_length positions, see pack_sequences,
+    instead of one padded row each. Every token list keeps its own [CLS] and [SEP], and is cut to max_length-2
+    tokens as by tokenize_list. max_length should not exceed model.max_length.
+    Return the num_outputs tag lists of model.decode unpacked, one per token list of lword, in its order.
+    """
+    lword = [w[:max_length-2] for w in lword]
+    lengths = [len(w)+2 for w in lword]
+    rows = pack_sequences(lengths, max_length)
+    padded_length = max(sum(lengths[i] for i in row) for row in rows)
+
+    examples = [tokenize_list(w, n, model.tokenizer) for w, n in zip(lword, lengths)]
+    input_ids, segment_ids, input_masks, pack_ids = [], [], [], []
+    for row in rows:
+        (input_id, segment_id, input_mask), pack_id = pack_row([examples[i] for i in row], \
+                                                    [lengths[i] for i in row], padded_length)
+        input_ids.append(input_id)
+        segment_ids.append(segment_id)
+        input_masks.append(input_mask)
+        pack_ids.append(pack_id)
+
+    outputs = model.decode(to_input_tensor(model, 'input_ids', input_ids), \
+                           to_input_tensor(model, 'segment_ids', segment_ids), \
+                           to_input_tensor(model, 'input_masks', input_masks), \
+                           pack_ids=to_input_tensor(model, 'pack_ids', pack_ids))
+
+    order = [i for row in rows for i in row]
+    row_lengths = [[lengths[i] for i in row] for row in rows]
+
+    tag_lists = []
+    for tags_list in outputs[-num_outputs:]:
+        unpacked = [None] * len(lword)
+        for i, tags in zip(order, unpack_tags(tags_list, row_lengths)):
+            unpacked[i] = tags
+        tag_lists.append(unpacked)
+
+    return tag_lists
+
+
+def cutlist_long_documents(model, input_list, window_size=None, stride=None, whole_word=False, with_pos=True):
+    """
+    Segment long documents with overlapping windows instead of independent chunks of max_length-2 characters.
+
+    Each document is tokenized once and cut into windows of at most window_size tokens, the next window starting
+    stride tokens later. Only the centre of each window is kept, i.e., the overlap of two windows is split at its
+    middle, so every token is tagged with context on both sides and words are not cut at the chunk boundaries.
+    window_size: default = config.max_position_embeddings-2; stride: default = window_size//2.
+    whole_word: the tags are predicted for whole words, as in the BertML* models.
+    Return the same format as cutlist_noUNK: lists of words, or of 'word / POS' if with_pos.
+    """
+    if window_size is None: window_size = model.config.max_position_embeddings - 2
+    window_size = min(window_size, model.config.max_position_embeddings - 2)
+    if stride is None: stride = max(window_size // 2, 1)
+    if stride > window_size:
+        raise ValueError('stride ({}) must not be larger than window_size ({})'.format(stride, window_size))
+
+    # tokenize the documents and group their tokens into units, i.e., the items tagged by the model
+    doc_list = []
+    window_list = [] # (doc index, first unit, last unit+1, first kept unit, last kept unit+1)
+    for text in input_list:
+        if isinstance(text, float): continue # process problem of empty line, which is converted to nan
+
+        text = ''.join(split_text_by_punc(text))
+        tokens, offsets = tokenize_with_offsets(model.tokenizer, text, unk_if_empty=whole_word)
+
+        if whole_word:
+            unit_tokens = define_words_set(tokens)
+        else:
+            unit_tokens = [[i] for i in range(len(tokens))]
+        unit_offsets = [(offsets[u[0]][0], offsets[u[-1]][1]) for u in unit_tokens]
+
+        for w_start, w_end, k_start, k_end in sliding_windows([len(u) for u in unit_tokens], window_size, stride):
+            window_list.append((len(doc_list), unit_tokens[w_start][0], unit_tokens[w_end-1][-1]+1,
+                                w_start, w_end, k_start, k_end))
+
+        # units not covered by a decoded window, e.g., a word longer than window_size, stay single words
+        doc_list.append((text, tokens, unit_offsets,
+                         np.full(len(unit_offsets), segType.BMES_label_map['S'], dtype=np.int64),
+                         np.full(len(unit_offsets), 35, dtype=np.int64)))
+
+    window_tokens = [doc_list[d][1][t_start:t_end] for d, t_start, t_end, _, _, _, _ in window_list]
+    for b_idx, b_max_length in bucket_by_length(window_tokens, model.batch_size, window_size+2):
+        outputs = model._seg_wordslist([window_tokens[i] for i in b_idx], b_max_length)
+        if not with_pos: outputs = (outputs,)
+
+        for j, i in enumerate(b_idx):
+            d, _, _, w_start, w_end, k_start, k_end = window_list[i]
+            cws_tags = outputs[0][j][k_start-w_start:k_end-w_start]
+            doc_list[d][3][k_start:k_start+len(cws_tags)] = cws_tags
+            if with_pos:
+                pos_tags = outputs[1][j][k_start-w_start:k_end-w_start]
+                doc_list[d][4][k_start:k_start+len(pos_tags)] = pos_tags
+
+    result_str_list = []
+    for text, _, unit_offsets, cws_tags, pos_tags in doc_list:
+        word_spans, word_pos = tags_to_spans([text], [unit_offsets], [cws_tags], [pos_tags] if with_pos else None)
+
+        if with_pos:
+            seg_ls, pos_ls = spans_to_words(text, word_spans, word_pos.tolist())
+            result_str_list.append([seg_ls[i] + ' / ' + posType.POS_label_map[pos_ls[i]] for i in range(len(seg_ls))])
+        else:
+            seg_ls, _ = spans_to_words(text, word_spans)
+            result_str_list.append(seg_ls)
+
+    return result_str_list
+
+
+def segment_text_stream(model, input_iter, window_size=None):
+    """
+    Streaming version of model.cutlist_noUNK: input_iter can be any iterator of texts, e.g., an opened file,
+    and the results of each text are yielded as soon as the window containing it is decoded.
+    At most window_size chunks of max_length-2 characters are kept in memory. Default = 4*batch_size.
+    model can also be an InferenceSession, whose cutlist_noUNK then decodes the windows.
+
+    # Example usage:
+        with open(infile, 'r', encoding='utf8') as f:
+            for words in segment_text_stream(models, f):
+                print(' '.join(words))
+    """
+    if window_size is None: window_size = 4*model.batch_size
+
+    return stream_cutlist(model.cutlist_noUNK, input_iter, model.max_length-2, window_size)
+
+
 class BertCWS(BertVariant):
     """BERT models with CRF for Chinese Word Segmentation.
     This module is composed of the BERT models with a linear layer on top of
@@ -323,6 +775,11 @@ class BertCWS(BertVariant):
         `num_tags`: the number of classes for the classifier. Default = 6.
         `batch_size`: the number of mini-batch size for processing the data
         'fclassifier': the type of classifier in the final stage, currently I use CRF or Softmax
+        `early_exit`: put exit classifiers on the encoder layers, see BertVariant. Default = False.
+
+    With pack_sequences = True, the chunks of cutlist_noUNK are packed into rows of max_length positions,
+    see decode_packed_wordslist, instead of taking one padded row each. The windows of cutlist_long longer than
+    max_length are decoded unpacked.
 
     Outputs:
         if `labels` is not `None`:
@@ -342,46 +799,44 @@ class BertCWS(BertVariant):
     logits = models(input_ids, token_type_ids, input_mask)
     ```
     """
-    def __init__(self, device, config, vocab_file, max_length, num_tags=6, batch_size=64, fclassifier='Softmax', method='fine_tune'):
+    def __init__(self, device, config, vocab_file, max_length, num_tags=6, batch_size=64, fclassifier='Softmax', method='fine_tune', \
+                 early_exit=False):
         super(BertCWS, self).__init__(config)
-        BertVariant.__init__(self, config, num_tags=num_tags, method=method, fclassifier=fclassifier)
+        BertVariant.__init__(self, config, num_tags=num_tags, method=method, fclassifier=fclassifier, early_exit=early_exit)
 
         self.device = device
         self.batch_size = batch_size
         self.max_length = max_length
+        self.chunk_cache = None # see set_chunk_cache
+        self.input_buffers = None # see src/inference_session.py
+        self.pack_sequences = False
 
-    def _seg_wordslist(self, lword):  # ->str
+    def _seg_wordslist(self, lword, max_length=None):  # ->str
         # lword: list of words (list)
-        # input_ids, segment_ids, input_mask = tokenize_list(
-        #     words, self.max_length, self.tokenizer)
-        input_ids, segment_ids, input_masks = zip(
-            *[tokenize_list(w, self.max_length, self.tokenizer) for w in lword])
-
-        input_id_torch = torch.from_numpy(np.array(input_ids)).to(self.device)
-        segment_ids_torch = torch.from_numpy(np.array(segment_ids)).to(self.device)
-        input_masks_torch = torch.from_numpy(np.array(input_masks)).to(self.device)
+        # max_length: length to pad the batch to, default: self.max_length
+        if max_length is None: max_length = self.max_length
 
-        _, decode_rs = self.decode(input_id_torch, segment_ids_torch, input_masks_torch)
-
-        decode_output_list = []
-        for rs in decode_rs:
-            decode_output = ''.join(str(v) for v in rs[1:-1])
+        if self.pack_sequences and max_length <= self.max_length:
+            decode_rs, = decode_packed_wordslist(self, lword, max_length, num_outputs=1)
+        else:
+            # input_ids, segment_ids, input_mask = tokenize_list(
+            #     words, self.max_length, self.tokenizer)
+            input_ids, segment_ids, input_masks = zip(
+                *[tokenize_list(w, max_length, self.tokenizer) for w in lword])
 
-            # tmp_rs[1:-1]: remove the start token and the end token
-            #decode_output = tmp_rs[1:-1]
+            input_id_torch = to_input_tensor(self, 'input_ids', input_ids)
+            segment_ids_torch = to_input_tensor(self, 'segment_ids', segment_ids)
+            input_masks_torch = to_input_tensor(self, 'input_masks', input_masks)
 
-            # Now decode_output should consists of the tokens corresponding to B, M, E, S, [START], [END],
-            #  i.e, BMES_idx_to_label_map = {0: 'B', 1: 'M', 2: 'E', 3: 'S', 4: '[START]', 5: '[END]'}
-            #  i.e., BMES_idx_to_label_map = {0: '[START]', 1: '[END]', 2: 'B', 3: 'M', 4: 'E', 5: 'S'}
+            _, decode_rs = self.decode(input_id_torch, segment_ids_torch, input_masks_torch)
 
-            # replace the [START] and [END] tokens
-            # predict those wrong tokens as a separated word
-            # replacing 4 and 5 should not be conducted usually
-            #decode_output = decode_output.replace(str(segType.BMES_label_map['[START]']), str(segType.BMES_label_map['S']))
-            #decode_output = decode_output.replace(str(segType.BMES_label_map['[END]']), str(segType.BMES_label_map['S']))
-            decode_output_list.append(decode_output)
+        # rs[1:-1]: remove the start token and the end token
+        # Now each output consists of the tag ids of B, M, E, S, [START], [END],
+        #  i.e., BMES_idx_to_label_map = {0: '[START]', 1: '[END]', 2: 'B', 3: 'M', 4: 'E', 5: 'S'}
+        # [START] and [END] are kept, they are merged into the current word as M when rebuilding the words
+        decode_output_list = [np.array(rs[1:-1], dtype=np.int64) for rs in decode_rs]
 
-        return decode_output_list  # list of string
+        return decode_output_list  # list of np.array
 
     def cutlist_noUNK(self, input_list):
         """
@@ -428,61 +883,38 @@ class BertCWS(BertVariant):
             merge_index_list.append(merge_index_tuple)
 
         original_text_list = processed_text_list
-        processed_text_list = [self.tokenizer.tokenize(
-            t) for t in processed_text_list]
 
-        decode_output_list = []
-        batch_size = self.batch_size
-        for p_t_l in [processed_text_list[0+i:batch_size+i] for i in range(0, len(processed_text_list), batch_size)]:
-            decode_output_list.extend(self._seg_wordslist(p_t_l))
+        # decode chunks in buckets of similar lengths, each padded to its longest chunk only,
+        # while repeated chunks are read from the chunk cache
+        # the packed rows are filled up to max_length instead of the longest chunk of the bucket
+        seg_fn = (lambda lword, _: self._seg_wordslist(lword)) if self.pack_sequences else self._seg_wordslist
+        processed_text_list, offset_list, (decode_output_list,) = decode_chunks(original_text_list, \
+            lambda t: tokenize_with_offsets(self.tokenizer, t), seg_fn, self.batch_size, \
+            self.max_length, num_outputs=1, chunk_cache=self.chunk_cache, fingerprint=compute_model_fingerprint(self))
 
-        # restoring processed_text_list to list of strings
-        #processed_text_list = [''.join(char_list) for char_list in processed_text_list]
+        # the words are sliced out of the text with the offsets of their tokens, including unknown tokens
         result_str_list = []
         for merge_start, merge_end in merge_index_list:
-            result_str = ''
-            original_str = ''
-
-            tag = ''.join(decode_output_list[merge_start:merge_end])
-            text = []
-            for a in processed_text_list[merge_start:merge_end]:
-                text.extend(a)
-
-            for a in original_text_list[merge_start:merge_end]:
-                str_used = ''
-                al = re.split('[\n\r]', a)
-
-                for aa in al: str_used += ''.join(aa.strip())
-
-                original_str += str_used
-
-            for idx in range(len(tag)):
-                tt = text[idx]
-                tt = tt.replace('##', '')
-                ti = tag[idx]
-
-                try:
-                    int(ti)
-                except ValueError:
-                    print(ti + '\n')      # or whatever
-                    print(tag)
-
-                if int(ti) == segType.BMES_label_map['B']:  # 'B'
-                    result_str += ' ' + tt
-                elif int(ti) > segType.BMES_label_map['M']:  # and (cur_word_is_english)
-                    # int(ti)>1: tokens of 'E' and 'S'
-                    # current word is english
-                    result_str += tt + ' '
-                else:
-                    result_str += tt
-
-            if UNK_TOKEN in result_str or '[unused' in result_str:
-                result_str = restore_unknown_tokens(original_str, result_str)
+            chunk_list = original_text_list[merge_start:merge_end]
+            word_spans, _ = tags_to_spans(chunk_list, offset_list[merge_start:merge_end], \
+                                          decode_output_list[merge_start:merge_end])
+            words, _ = spans_to_words(''.join(chunk_list), word_spans)
 
-            result_str_list.append(result_str.strip().split())
+            result_str_list.append(words)
 
         return result_str_list
 
+    def segment_stream(self, input_iter, window_size=None):
+        """Streaming version of cutlist_noUNK, see segment_text_stream."""
+        return segment_text_stream(self, input_iter, window_size)
+
+    def cutlist_long(self, input_list, window_size=None, stride=None):
+        """
+        Long-document version of cutlist_noUNK with overlapping windows of up to max_position_embeddings-2 tokens,
+        see cutlist_long_documents. window_size: default = max_position_embeddings-2; stride: default = window_size//2.
+        """
+        return cutlist_long_documents(self, input_list, window_size, stride, whole_word=False, with_pos=False)
+
 
 class BertVariantCWSPOS(PreTrainedBertModel):
     """Apply BERT for Sequence Labeling on Chinese Word Segmentation and Part-of-Speech.
@@ -490,6 +922,8 @@ class BertVariantCWSPOS(PreTrainedBertModel):
     models = BertVariantCWSPOS(config, num_tags)
     logits = models(input_ids, token_type_ids, input_mask)
     ```
+
+    pack_ids: several sequences packed into each row of the batch, see BertVariant.
     """
     def __init__(self, config, num_CWStags=6, num_POStags=108, method='fine_tune', fclassifier='Softmax'):
         super(BertVariantCWSPOS, self).__init__(config)
@@ -516,6 +950,7 @@ class BertVariantCWSPOS(PreTrainedBertModel):
             last_hidden_size = self.config.hidden_size*2
         elif self.method == 'MHMLA':
             self.MHMLA = MultiHeadMultiLayerAttention(config)
+            last_hidden_size = self.config.hidden_size
 
         # Maps the output of BERT into tag space.
         self.hidden2CWStag = nn.Linear(last_hidden_size, num_CWStags)
@@ -525,72 +960,72 @@ class BertVariantCWSPOS(PreTrainedBertModel):
             self.CWSclassifier = CRF(num_CWStags, batch_first=True)
             self.POSclassifier = CRF(num_POStags, batch_first=True)
 
+        # the allowed tags of the Softmax decoding, see use_transition_constraints
+        self.CWS_constraints = None
+        self.POS_constraints = None
+
         self.apply(self.init_bert_weights)
 
-    def forward(self, input_ids, token_type_ids=None, attention_mask=None, labels_CWS=None, labels_POS=None):
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None, labels_CWS=None, labels_POS=None, pack_ids=None):
         mask = attention_mask.byte()
         loss = 1e10
 
         if labels_CWS is None and labels_POS is None:
             raise RuntimeError('Input: labels_CWS or labels_POS is missing!')
         else:
-            feat_used = self._compute_bert_feats(input_ids, token_type_ids, attention_mask)
+            feat_used = self._compute_bert_feats(input_ids, token_type_ids, attention_mask, pack_ids)
             cws_logits = self.hidden2CWStag(feat_used)
 
             if labels_CWS is not None:
-                loss = self._compute_loss(cws_logits, mask, labels_CWS, 'CWS')
+                loss = self._compute_loss(cws_logits, mask, labels_CWS, 'CWS', pack_ids)
 
             if labels_POS is not None:
                 pos_logits = self.hidden2POStag(feat_used)
-                loss += self._compute_loss(pos_logits, mask, labels_POS, 'POS')
+                loss += self._compute_loss(pos_logits, mask, labels_POS, 'POS', pack_ids)
 
         return loss
 
-    def decode(self, input_ids, token_type_ids=None, attention_mask=None, labels_CWS=None, labels_POS=None):
+    def decode(self, input_ids, token_type_ids=None, attention_mask=None, labels_CWS=None, labels_POS=None, pack_ids=None):
         cws_loss = 1e10
         pos_loss = 1e10
 
         mask = attention_mask.byte()
-        feat_used = self._compute_bert_feats(input_ids, token_type_ids, attention_mask)
+        feat_used = self._compute_bert_feats(input_ids, token_type_ids, attention_mask, pack_ids)
 
         cws_logits = self.hidden2CWStag(feat_used)
         pos_logits = self.hidden2POStag(feat_used)
 
         if labels_CWS is not None:
-            cws_loss = self._compute_loss(cws_logits, mask, labels_CWS, 'CWS')
+            cws_loss = self._compute_loss(cws_logits, mask, labels_CWS, 'CWS', pack_ids)
 
         if labels_POS is not None:
-            pos_loss = self._compute_loss(pos_logits, mask, labels_POS, 'POS')
+            pos_loss = self._compute_loss(pos_logits, mask, labels_POS, 'POS', pack_ids)
 
         if self.fclassifier == 'CRF':
-            best_cws_tags_list = self.classifier.decode(cws_logits, mask)
-            best_pos_tags_list = self.classifier.decode(pos_logits, mask)
+            best_cws_tags_list = self.CWSclassifier.decode(cws_logits, mask, pack_ids)
+            best_pos_tags_list = self.POSclassifier.decode(pos_logits, mask, pack_ids)
         elif self.fclassifier == 'Softmax':
-            best_cws_tags_list = self._decode_Softmax(cws_logits, mask)
-            best_pos_tags_list = self._decode_Softmax(pos_logits, mask)
+            best_cws_tags_list = self._decode_Softmax(cws_logits, mask, self.CWS_constraints)
+            best_pos_tags_list = self._decode_Softmax(pos_logits, mask, self.POS_constraints)
 
         return cws_loss, pos_loss, best_cws_tags_list, best_pos_tags_list
 
-    def _compute_bert_feats(self, input_ids, token_type_ids=None, attention_mask=None):
+    def _compute_bert_feats(self, input_ids, token_type_ids=None, attention_mask=None, pack_ids=None):
         if self.method in ['last_layer', 'fine_tune']:
             output_all_encoded_layers = False
         else: # sum_last4, sum_all, cat_last4, 'MHMLA'
             output_all_encoded_layers = True
 
-        sequence_output, _ = self.bert(input_ids, token_type_ids, attention_mask, output_all_encoded_layers=output_all_encoded_layers)
-
-        if self.method == 'sum_last4':
-            feat_used = self.dropout(sequence_output[-1])
-            for l in range(-2, -5, -1):
-                feat_used += self.dropout(sequence_output[l])
-        elif self.method == 'sum_all':
-            feat_used = self.dropout(sequence_output[-1])
-            for l in range(-2, -13, -1):
-                feat_used += self.dropout(sequence_output[l])
-        elif self.method == 'cat_last4':
-            feat_used = self.dropout(sequence_output[-4])
-            for l in range(-3, 0):
-                feat_used = torch.cat((feat_used, self.dropout(sequence_output[l])), 2)
+        output_layers, layer_reduction = LAYER_SELECTION.get(self.method, (None, None))
+        sequence_output, _ = self.bert(input_ids, token_type_ids, attention_mask, output_all_encoded_layers=output_all_encoded_layers, \
+                                       pack_ids=pack_ids, output_layers=output_layers, layer_reduction=layer_reduction, \
+                                       layer_transform=self.dropout)
+        if pack_ids is not None and hasattr(self, 'biLSTM'):
+            # the biLSTM would run across the packed sequences
+            raise ValueError('pack_ids is not supported for method=%s' % self.method)
+
+        if self.method in LAYER_SELECTION: # the sum or the concat of the layers after dropout
+            feat_used = sequence_output
         elif self.method in ['last_layer', 'fine_tune']:
             feat_used = sequence_output
             feat_used = self.dropout(feat_used)
@@ -604,7 +1039,7 @@ class BertVariantCWSPOS(PreTrainedBertModel):
 
         return feat_used
 
-    def _compute_loss(self, logits, mask, labels, task):
+    def _compute_loss(self, logits, mask, labels, task, pack_ids=None):
         # mask is a ByteTensor
 
         if self.fclassifier == 'Softmax':
@@ -618,14 +1053,16 @@ class BertVariantCWSPOS(PreTrainedBertModel):
             loss = loss_fct(logits.view(-1, num_tags), labels.view(-1))
         elif self.fclassifier == 'CRF':
             if task == 'CWS':
-                loss = -self.CWSclassifier(logits, labels, mask)
+                loss = -self.CWSclassifier(logits, labels, mask, pack_ids=pack_ids)
             elif task == 'POS':
-                loss = -self.POSclassifier(logits, labels, mask)
+                loss = -self.POSclassifier(logits, labels, mask, pack_ids=pack_ids)
 
         return loss
 
-    def _decode_Softmax(self, logits, mask):
-        # mask is a ByteTensor
+    def _decode_Softmax(self, logits, mask, constraints=None):
+        # mask is a ByteTensor; constraints: the allowed tags, see use_transition_constraints
+        if constraints is not None:
+            return constrained_argmax(logits, mask, constraints)
 
         batch_size, _ = mask.shape
 
@@ -645,6 +1082,8 @@ class BertCWSPOS(BertVariantCWSPOS):
     models = BertCWSPOS(device, config, vocab_file, max_length, num_CWStags=6, num_POStags=110, batch_size=64, fclassifier='Softmax', method='fine_tune')
     logits = models(input_ids, token_type_ids, input_mask)
     ```
+
+    pack_sequences: pack the chunks of cutlist_noUNK into rows of max_length positions, see BertCWS.
     """
     def __init__(self, device, config, vocab_file, max_length, num_CWStags=6, num_POStags=110, batch_size=64, fclassifier='Softmax', pclassifier='CRF', method='fine_tune'):
         super(BertCWSPOS, self).__init__(config)
@@ -655,59 +1094,41 @@ class BertCWSPOS(BertVariantCWSPOS):
         self.tokenizer = FullTokenizer(
                 vocab_file=vocab_file, do_lower_case=True)
         self.max_length = max_length
+        self.chunk_cache = None # see set_chunk_cache
+        self.input_buffers = None # see src/inference_session.py
+        self.pack_sequences = False
 
 
-    def _seg_wordslist(self, lword):  # ->str
+    def _seg_wordslist(self, lword, max_length=None):  # ->str
         # lword: list of words (list)
-        # input_ids, segment_ids, input_mask = tokenize_list(
-        #     words, self.max_length, self.tokenizer)
-        input_ids, segment_ids, input_masks = zip(
-            *[tokenize_list(w, self.max_length, self.tokenizer) for w in lword])
-            #*[tokenize_list_no_seg(w, self.max_length, self.tokenizer) for w in lword])
-
-        input_id_torch = torch.from_numpy(np.array(input_ids)).to(self.device)
-        segment_ids_torch = torch.from_numpy(np.array(segment_ids)).to(self.device)
-        input_masks_torch = torch.from_numpy(np.array(input_masks)).to(self.device)
-
-        _, _, best_cws_tags_list, best_pos_tags_list = self.decode(input_id_torch, segment_ids_torch, input_masks_torch)
+        # max_length: length to pad the batch to, default: self.max_length
+        if max_length is None: max_length = self.max_length
 
-        cws_output_list = []
-        for rs in best_cws_tags_list:
-            cws_decode_output = ''.join(str(v) for v in rs[1:-1]) #
-
-            # tmp_rs[1:-1]: remove the tokens, [START] and [END]
-            #decode_output = tmp_rs[1:-1]
-
-            # Now decode_output should consists of the tokens corresponding to B, M, E, S, [START], [END],
-            # i.e, BMES_idx_to_label_map = {0: 'B', 1: 'M', 2: 'E', 3: 'S', 4: '[START]', 5: '[END]'}
-            # i.e., BMES_idx_to_label_map = {0: '[START]', 1: '[END]', 2: 'B', 3: 'M', 4: 'E', 5: 'S'}
-
-            # replace the [START] and [END] tokens
-            # predict those wrong tokens as a separated word
-            # replacing 0 and 1 should not be conducted usually
-            cws_decode_output = cws_decode_output.replace(str(segType.BMES_label_map['[START]']), str(segType.BMES_label_map['S']))
-            cws_decode_output = cws_decode_output.replace(str(segType.BMES_label_map['[END]']), str(segType.BMES_label_map['S']))
-
-            cws_output_list.append(cws_decode_output)
-
-        pos_output_list = []
-        for rs in best_pos_tags_list:
-            pos_decode_output = ' '.join(posType.POS_label_map[(v-2)//3] if v > 2 else posType.POS_label_map[35] for v in rs[1:-1]) #
+        if self.pack_sequences and max_length <= self.max_length:
+            best_cws_tags_list, best_pos_tags_list = decode_packed_wordslist(self, lword, max_length, num_outputs=2)
+        else:
+            # input_ids, segment_ids, input_mask = tokenize_list(
+            #     words, self.max_length, self.tokenizer)
+            input_ids, segment_ids, input_masks = zip(
+                *[tokenize_list(w, max_length, self.tokenizer) for w in lword])
+                #*[tokenize_list_no_seg(w, self.max_length, self.tokenizer) for w in lword])
 
-            # tmp_rs[1:-1]: remove the tokens, [START] and [END]
-            #decode_output = tmp_rs[1:-1]
+            input_id_torch = to_input_tensor(self, 'input_ids', input_ids)
+            segment_ids_torch = to_input_tensor(self, 'segment_ids', segment_ids)
+            input_masks_torch = to_input_tensor(self, 'input_masks', input_masks)
 
-            # Now decode_output should consists of the tokens in POSType.BIO_idx_to_label_map
+            _, _, best_cws_tags_list, best_pos_tags_list = self.decode(input_id_torch, segment_ids_torch, input_masks_torch)
 
-            # replace the [START] and [END] tokens ??
-            # predict those wrong tokens as a separated word
-            # replacing 0 and 1 should not be conducted usually
-            #decode_output = decode_output.replace(str(segType.BMES_label_map['[START]']), str(segType.BMES_label_map['S']))
-            #decode_output = decode_output.replace(str(segType.BMES_label_map['[END]']), str(segType.BMES_label_map['S']))
+        # rs[1:-1]: remove the tokens, [START] and [END]
+        # Now cws outputs consist of the tag ids in BMES_label_map = {0: '[START]', 1: '[END]', 2: 'B', 3: 'M', 4: 'E', 5: 'S'}
+        # replace the [START] and [END] tokens, i.e., predict those wrong tokens as a separated word
+        # replacing 0 and 1 should not be conducted usually
+        cws_output_list = [clean_cws_tags(rs[1:-1]) for rs in best_cws_tags_list]
 
-            pos_output_list.append(pos_decode_output)
+        # pos outputs are the indexes of POS_label_map, converted from the tags in POSType.BIO_idx_to_label_map
+        pos_output_list = [bio2pos_index(rs[1:-1]) for rs in best_pos_tags_list]
 
-        return cws_output_list, pos_output_list  # list of string
+        return cws_output_list, pos_output_list  # list of np.array
 
     def cutlist_noUNK(self, input_list):
         """
@@ -754,124 +1175,52 @@ class BertCWSPOS(BertVariantCWSPOS):
             merge_index_list.append(merge_index_tuple)
 
         original_text_list = processed_text_list
-        processed_text_list = [self.tokenizer.tokenize(
-            t) for t in processed_text_list]
 
-        cws_output_list = []
-        pos_output_list = []
-        tmp_pos_list = []
+        # decode chunks in buckets of similar lengths, each padded to its longest chunk only,
+        # while repeated chunks are read from the chunk cache
+        # the packed rows are filled up to max_length instead of the longest chunk of the bucket
+        seg_fn = (lambda lword, _: self._seg_wordslist(lword)) if self.pack_sequences else self._seg_wordslist
+        processed_text_list, offset_list, (cws_output_list, pos_output_list) = decode_chunks(original_text_list, \
+            lambda t: tokenize_with_offsets(self.tokenizer, t), seg_fn, self.batch_size, \
+            self.max_length, num_outputs=2, chunk_cache=self.chunk_cache, fingerprint=compute_model_fingerprint(self))
 
-        batch_size = self.batch_size
-        for p_t_l in [processed_text_list[0+i:batch_size+i] for i in range(0, len(processed_text_list), batch_size)]:
-            cws_output, pos_output = self._seg_wordslist(p_t_l)
-            cws_output_list.extend(cws_output)
-            pos_output_list.extend(pos_output)
-
-        # restoring processed_text_list to list of strings
-        #processed_text_list = [''.join(char_list) for char_list in processed_text_list]
+        # the words are sliced out of the text with the offsets of their tokens, including unknown tokens
         result_str_list = []
-
         for merge_start, merge_end in merge_index_list:
-            result_str = ''
-            original_str = ''
-            result_pos = '' # storing pos results
-
-            cws_tag = ''.join(cws_output_list[merge_start:merge_end])
-            pos_tag = ' '.join(pos_output_list[merge_start:merge_end]).split()
-
-            text = []
-            for a in processed_text_list[merge_start:merge_end]:
-                text.extend(a)
-
-            for a in original_text_list[merge_start:merge_end]:
-                str_used = ''
-                al = re.split('[\n\r]', a)
-
-                for aa in al: str_used += ''.join(aa.strip())
-
-                original_str += str_used
-
-            tmp_pos = []
-            seg_start = False
-            for idx in range(len(cws_tag)):
-                tt = text[idx]
-                tt = tt.replace('##', '')
-                ti = cws_tag[idx]
-                pos_tag_i = pos_tag[idx]
-
-                try:
-                    int(ti)
-                except ValueError:
-                    print(ti + '\n')      # or whatever
-                    print(cws_tag)
-
-                int_ti = int(ti)
-                if int_ti == segType.BMES_label_map['B']:  # 'B'
-                    result_str += ' ' + tt
-
-                    if not seg_start:
-                        seg_start = True
-
-                    if tmp_pos != []:
-                        tmp_pos_list.append(tmp_pos)
-
-                    result_pos += pos_tag_i + ' '
-                    tmp_pos = [pos_tag_i]
-                elif int_ti > segType.BMES_label_map['M']:  # and (cur_word_is_english)
-                    # int(ti)>1: tokens of 'E' and 'S'
-                    # current word is english
-                    result_str += tt + ' '
-
-                    #if int_ti == segType.BMES_label_map['S']:
-                    #    result_pos += pos_tag_i + ' '
-                    #    tmp_pos = []
-
-                    #    tmp_pos_list.append([pos_tag_i])
-                    #else:
-                    if tmp_pos == []:
-                        result_pos += pos_tag_i + ' '
-
-                    tmp_pos.extend([pos_tag_i])
-                    tmp_pos_list.append(tmp_pos)
-                    tmp_pos = []
-
-                    seg_start = False
-                else:
-                    result_str += tt
-                    tmp_pos.append(pos_tag_i)
-                    if not seg_start:
-                        seg_start = True
-                        result_pos += pos_tag_i + ' '
-
-            result_pos_str = extract_pos(tmp_pos_list)
-
-            if '[UNK]' in result_str or '[unused' in result_str:
-                seg_ls, pos_ls = restore_unknown_tokens_with_pos(original_str, result_str, result_pos)
-            else:
-                seg_ls = result_str.strip().split()
-                pos_ls = result_pos.strip().split()
-
-            #seg_ls = result_str_rev.strip().split()
-            #pos_ls = result_pos_rev.strip().split()
-            assert(len(seg_ls)==len(pos_ls))
+            chunk_list = original_text_list[merge_start:merge_end]
+            word_spans, word_pos = tags_to_spans(chunk_list, offset_list[merge_start:merge_end], \
+                cws_output_list[merge_start:merge_end], pos_output_list[merge_start:merge_end])
+            seg_ls, pos_ls = spans_to_words(''.join(chunk_list), word_spans, word_pos.tolist())
 
             rs = []
             for i in range(len(seg_ls)):
-                rs.append(seg_ls[i] + ' / ' + pos_ls[i])
+                rs.append(seg_ls[i] + ' / ' + posType.POS_label_map[pos_ls[i]])
 
             result_str_list.append(rs)
 
         return result_str_list
 
+    def segment_stream(self, input_iter, window_size=None):
+        """Streaming version of cutlist_noUNK, see segment_text_stream."""
+        return segment_text_stream(self, input_iter, window_size)
+
+    def cutlist_long(self, input_list, window_size=None, stride=None):
+        """
+        Long-document version of cutlist_noUNK with overlapping windows of up to max_position_embeddings-2 tokens,
+        see cutlist_long_documents. window_size: default = max_position_embeddings-2; stride: default = window_size//2.
+        """
+        return cutlist_long_documents(self, input_list, window_size, stride, whole_word=False, with_pos=True)
+
 
 class BertMLEmbeddings(nn.Module):
     """Construct the embeddings from word, position and token_type embeddings for multilinguisticss
     """
-    def __init__(self, config, update_method='mean', speedup=True):
+    def __init__(self, config, update_method='mean', speedup=True, embedding_bag=True):
         super(BertMLEmbeddings, self).__init__()
         self.hidden_size = config.hidden_size
         self.update_method = update_method
         self.speedup = speedup
+        self.embedding_bag = embedding_bag # see extract_embedding_bag
         self.word_embeddings = nn.Embedding(config.vocab_size, config.hidden_size)
         self.position_embeddings = nn.Embedding(config.max_position_embeddings, config.hidden_size)
         self.token_type_embeddings = nn.Embedding(config.type_vocab_size, config.hidden_size)
@@ -888,7 +1237,11 @@ class BertMLEmbeddings(nn.Module):
         if token_type_ids is None:
             token_type_ids = torch.zeros_like(input_ids)
 
-        if self.speedup:
+        if token_ids is not None and token_ids.dim() == 2: # ragged, see stack_csr in src/preprocess.py
+            words_embeddings = self.extract_embedding_csr(token_ids, cand_indexes)
+        elif self.speedup and self.embedding_bag:
+            words_embeddings = self.extract_embedding_bag(token_ids, attention_mask, cand_indexes)
+        elif self.speedup:
             words_embeddings = self.extract_embedding_speed(token_ids, attention_mask, cand_indexes)
         else:
             words_embeddings = self.extract_embedding(token_ids, attention_mask, cand_indexes)
@@ -933,6 +1286,46 @@ class BertMLEmbeddings(nn.Module):
 
         return words_embeddings
 
+    def extract_embedding_bag(self, token_ids, attention_mask=None, cand_indexes=None):
+        # same mean of the subword embeddings of each word as extract_embedding_speed, but reduced by embedding_bag
+        # from the flat subword ids and the offsets of the words, so that no tensor of
+        # [batch_size, max_seq_len, max_chunk_per_word, hidden_size] is materialized
+        if token_ids is None: # cand_indexes is None and
+            raise RuntimeError('Input: cand_indexes or token_ids should not be None!')
+
+        batch_size, max_seq_len, max_chunk_per_word = token_ids.shape
+        token_ids_2d = token_ids.reshape(batch_size*max_seq_len, max_chunk_per_word)
+        cand_mask = token_ids_2d.ge(1)
+
+        # the subwords of a word are contiguous in the row-major order of the masked ids
+        bag_sizes = cand_mask.sum(1)
+        offsets = torch.cumsum(bag_sizes, 0) - bag_sizes
+        flat_token_ids = torch.masked_select(token_ids_2d, cand_mask)
+
+        # empty bags, i.e., padded words, are zeros, as the NaNs replaced in extract_embedding_speed
+        words_embeddings = F.embedding_bag(flat_token_ids, self.word_embeddings.weight, offsets, mode='mean')
+
+        return words_embeddings.view(batch_size, max_seq_len, -1)
+
+    def extract_embedding_csr(self, token_ids, cand_offsets):
+        # token_ids: the subword ids of each sentence padded by 0, [batch_size, max_subwords]
+        # cand_offsets: the offset of each word in its row of token_ids, [batch_size, max_seq_len+1], the last column
+        #   is the number of subword ids of the row, the padded words are empty
+        if cand_offsets is None:
+            raise RuntimeError('Input: cand_indexes, i.e., the offsets of the words, should not be None!')
+
+        batch_size, max_seq_len = cand_offsets.size(0), cand_offsets.size(1)-1
+        row_lens = cand_offsets[:, -1]
+
+        # drop the padding of the rows and shift the offsets of each row by the start of the row
+        valid = torch.arange(token_ids.size(1), device=token_ids.device).unsqueeze(0) < row_lens.unsqueeze(1)
+        row_starts = torch.cumsum(row_lens, 0) - row_lens
+        offsets = cand_offsets[:, :-1] + row_starts.unsqueeze(1)
+
+        words_embeddings = F.embedding_bag(token_ids[valid], self.word_embeddings.weight, offsets.reshape(-1), mode='mean')
+
+        return words_embeddings.view(batch_size, max_seq_len, -1)
+
     def extract_embedding(self, token_ids, attention_mask=None, cand_indexes=None):
         if token_ids is None: # cand_indexes is None and
             raise RuntimeError('Input: cand_indexes or token_ids should not be None!')
@@ -1020,6 +1413,13 @@ class BertMLModel(PreTrainedBertModel):
             input sequence length in the current batch. It's the mask that we typically use for attention when
             a batch has varying length sentences.
         `output_all_encoded_layers`: boolean which controls the content of the `encoded_layers` output as described below. Default: `True`.
+        `cand_indexes`, `token_ids`: the subword ids of each word, either
+            - dense: both torch.LongTensor of [batch_size, sequence_length, MAX_SUBWORDS] padded with 0,
+                see indexes2nparray, or
+            - ragged: `token_ids` holds the subword ids of each sentence, [batch_size, num_subwords] padded with 0,
+                and `cand_indexes` the offsets of the words in them, [batch_size, sequence_length+1],
+                see indexes2csr and stack_csr.
+        `output_layers`, `layer_reduction`, `layer_transform`: only retain the outputs of some layers, see BertModel.
 
     Outputs: Tuple of (encoded_layers, pooled_output)
         `encoded_layers`: controled by `output_all_encoded_layers` argument:
@@ -1056,7 +1456,7 @@ class BertMLModel(PreTrainedBertModel):
         self.apply(self.init_bert_weights)
 
     def forward(self, input_ids, token_type_ids=None, attention_mask=None, output_all_encoded_layers=True, \
-                cand_indexes=None, token_ids=None):
+                cand_indexes=None, token_ids=None, output_layers=None, layer_reduction=None, layer_transform=None):
         if attention_mask is None:
             attention_mask = torch.ones_like(input_ids)
         if token_type_ids is None:
@@ -1079,6 +1479,11 @@ class BertMLModel(PreTrainedBertModel):
 
         embedding_output = self.embeddings(input_ids, token_type_ids, attention_mask, cand_indexes, token_ids)
 
+        if output_layers is not None: # see BertModel
+            encoded_layers, sequence_output = self.encoder(embedding_output, extended_attention_mask, \
+                output_layers=output_layers, layer_reduction=layer_reduction, layer_transform=layer_transform)
+            return encoded_layers, self.pooler(sequence_output)
+
         encoded_layers = self.encoder(embedding_output,
                                       extended_attention_mask,
                                       output_all_encoded_layers=output_all_encoded_layers)
@@ -1129,6 +1534,7 @@ class BertMLVariantCWSPOS(PreTrainedBertModel):
             last_hidden_size = self.config.hidden_size*2
         elif self.method == 'MHMLA':
             self.MHMLA = MultiHeadMultiLayerAttention(config)
+            last_hidden_size = self.config.hidden_size
 
         # Maps the output of BERT into tag space.
         self.hidden2CWStag = nn.Linear(last_hidden_size, num_CWStags)
@@ -1140,6 +1546,10 @@ class BertMLVariantCWSPOS(PreTrainedBertModel):
         if self.pclassifier == 'CRF':
             self.POSclassifier = CRF(num_POStags, batch_first=True)
 
+        # the allowed tags of the Softmax decoding, see use_transition_constraints
+        self.CWS_constraints = None
+        self.POS_constraints = None
+
         self.apply(self.init_bert_weights)
 
     def forward(self, input_ids, token_type_ids=None, attention_mask=None, cand_indexes=None, token_ids=None,
@@ -1182,12 +1592,12 @@ class BertMLVariantCWSPOS(PreTrainedBertModel):
         if self.fclassifier == 'CRF':
             best_cws_tags_list = self.CWSclassifier.decode(cws_logits, mask)
         elif self.fclassifier == 'Softmax':
-            best_cws_tags_list = self._decode_Softmax(cws_logits, mask)
+            best_cws_tags_list = self._decode_Softmax(cws_logits, mask, self.CWS_constraints)
 
         if self.pclassifier == 'CRF':
             best_pos_tags_list = self.POSclassifier.decode(pos_logits, mask)
         elif self.pclassifier == 'Softmax':
-            best_pos_tags_list = self._decode_Softmax(pos_logits, mask)
+            best_pos_tags_list = self._decode_Softmax(pos_logits, mask, self.POS_constraints)
 
         return cws_loss, pos_loss, best_cws_tags_list, best_pos_tags_list
 
@@ -1201,22 +1611,14 @@ class BertMLVariantCWSPOS(PreTrainedBertModel):
             if cand_indexes is None and token_ids is None:
                 raise RuntimeError('Input: cand_indexes and token_ids are missing!')
 
+        output_layers, layer_reduction = LAYER_SELECTION.get(self.method, (None, None))
         sequence_output, _ = self.bert(input_ids, token_type_ids, attention_mask, \
                    output_all_encoded_layers=output_all_encoded_layers, \
-                   cand_indexes=cand_indexes, token_ids=token_ids)
-
-        if self.method == 'sum_last4':
-            feat_used = self.dropout(sequence_output[-1])
-            for l in range(-2, -5, -1):
-                feat_used += self.dropout(sequence_output[l])
-        elif self.method == 'sum_all':
-            feat_used = self.dropout(sequence_output[-1])
-            for l in range(-2, -13, -1):
-                feat_used += self.dropout(sequence_output[l])
-        elif self.method == 'cat_last4':
-            feat_used = self.dropout(sequence_output[-4])
-            for l in range(-3, 0):
-                feat_used = torch.cat((feat_used, self.dropout(sequence_output[l])), 2)
+                   cand_indexes=cand_indexes, token_ids=token_ids, output_layers=output_layers, \
+                   layer_reduction=layer_reduction, layer_transform=self.dropout)
+
+        if self.method in LAYER_SELECTION: # the sum or the concat of the layers after dropout
+            feat_used = sequence_output
         elif self.method in ['last_layer', 'fine_tune']:
             feat_used = sequence_output
             feat_used = self.dropout(feat_used)
@@ -1250,8 +1652,10 @@ class BertMLVariantCWSPOS(PreTrainedBertModel):
 
         return loss
 
-    def _decode_Softmax(self, logits, mask):
-        # mask is a ByteTensor
+    def _decode_Softmax(self, logits, mask, constraints=None):
+        # mask is a ByteTensor; constraints: the allowed tags, see use_transition_constraints
+        if constraints is not None:
+            return constrained_argmax(logits, mask, constraints)
 
         batch_size, _ = mask.shape
 
@@ -1283,14 +1687,20 @@ class BertMLCWSPOS(BertMLVariantCWSPOS):
         self.tokenizer = BertTokenizer(
                 vocab_file=vocab_file, do_lower_case=do_lower_case)
         self.max_length = max_length
+        self.chunk_cache = None # see set_chunk_cache
+        self.input_buffers = None # see src/inference_session.py
 
-    def _seg_wordslist(self, lword):  # ->str
+    def _seg_wordslist(self, lword, max_length=None):  # ->str
         # lword: list of words (list)
+        # max_length: length to pad the batch to, default: self.max_length
+        if max_length is None: max_length = self.max_length
+
         # input_ids, segment_ids, input_mask = tokenize_list(
         #     words, self.max_length, self.tokenizer)
         #print(lword)
         tuple1, tuple2, tuple3 = zip(
-            *[tokenize_list_with_cand_indexes_lang_status(w, self.max_length, self.tokenizer) for w in lword if w]) # w is not empty
+            *[tokenize_list_with_cand_indexes_lang_status(w, max_length, self.tokenizer, ragged=True)
+              for w in lword if w]) # w is not empty
             #*[tokenize_list(w, self.max_length, self.tokenizer) for w in lword])
             #*[tokenize_list_no_seg(w, self.max_length, self.tokenizer) for w in lword])
         list1 = unpackTuple(tuple1)
@@ -1298,67 +1708,32 @@ class BertMLCWSPOS(BertMLVariantCWSPOS):
         segment_ids = list1[1::3]
         input_masks = list1[2::3]
 
-        list2 = unpackTuple(tuple2)
-        cand_indexes = list2[0::2]
-        token_ids = list2[1::2]
+        # the offsets of the words and the subword ids of the batch, see stack_csr
+        cand_indexes, token_ids = stack_csr(tuple2)
 
         lang_status = unpackTuple(tuple3)
         #lang_status = list3[0::]
 
-        input_id_torch = torch.from_numpy(np.array(input_ids)).to(self.device)
-        segment_ids_torch = torch.from_numpy(np.array(segment_ids)).to(self.device)
-        input_masks_torch = torch.from_numpy(np.array(input_masks)).to(self.device)
-        cand_indexes_troch = torch.from_numpy(np.array(cand_indexes)).to(self.device)
-        token_ids_torch = torch.from_numpy(np.array(token_ids)).to(self.device)
-        lang_status_torch = torch.from_numpy(np.array(lang_status)).to(self.device)
+        input_id_torch = to_input_tensor(self, 'input_ids', input_ids)
+        segment_ids_torch = to_input_tensor(self, 'segment_ids', segment_ids)
+        input_masks_torch = to_input_tensor(self, 'input_masks', input_masks)
+        cand_indexes_troch = to_input_tensor(self, 'cand_indexes', cand_indexes)
+        token_ids_torch = to_input_tensor(self, 'token_ids', token_ids)
 
         _, _, best_cws_tags_list, best_pos_tags_list = self.decode(input_id_torch, segment_ids_torch, \
                                            input_masks_torch, cand_indexes_troch, token_ids_torch)
 
-        cws_output_list = []
-        for idx, rs in enumerate(best_cws_tags_list):
-            cws_decode_output = ''.join(str(v) for v in rs[1:-1]) #
-
-            # tmp_rs[1:-1]: remove the tokens, [START] and [END]
-            #decode_output = tmp_rs[1:-1]
-
-            # Now decode_output should consists of the tokens corresponding to B, M, E, S, [START], [END],
-            # i.e, BMES_idx_to_label_map = {0: 'B', 1: 'M', 2: 'E', 3: 'S', 4: '[START]', 5: '[END]'}
-            # i.e., BMES_idx_to_label_map = {0: '[START]', 1: '[END]', 2: 'B', 3: 'M', 4: 'E', 5: 'S'}
-
-            # replace the [START] and [END] tokens
-            # predict those wrong tokens as a separated word
-            # replacing 0 and 1 should not be conducted usually
-            cws_decode_output = cws_decode_output.replace(str(segType.BMES_label_map['[START]']), str(segType.BMES_label_map['S']))
-            cws_decode_output = cws_decode_output.replace(str(segType.BMES_label_map['[END]']), str(segType.BMES_label_map['S']))
-
-            if 1:
-                lang_status_i = lang_status_torch[idx]
-                cws_decode_output_l = list(cws_decode_output)
-                for ii, ls_ii in enumerate(lang_status_i):
-                    if ls_ii==1: cws_decode_output_l[ii] = str(segType.BMES_label_map['S'])
-                cws_decode_output = ''.join(cws_decode_output_l)
+        # rs[1:-1]: remove the tokens, [START] and [END]
+        # Now cws outputs consist of the tag ids in BMES_label_map = {0: '[START]', 1: '[END]', 2: 'B', 3: 'M', 4: 'E', 5: 'S'}
+        # replace the [START] and [END] tokens, i.e., predict those wrong tokens as a separated word
+        # replacing 0 and 1 should not be conducted usually
+        # english words are separated words
+        cws_output_list = [clean_cws_tags(rs[1:-1], lang_status[idx]) for idx, rs in enumerate(best_cws_tags_list)]
 
-            cws_output_list.append(cws_decode_output)
+        # pos outputs are the indexes of POS_label_map, converted from the tags in POSType.BIO_idx_to_label_map
+        pos_output_list = [bio2pos_index(rs[1:-1]) for rs in best_pos_tags_list]
 
-        pos_output_list = []
-        for rs in best_pos_tags_list:
-            pos_decode_output = ' '.join(posType.POS_label_map[(v-2)//3] if v > 2 else posType.POS_label_map[35] for v in rs[1:-1]) #
-
-            # tmp_rs[1:-1]: remove the tokens, [START] and [END]
-            #decode_output = tmp_rs[1:-1]
-
-            # Now decode_output should consists of the tokens in POSType.BIO_idx_to_label_map
-
-            # replace the [START] and [END] tokens ??
-            # predict those wrong tokens as a separated word
-            # replacing 0 and 1 should not be conducted usually
-            #decode_output = decode_output.replace(str(segType.BMES_label_map['[START]']), str(segType.BMES_label_map['S']))
-            #decode_output = decode_output.replace(str(segType.BMES_label_map['[END]']), str(segType.BMES_label_map['S']))
-
-            pos_output_list.append(pos_decode_output)
-
-        return cws_output_list, pos_output_list  # list of string
+        return cws_output_list, pos_output_list  # list of np.array
 
     def cutlist_noUNK(self, input_list):
         """
@@ -1404,130 +1779,46 @@ class BertMLCWSPOS(BertMLVariantCWSPOS):
             merge_index_list.append(merge_index_tuple)
 
         original_text_list = processed_text_list
-        processed_text_list = [self.tokenizer.tokenize(t) if len(self.tokenizer.tokenize(t))>0 \
-                               else ['[UNK]'] for t in processed_text_list]
-
-        cws_output_list = []
-        pos_output_list = []
-        tmp_pos_list = []
-
-        batch_size = self.batch_size
-        for p_t_l in [processed_text_list[0+i:batch_size+i] for i in range(0, len(processed_text_list), batch_size)]:
-            #print(p_t_l)
-            #if '翡翠' in ''.join(p_t_l[0]):
-            #    print('test')
-            #if len(p_t_l)==0:
-            #    cws_output = segType.BMES_label_map['S']
-            #    pos_output = posType.POS2idx_map['PU']
-            #    continue # avoid input empty tokens
-
-            cws_output, pos_output = self._seg_wordslist(p_t_l)
-            cws_output_list.extend(cws_output)
-            pos_output_list.extend(pos_output)
-
-        # restoring processed_text_list to list of strings
-        #processed_text_list = [''.join(char_list) for char_list in processed_text_list]
-        result_str_list = []
 
-        for merge_start, merge_end in merge_index_list:
-            result_str = ''
-            original_str = ''
-            result_pos = '' # storing pos results
-
-            cws_tag = ''.join(cws_output_list[merge_start:merge_end])
-            pos_tag = ' '.join(pos_output_list[merge_start:merge_end]).split()
-
-            text = []
-            for a in processed_text_list[merge_start:merge_end]:
-                cand_indexes = define_words_set(a)
-
-                for idx_ls in cand_indexes:
-                    pa = ''
-                    for idx in idx_ls:
-                        pa += a[idx].replace('##', '')
-                    text.append(pa)
-
-            for a in original_text_list[merge_start:merge_end]:
-                str_used = ''
-                al = re.split('[\n\r]', a)
-
-                for aa in al: str_used += ''.join(aa.strip())
-
-                original_str += str_used
-
-            tmp_pos = []
-            seg_start = False
-            for idx in range(len(cws_tag)):
-                tt = text[idx]
-                tt = tt.replace('##', '')
-                ti = cws_tag[idx]
-                pos_tag_i = pos_tag[idx]
-
-                try:
-                    int(ti)
-                except ValueError:
-                    print(ti + '\n')      # or whatever
-                    print(cws_tag)
-
-                int_ti = int(ti)
-                if int_ti == segType.BMES_label_map['B']:  # 'B'
-                    result_str += ' ' + tt
-
-                    if not seg_start:
-                        seg_start = True
-
-                    if tmp_pos != []:
-                        tmp_pos_list.append(tmp_pos)
-
-                    result_pos += pos_tag_i + ' '
-                    tmp_pos = [pos_tag_i]
-                elif int_ti > segType.BMES_label_map['M']:  # and (cur_word_is_english)
-                    # int(ti)>1: tokens of 'E' and 'S'
-                    # current word is english
-                    result_str += tt + ' '
-
-                    #if int_ti == segType.BMES_label_map['S']:
-                    #    result_pos += pos_tag_i + ' '
-                    #    tmp_pos = []
-
-                    #    tmp_pos_list.append([pos_tag_i])
-                    #else:
-                    if tmp_pos == []:
-                        result_pos += pos_tag_i + ' '
-
-                    tmp_pos.extend([pos_tag_i])
-                    tmp_pos_list.append(tmp_pos)
-                    tmp_pos = []
-
-                    seg_start = False
-                else:
-                    result_str += tt
-                    tmp_pos.append(pos_tag_i)
-                    if not seg_start:
-                        seg_start = True
-                        result_pos += pos_tag_i + ' '
+        # decode chunks in buckets of similar lengths, each padded to its longest chunk only,
+        # while repeated chunks are read from the chunk cache
+        processed_text_list, offset_list, (cws_output_list, pos_output_list) = decode_chunks(original_text_list, \
+            lambda t: tokenize_with_offsets(self.tokenizer, t, unk_if_empty=True), self._seg_wordslist, self.batch_size, \
+            self.max_length, num_outputs=2, chunk_cache=self.chunk_cache, fingerprint=compute_model_fingerprint(self))
 
-            result_pos_str = extract_pos(tmp_pos_list)
+        # the words are sliced out of the text with the offsets of their tokens, including unknown tokens
+        result_str_list = []
+        for merge_start, merge_end in merge_index_list:
+            chunk_list = original_text_list[merge_start:merge_end]
 
-            if '[UNK]' in result_str or '[unused' in result_str:
-                print(original_str)
-                seg_ls, pos_ls = restore_unknown_tokens_without_unused_with_pos(original_str, result_str, result_pos)
-            else:
-                seg_ls = result_str.strip().split()
-                pos_ls = result_pos.strip().split()
+            # the tags are predicted for whole words
+            word_offset_list = []
+            for a, offsets in zip(processed_text_list[merge_start:merge_end], offset_list[merge_start:merge_end]):
+                word_offset_list.append([(offsets[idx_ls[0]][0], offsets[idx_ls[-1]][1]) for idx_ls in define_words_set(a)])
 
-            #seg_ls = result_str_rev.strip().split()
-            #pos_ls = result_pos_rev.strip().split()
-            assert(len(seg_ls)==len(pos_ls))
+            word_spans, word_pos = tags_to_spans(chunk_list, word_offset_list, \
+                cws_output_list[merge_start:merge_end], pos_output_list[merge_start:merge_end])
+            seg_ls, pos_ls = spans_to_words(''.join(chunk_list), word_spans, word_pos.tolist())
 
             rs = []
             for i in range(len(seg_ls)):
-                rs.append(seg_ls[i] + ' / ' + pos_ls[i])
+                rs.append(seg_ls[i] + ' / ' + posType.POS_label_map[pos_ls[i]])
 
             result_str_list.append(rs)
 
         return result_str_list
 
+    def segment_stream(self, input_iter, window_size=None):
+        """Streaming version of cutlist_noUNK, see segment_text_stream."""
+        return segment_text_stream(self, input_iter, window_size)
+
+    def cutlist_long(self, input_list, window_size=None, stride=None):
+        """
+        Long-document version of cutlist_noUNK with overlapping windows of up to max_position_embeddings-2 tokens,
+        see cutlist_long_documents. window_size: default = max_position_embeddings-2; stride: default = window_size//2.
+        """
+        return cutlist_long_documents(self, input_list, window_size, stride, whole_word=True, with_pos=True)
+
 
 class BertMLVariantCWSPOS_with_Dict(BertMLVariantCWSPOS):
     """Apply BERT for Sequence Labeling on Chinese Word Segmentation and Part-of-Speech with multilinguistics
@@ -1576,6 +1867,10 @@ class BertMLVariantCWSPOS_with_Dict(BertMLVariantCWSPOS):
         if self.pclassifier == 'CRF':
             self.POSclassifier = CRF(num_POStags, batch_first=True)
 
+        # the allowed tags of the Softmax decoding, see use_transition_constraints
+        self.CWS_constraints = None
+        self.POS_constraints = None
+
         self.apply(self.init_bert_weights)
 
     def _set_last_hidden_size(self, method='fine_tune'):
@@ -1594,7 +1889,7 @@ class BertMLVariantCWSPOS_with_Dict(BertMLVariantCWSPOS):
                                   dropout=0, bidirectional=True)
             last_hidden_size = self.config.hidden_size*2 + (self.max_gram-1)*2
         elif self.method == 'MHMLA':
-            self.MHMLA = MultiHeadMultiLayerAttention(config)
+            self.MHMLA = MultiHeadMultiLayerAttention(self.config)
             last_hidden_size = self.config.hidden_size + (self.max_gram-1)*2
         return last_hidden_size
 
@@ -1638,17 +1933,60 @@ class BertMLVariantCWSPOS_with_Dict(BertMLVariantCWSPOS):
         if self.fclassifier == 'CRF':
             best_cws_tags_list = self.CWSclassifier.decode(cws_logits, mask)
         elif self.fclassifier == 'Softmax':
-            best_cws_tags_list = self._decode_Softmax(cws_logits, mask)
+            best_cws_tags_list = self._decode_Softmax(cws_logits, mask, self.CWS_constraints)
 
         if self.pclassifier == 'CRF':
             best_pos_tags_list = self.POSclassifier.decode(pos_logits, mask)
         elif self.pclassifier == 'Softmax':
-            best_pos_tags_list = self._decode_Softmax(pos_logits, mask)
+            best_pos_tags_list = self._decode_Softmax(pos_logits, mask, self.POS_constraints)
 
         return cws_loss, pos_loss, best_cws_tags_list, best_pos_tags_list
 
+    def decode_with_confidence(self, input_ids, token_type_ids=None, attention_mask=None, cand_indexes=None,
+                               token_ids=None, input_via_dict=None):
+        # the CWS and POS tags of decode, and the marginal probability of the tag of each token, see tag_confidences
+        mask = attention_mask.byte()
+        cws_logits, pos_logits = self.compute_logits(input_ids, token_type_ids, attention_mask, cand_indexes, \
+                                                     token_ids, input_via_dict)
+
+        if self.fclassifier == 'CRF':
+            best_cws_tags_list = self.CWSclassifier.decode(cws_logits, mask)
+            cws_classifier = self.CWSclassifier
+        elif self.fclassifier == 'Softmax':
+            best_cws_tags_list = self._decode_Softmax(cws_logits, mask, self.CWS_constraints)
+            cws_classifier = None
+
+        if self.pclassifier == 'CRF':
+            best_pos_tags_list = self.POSclassifier.decode(pos_logits, mask)
+            pos_classifier = self.POSclassifier
+        elif self.pclassifier == 'Softmax':
+            best_pos_tags_list = self._decode_Softmax(pos_logits, mask, self.POS_constraints)
+            pos_classifier = None
+
+        cws_confidences = tag_confidences(cws_logits, mask, best_cws_tags_list, cws_classifier, self.CWS_constraints)
+        pos_confidences = tag_confidences(pos_logits, mask, best_pos_tags_list, pos_classifier, self.POS_constraints)
+
+        return best_cws_tags_list, best_pos_tags_list, cws_confidences, pos_confidences
+
+    def compute_logits(self, input_ids, token_type_ids=None, attention_mask=None, cand_indexes=None, token_ids=None,
+                       input_via_dict=None, return_encoded_layers=False):
+        # emissions of the CWS and POS heads, and the outputs of all the encoder layers if return_encoded_layers,
+        # e.g., the targets of distillation, see src/distillation.py
+        feat_used = self._compute_bert_feats(input_ids, token_type_ids, attention_mask, cand_indexes, token_ids, \
+                            input_via_dict, return_encoded_layers=return_encoded_layers)
+        if return_encoded_layers:
+            feat_used, encoded_layers = feat_used
+
+        cws_logits = self.hidden2CWStag(feat_used)
+        pos_logits = self.hidden2POStag(feat_used)
+
+        if return_encoded_layers:
+            return cws_logits, pos_logits, encoded_layers
+
+        return cws_logits, pos_logits
+
     def _compute_bert_feats(self, input_ids, token_type_ids=None, attention_mask=None, cand_indexes=None, token_ids=None, \
-                            input_via_dict=None):
+                            input_via_dict=None, return_encoded_layers=False):
         if self.method in ['last_layer', 'fine_tune']:
             output_all_encoded_layers = False
         else: # sum_last4, sum_all, cat_last4, 'MHMLA'
@@ -1658,21 +1996,23 @@ class BertMLVariantCWSPOS_with_Dict(BertMLVariantCWSPOS):
             if cand_indexes is None and token_ids is None:
                 raise RuntimeError('Input: cand_indexes and token_ids are missing!')
 
+        # all the layers are needed by return_encoded_layers
+        output_layers, layer_reduction = LAYER_SELECTION.get(self.method, (None, None)) \
+            if not return_encoded_layers else (None, None)
         sequence_output, _ = self.bert(input_ids, token_type_ids, attention_mask, cand_indexes=cand_indexes,
-                               token_ids=token_ids, output_all_encoded_layers=output_all_encoded_layers)
-
-        if self.method == 'sum_last4':
-            feat_used = self.dropout(sequence_output[-1])
-            for l in range(-2, -5, -1):
-                feat_used += self.dropout(sequence_output[l])
-        elif self.method == 'sum_all':
-            feat_used = self.dropout(sequence_output[-1])
-            for l in range(-2, -13, -1):
-                feat_used += self.dropout(sequence_output[l])
-        elif self.method == 'cat_last4':
-            feat_used = self.dropout(sequence_output[-4])
-            for l in range(-3, 0):
-                feat_used = torch.cat((feat_used, self.dropout(sequence_output[l])), 2)
+                               token_ids=token_ids, output_all_encoded_layers=output_all_encoded_layers or return_encoded_layers,
+                               output_layers=output_layers, layer_reduction=layer_reduction, layer_transform=self.dropout)
+
+        encoded_layers = sequence_output
+        if return_encoded_layers and not output_all_encoded_layers:
+            sequence_output = encoded_layers[-1]
+        elif return_encoded_layers and self.method in LAYER_SELECTION:
+            output_layers, layer_reduction = LAYER_SELECTION[self.method]
+            retained = [self.dropout(encoded_layers[l]) for l in range(len(encoded_layers))[output_layers]]
+            sequence_output = sum(retained) if layer_reduction == 'sum' else torch.cat(retained, 2)
+
+        if self.method in LAYER_SELECTION: # the sum or the concat of the layers after dropout
+            feat_used = sequence_output
         elif self.method in ['last_layer', 'fine_tune']:
             feat_used = sequence_output
             feat_used = self.dropout(feat_used)
@@ -1686,6 +2026,9 @@ class BertMLVariantCWSPOS_with_Dict(BertMLVariantCWSPOS):
             input_via_dict = input_via_dict.to(dtype=next(self.parameters()).dtype)
             feat_used = torch.cat((feat_used, input_via_dict), 2)
 
+        if return_encoded_layers:
+            return feat_used, encoded_layers
+
         return feat_used
 
 
@@ -1710,17 +2053,23 @@ class BertMLCWSPOS_with_Dict(BertMLVariantCWSPOS_with_Dict):
         self.tokenizer = BertTokenizer(
                 vocab_file=vocab_file, do_lower_case=do_lower_case)
         self.max_length = max_length
+        self.chunk_cache = None # see set_chunk_cache
+        self.input_buffers = None # see src/inference_session.py
 
         #if dict_file is not None:
         #    self.dict_mat = torch.zeros((max_length, (self.max_gram-1)*2), device=device)
 
-    def _seg_wordslist(self, lword):  # ->str
+    def _seg_wordslist(self, lword, max_length=None, with_confidence=False):  # ->str
         # lword: list of words (list)
+        # max_length: length to pad the batch to, default: self.max_length
+        # with_confidence: also return the marginal probabilities of the CWS and POS tags, see decode_with_confidence
+        if max_length is None: max_length = self.max_length
+
         # input_ids, segment_ids, input_mask = tokenize_list(
         #     words, self.max_length, self.tokenizer)
         #print(lword)
         tuple1, tuple2, tuple3, input_via_dict = zip(
-            *[tokenize_list_with_cand_indexes_lang_status_dict_vec(w, self.max_length, self.tokenizer, self.dict)
+            *[tokenize_list_with_cand_indexes_lang_status_dict_vec(w, max_length, self.tokenizer, self.dict, ragged=True)
               for w in lword if w]) # , self.dict_mat
             #*[tokenize_list_with_cand_indexes_lang_status(w, self.max_length, self.tokenizer) for w in lword if w]) # w is not empty
             #*[tokenize_list(w, self.max_length, self.tokenizer) for w in lword])
@@ -1730,69 +2079,43 @@ class BertMLCWSPOS_with_Dict(BertMLVariantCWSPOS_with_Dict):
         segment_ids = list1[1::3]
         input_masks = list1[2::3]
 
-        list2 = unpackTuple(tuple2)
-        cand_indexes = list2[0::2]
-        token_ids = list2[1::2]
+        # the offsets of the words and the subword ids of the batch, see stack_csr
+        cand_indexes, token_ids = stack_csr(tuple2)
 
         lang_status = unpackTuple(tuple3)
         input_via_dict = unpackTuple(input_via_dict)
         #lang_status = list3[0::]
 
-        input_id_torch = torch.from_numpy(np.array(input_ids)).to(self.device)
-        segment_ids_torch = torch.from_numpy(np.array(segment_ids)).to(self.device)
-        input_masks_torch = torch.from_numpy(np.array(input_masks)).to(self.device)
-        cand_indexes_troch = torch.from_numpy(np.array(cand_indexes)).to(self.device)
-        token_ids_torch = torch.from_numpy(np.array(token_ids)).to(self.device)
-        lang_status_torch = torch.from_numpy(np.array(lang_status)).to(self.device)
-        input_via_dict_torch = torch.from_numpy(np.array(input_via_dict)).to(self.device)
-
-        _, _, best_cws_tags_list, best_pos_tags_list = self.decode(input_id_torch, segment_ids_torch, \
+        input_id_torch = to_input_tensor(self, 'input_ids', input_ids)
+        segment_ids_torch = to_input_tensor(self, 'segment_ids', segment_ids)
+        input_masks_torch = to_input_tensor(self, 'input_masks', input_masks)
+        cand_indexes_troch = to_input_tensor(self, 'cand_indexes', cand_indexes)
+        token_ids_torch = to_input_tensor(self, 'token_ids', token_ids)
+        input_via_dict_torch = to_input_tensor(self, 'input_via_dict', input_via_dict)
+
+        if with_confidence:
+            best_cws_tags_list, best_pos_tags_list, cws_confidences, pos_confidences = self.decode_with_confidence( \
+                input_id_torch, segment_ids_torch, input_masks_torch, cand_indexes_troch, token_ids_torch, \
+                input_via_dict_torch)
+        else:
+            _, _, best_cws_tags_list, best_pos_tags_list = self.decode(input_id_torch, segment_ids_torch, \
                                            input_masks_torch, cand_indexes_troch, token_ids_torch, input_via_dict_torch)
 
-        cws_output_list = []
-        for idx, rs in enumerate(best_cws_tags_list):
-            cws_decode_output = ''.join(str(v) for v in rs[1:-1]) #
-
-            # tmp_rs[1:-1]: remove the tokens, [START] and [END]
-            #decode_output = tmp_rs[1:-1]
+        # rs[1:-1]: remove the tokens, [START] and [END]
+        # Now cws outputs consist of the tag ids in BMES_label_map = {0: '[START]', 1: '[END]', 2: 'B', 3: 'M', 4: 'E', 5: 'S'}
+        # replace the [START] and [END] tokens, i.e., predict those wrong tokens as a separated word
+        # replacing 0 and 1 should not be conducted usually
+        # english words are separated words
+        cws_output_list = [clean_cws_tags(rs[1:-1], lang_status[idx]) for idx, rs in enumerate(best_cws_tags_list)]
 
-            # Now decode_output should consists of the tokens corresponding to B, M, E, S, [START], [END],
-            # i.e, BMES_idx_to_label_map = {0: 'B', 1: 'M', 2: 'E', 3: 'S', 4: '[START]', 5: '[END]'}
-            # i.e., BMES_idx_to_label_map = {0: '[START]', 1: '[END]', 2: 'B', 3: 'M', 4: 'E', 5: 'S'}
+        # pos outputs are the indexes of POS_label_map, converted from the tags in POSType.BIO_idx_to_label_map
+        pos_output_list = [bio2pos_index(rs[1:-1]) for rs in best_pos_tags_list]
 
-            # replace the [START] and [END] tokens
-            # predict those wrong tokens as a separated word
-            # replacing 0 and 1 should not be conducted usually
-            cws_decode_output = cws_decode_output.replace(str(segType.BMES_label_map['[START]']), str(segType.BMES_label_map['S']))
-            cws_decode_output = cws_decode_output.replace(str(segType.BMES_label_map['[END]']), str(segType.BMES_label_map['S']))
+        if with_confidence:
+            return cws_output_list, pos_output_list, [np.array(c[1:-1]) for c in cws_confidences], \
+                   [np.array(c[1:-1]) for c in pos_confidences]
 
-            if 1:
-                lang_status_i = lang_status_torch[idx]
-                cws_decode_output_l = list(cws_decode_output)
-                for ii, ls_ii in enumerate(lang_status_i):
-                    if ls_ii==1: cws_decode_output_l[ii] = str(segType.BMES_label_map['S'])
-                cws_decode_output = ''.join(cws_decode_output_l)
-
-            cws_output_list.append(cws_decode_output)
-
-        pos_output_list = []
-        for rs in best_pos_tags_list:
-            pos_decode_output = ' '.join(posType.POS_label_map[(v-2)//3] if v > 2 else posType.POS_label_map[35] for v in rs[1:-1]) #
-
-            # tmp_rs[1:-1]: remove the tokens, [START] and [END]
-            #decode_output = tmp_rs[1:-1]
-
-            # Now decode_output should consists of the tokens in POSType.BIO_idx_to_label_map
-
-            # replace the [START] and [END] tokens ??
-            # predict those wrong tokens as a separated word
-            # replacing 0 and 1 should not be conducted usually
-            #decode_output = decode_output.replace(str(segType.BMES_label_map['[START]']), str(segType.BMES_label_map['S']))
-            #decode_output = decode_output.replace(str(segType.BMES_label_map['[END]']), str(segType.BMES_label_map['S']))
-
-            pos_output_list.append(pos_decode_output)
-
-        return cws_output_list, pos_output_list  # list of string
+        return cws_output_list, pos_output_list  # list of np.array
 
     def cutlist_noUNK(self, input_list):
         """
@@ -1807,6 +2130,20 @@ class BertMLCWSPOS_with_Dict(BertMLVariantCWSPOS_with_Dict):
             models = BertCWS(config, num_tags, vocab_file, max_length)
             output = models.cutlist_noUNK([text])
         """
+        return self._cutlist(input_list)
+
+    def cutlist_with_confidence(self, input_list):
+        """
+        Same as cutlist_noUNK, each word comes with the confidence of its segmentation and of its POS, i.e.,
+        ('word / POS', cws_confidence, pos_confidence), see decode_with_confidence and word_confidences.
+
+        # Example usage:
+            output = models.cutlist_with_confidence(['目前由２３２位院士'])
+            # [[('目前 / NT', 0.98, 0.95), ('由 / P', 0.99, 0.97), ...]]
+        """
+        return self._cutlist(input_list, with_confidence=True)
+
+    def _cutlist(self, input_list, with_confidence=False):
         processed_text_list = []
         merge_index_list = []
         merge_index = 0
@@ -1838,126 +2175,57 @@ class BertMLCWSPOS_with_Dict(BertMLVariantCWSPOS_with_Dict):
             merge_index_list.append(merge_index_tuple)
 
         original_text_list = processed_text_list
-        processed_text_list = [self.tokenizer.tokenize(t) if len(self.tokenizer.tokenize(t))>0 \
-                               else ['[UNK]'] for t in processed_text_list]
-
-        cws_output_list = []
-        pos_output_list = []
-        tmp_pos_list = []
-
-        batch_size = self.batch_size
-        for p_t_l in [processed_text_list[0+i:batch_size+i] for i in range(0, len(processed_text_list), batch_size)]:
-            #print(p_t_l)
-            #if '翡翠' in ''.join(p_t_l[0]):
-            #    print('test')
-            #if len(p_t_l)==0:
-            #    cws_output = segType.BMES_label_map['S']
-            #    pos_output = posType.POS2idx_map['PU']
-            #    continue # avoid input empty tokens
-
-            cws_output, pos_output = self._seg_wordslist(p_t_l)
-            cws_output_list.extend(cws_output)
-            pos_output_list.extend(pos_output)
-
-        # restoring processed_text_list to list of strings
-        #processed_text_list = [''.join(char_list) for char_list in processed_text_list]
-        result_str_list = []
 
+        # decode chunks in buckets of similar lengths, each padded to its longest chunk only,
+        # while repeated chunks are read from the chunk cache
+        # the chunks decoded with confidences are cached apart
+        fingerprint = compute_model_fingerprint(self)
+        processed_text_list, offset_list, output_lists = decode_chunks(original_text_list, \
+            lambda t: tokenize_with_offsets(self.tokenizer, t, unk_if_empty=True), \
+            lambda lword, max_length: self._seg_wordslist(lword, max_length, with_confidence), self.batch_size, \
+            self.max_length, num_outputs=4 if with_confidence else 2, chunk_cache=self.chunk_cache, \
+            fingerprint=(fingerprint, 'confidence') if with_confidence else fingerprint)
+        cws_output_list, pos_output_list = output_lists[:2]
+
+        # the words are sliced out of the text with the offsets of their tokens, including unknown tokens
+        result_str_list = []
         for merge_start, merge_end in merge_index_list:
-            result_str = ''
-            original_str = ''
-            result_pos = '' # storing pos results
-
-            cws_tag = ''.join(cws_output_list[merge_start:merge_end])
-            pos_tag = ' '.join(pos_output_list[merge_start:merge_end]).split()
-
-            text = []
-            for a in processed_text_list[merge_start:merge_end]:
-                cand_indexes = define_words_set(a)
-
-                for idx_ls in cand_indexes:
-                    pa = ''
-                    for idx in idx_ls:
-                        pa += a[idx].replace('##', '')
-                    text.append(pa)
-
-            for a in original_text_list[merge_start:merge_end]:
-                str_used = ''
-                al = re.split('[\n\r]', a)
-
-                for aa in al: str_used += ''.join(aa.strip())
-
-                original_str += str_used
-
-            tmp_pos = []
-            seg_start = False
-            for idx in range(len(cws_tag)):
-                tt = text[idx]
-                tt = tt.replace('##', '')
-                ti = cws_tag[idx]
-                pos_tag_i = pos_tag[idx]
-
-                try:
-                    int(ti)
-                except ValueError:
-                    print(ti + '\n')      # or whatever
-                    print(cws_tag)
-
-                int_ti = int(ti)
-                if int_ti == segType.BMES_label_map['B']:  # 'B'
-                    result_str += ' ' + tt
-
-                    if not seg_start:
-                        seg_start = True
-
-                    if tmp_pos != []:
-                        tmp_pos_list.append(tmp_pos)
-
-                    result_pos += pos_tag_i + ' '
-                    tmp_pos = [pos_tag_i]
-                elif int_ti > segType.BMES_label_map['M']:  # and (cur_word_is_english)
-                    # int(ti)>1: tokens of 'E' and 'S'
-                    # current word is english
-                    result_str += tt + ' '
-
-                    #if int_ti == segType.BMES_label_map['S']:
-                    #    result_pos += pos_tag_i + ' '
-                    #    tmp_pos = []
-
-                    #    tmp_pos_list.append([pos_tag_i])
-                    #else:
-                    if tmp_pos == []:
-                        result_pos += pos_tag_i + ' '
-
-                    tmp_pos.extend([pos_tag_i])
-                    tmp_pos_list.append(tmp_pos)
-                    tmp_pos = []
-
-                    seg_start = False
-                else:
-                    result_str += tt
-                    tmp_pos.append(pos_tag_i)
-                    if not seg_start:
-                        seg_start = True
-                        result_pos += pos_tag_i + ' '
-
-            result_pos_str = extract_pos(tmp_pos_list)
-
-            if '[UNK]' in result_str or '[unused' in result_str:
-                print(original_str)
-                seg_ls, pos_ls = restore_unknown_tokens_with_pos(original_str, result_str, result_pos)
-            else:
-                seg_ls = result_str.strip().split()
-                pos_ls = result_pos.strip().split()
-
-            #seg_ls = result_str_rev.strip().split()
-            #pos_ls = result_pos_rev.strip().split()
-            assert(len(seg_ls)==len(pos_ls))
+            chunk_list = original_text_list[merge_start:merge_end]
+
+            # the tags are predicted for whole words
+            word_offset_list = []
+            for a, offsets in zip(processed_text_list[merge_start:merge_end], offset_list[merge_start:merge_end]):
+                word_offset_list.append([(offsets[idx_ls[0]][0], offsets[idx_ls[-1]][1]) for idx_ls in define_words_set(a)])
+
+            word_spans, word_pos = tags_to_spans(chunk_list, word_offset_list, \
+                cws_output_list[merge_start:merge_end], pos_output_list[merge_start:merge_end])
+            word_pos = word_pos.tolist()
+            if with_confidence:
+                # the parts of a word split at spaces keep its confidences
+                cws_confidence, pos_confidence = word_confidences(word_offset_list, \
+                    cws_output_list[merge_start:merge_end], output_lists[2][merge_start:merge_end], \
+                    output_lists[3][merge_start:merge_end])
+                word_pos = list(zip(word_pos, cws_confidence.tolist(), pos_confidence.tolist()))
+            seg_ls, pos_ls = spans_to_words(''.join(chunk_list), word_spans, word_pos)
 
             rs = []
             for i in range(len(seg_ls)):
-                rs.append(seg_ls[i] + ' / ' + pos_ls[i])
+                if with_confidence:
+                    rs.append((seg_ls[i] + ' / ' + posType.POS_label_map[pos_ls[i][0]], pos_ls[i][1], pos_ls[i][2]))
+                else:
+                    rs.append(seg_ls[i] + ' / ' + posType.POS_label_map[pos_ls[i]])
 
             result_str_list.append(rs)
 
         return result_str_list
+
+    def segment_stream(self, input_iter, window_size=None):
+        """Streaming version of cutlist_noUNK, see segment_text_stream."""
+        return segment_text_stream(self, input_iter, window_size)
+
+    def cutlist_long(self, input_list, window_size=None, stride=None):
+        """
+        Long-document version of cutlist_noUNK with overlapping windows of up to max_position_embeddings-2 tokens,
+        see cutlist_long_documents. window_size: default = max_position_embeddings-2; stride: default = window_size//2.
+        """
+        return cutlist_long_documents(self, input_list, window_size, stride, whole_word=True, with_pos=True)
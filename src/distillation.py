@@ -0,0 +1,138 @@
+#!/anaconda3/envs/haiqin370/bin/ python3
+# -*- coding: utf-8 -*-
+"""
+Created on at 10:30 2019-07-05
+@author: haiqinyang
+
+Feature: knowledge distillation of a truncated student from a 12-layer CWS/POS teacher
+
+Scenario:
+    The student, e.g., BertMLVariantCWSPOS_with_Dict with 1-4 layers, is trained on the hard labels and on the
+    soft CWS/POS emissions of the teacher at a temperature, and optionally matches the outputs of the teacher
+    layers mapped uniformly onto its own layers. The teacher emissions of the training set can be computed
+    once and stored on disk as float16 arrays, so that a student epoch only needs a student forward.
+    See BertMLCWSPOS_With_Dict_Distill.py.
+"""
+import os
+import json
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import Dataset
+from torch.utils.data.dataloader import default_collate
+
+import logging
+logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                    datefmt = '%m/%d/%Y %H:%M:%S',
+                    level = logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class IndexedDataset(Dataset):
+    # yield the index of each example with the example, so that its stored teacher emissions can be read back
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.dataset_collate_fn = getattr(dataset, 'collate_fn', default_collate)
+
+    def collate_fn(self, batch):
+        # see dataset_to_dataloader
+        indexes, examples = zip(*batch)
+        return torch.tensor(indexes), self.dataset_collate_fn(list(examples))
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, i):
+        return i, self.dataset[i]
+
+
+def soft_cross_entropy(student_logits, teacher_logits, mask, temperature=1.):
+    """
+    KL divergence between the tag distributions of the teacher and the student softened by temperature,
+    averaged over the positions of mask and scaled by temperature**2 to keep the gradients comparable with the
+    hard loss. Logits: [batch_size, seq_len, num_tags]; mask: [batch_size, seq_len].
+    """
+    student_log_probs = F.log_softmax(student_logits / temperature, dim=-1)
+    teacher_probs = F.softmax(teacher_logits.to(student_logits.dtype) / temperature, dim=-1)
+
+    kl = (teacher_probs * (torch.log(teacher_probs + 1e-12) - student_log_probs)).sum(-1)
+    mask = mask.to(kl.dtype)
+
+    return (kl * mask).sum() / mask.sum().clamp(min=1.) * temperature**2
+
+
+def map_layers(num_student_layers, num_teacher_layers):
+    # teacher layer matched by each student layer, spread uniformly, the last layers are always matched
+    return [(i+1)*num_teacher_layers//num_student_layers - 1 for i in range(num_student_layers)]
+
+
+def hidden_state_loss(student_layers, teacher_layers, mask):
+    # mean squared error between each student layer and its mapped teacher layer over the positions of mask
+    layer_map = map_layers(len(student_layers), len(teacher_layers))
+    mask = mask.to(student_layers[0].dtype).unsqueeze(2)
+    num_values = mask.sum().clamp(min=1.) * student_layers[0].size(-1)
+
+    loss = 0.
+    for s_idx, t_idx in enumerate(layer_map):
+        loss += (((student_layers[s_idx] - teacher_layers[t_idx])**2) * mask).sum() / num_values
+
+    return loss / len(layer_map)
+
+
+class TeacherLogitsStore(object):
+    """Teacher emissions of a dataset, stored as float16 .npy files of [num_examples, max_length, num_tags].
+
+    store = TeacherLogitsStore(output_dir)
+    store.create(len(dataset), max_length, num_CWStags, num_POStags) # then store.write(indexes, cws, pos)
+    store.open() # then store.read(indexes, device)
+    """
+    META_NAME = 'teacher_logits.json'
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.cws_logits = None
+        self.pos_logits = None
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.output_dir, self.META_NAME))
+
+    def create(self, num_examples, max_length, num_CWStags, num_POStags):
+        if not os.path.exists(self.output_dir):
+            os.makedirs(self.output_dir)
+
+        self.cws_logits = np.lib.format.open_memmap(os.path.join(self.output_dir, 'cws_logits.npy'), mode='w+', \
+                                dtype=np.float16, shape=(num_examples, max_length, num_CWStags))
+        self.pos_logits = np.lib.format.open_memmap(os.path.join(self.output_dir, 'pos_logits.npy'), mode='w+', \
+                                dtype=np.float16, shape=(num_examples, max_length, num_POStags))
+
+    def write(self, indexes, cws_logits, pos_logits):
+        indexes = indexes.cpu().numpy()
+        self.cws_logits[indexes] = cws_logits.detach().cpu().numpy().astype(np.float16)
+        self.pos_logits[indexes] = pos_logits.detach().cpu().numpy().astype(np.float16)
+
+    def close(self):
+        # flush the arrays and mark the store as complete
+        self.cws_logits.flush()
+        self.pos_logits.flush()
+
+        with open(os.path.join(self.output_dir, self.META_NAME), 'w') as f:
+            json.dump({'shape_cws': list(self.cws_logits.shape), 'shape_pos': list(self.pos_logits.shape)}, f)
+
+    def open(self):
+        if not self.exists():
+            raise RuntimeError('No complete teacher logits in {}!'.format(self.output_dir))
+
+        self.cws_logits = np.load(os.path.join(self.output_dir, 'cws_logits.npy'), mmap_mode='r')
+        self.pos_logits = np.load(os.path.join(self.output_dir, 'pos_logits.npy'), mmap_mode='r')
+
+    def read(self, indexes, device):
+        # sorted reads are faster on the memory-mapped files
+        indexes = indexes.cpu().numpy()
+        order = np.argsort(indexes)
+        inverse = np.argsort(order)
+
+        cws_logits = torch.from_numpy(np.ascontiguousarray(self.cws_logits[indexes[order]][inverse]))
+        pos_logits = torch.from_numpy(np.ascontiguousarray(self.pos_logits[indexes[order]][inverse]))
+
+        return cws_logits.to(device).float(), pos_logits.to(device).float()
@@ -0,0 +1,125 @@
+#!/anaconda3/envs/haiqin370/bin/ python3
+# -*- coding: utf-8 -*-
+"""
+Created on at 10:15 2019-07-11
+@author: haiqinyang
+
+Feature: structured pruning of the intermediate neurons of the feed-forward blocks of the CWS/POS models
+
+Scenario:
+    Neuron i of the feed-forward block of a layer, BertIntermediate.dense row i and BertOutput.dense column i,
+    is scored by
+        'magnitude': |BertIntermediate.dense.weight[i]| * |BertOutput.dense.weight[:, i]|, or
+        'activation': the mean |activation| of neuron i over the tokens of a dev set * |BertOutput.dense.weight[:, i]|.
+    The intermediate_size best neurons of every layer are kept, so the pruned model is a dense BERT whose config
+    only differs by intermediate_size. export_pruned_model writes it with its config, as a bert_model_dir.
+
+    prune_ffn(model, 2048, compute_neuron_importance(model, 'activation', dev_inputs))
+    export_pruned_model(model, output_dir) # bert_config.json and pytorch_model.bin
+"""
+import os
+from collections import OrderedDict
+
+import torch
+
+from .BERT.modeling import WEIGHTS_NAME
+from .head_pruning import prune_linear
+
+import logging
+logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                    datefmt = '%m/%d/%Y %H:%M:%S',
+                    level = logging.INFO)
+logger = logging.getLogger(__name__)
+
+CONFIG_NAME = 'bert_config.json'
+
+
+def compute_neuron_importance(model, criterion='magnitude', batches=None):
+    """
+    Importance of the intermediate neurons of each encoder layer of model, a list of [intermediate_size] tensors.
+    batches: only for 'activation', the positional inputs of model._compute_bert_feats, e.g., (input_ids,
+        segment_ids, input_mask, cand_indexes, token_ids, input_via_dict); the tokens of input_mask are counted.
+    """
+    layers = model.bert.encoder.layer
+    output_norms = [layer.output.dense.weight.detach().norm(dim=0) for layer in layers]
+
+    if criterion == 'magnitude':
+        return [layer.intermediate.dense.weight.detach().norm(dim=1) * output_norm
+                for layer, output_norm in zip(layers, output_norms)]
+    if criterion != 'activation':
+        raise ValueError('Unknown criterion of the neuron importance: {}'.format(criterion))
+    if batches is None:
+        raise ValueError('The activation criterion needs the batches of a dev set!')
+
+    activation_sums = [torch.zeros_like(output_norm) for output_norm in output_norms]
+    token_mask = {}
+
+    def activation_hook(activation_sum):
+        # sum |activation| over the tokens of the batch, [batch_size, seq_len, intermediate_size]
+        def hook(module, inputs, output):
+            activation_sum.add_((output.detach().abs() * token_mask['mask'].unsqueeze(2)).sum((0, 1)))
+        return hook
+
+    handles = [layer.intermediate.register_forward_hook(activation_hook(activation_sum))
+               for layer, activation_sum in zip(layers, activation_sums)]
+
+    training = model.training
+    model.eval()
+    num_tokens = 0.
+    try:
+        with torch.no_grad():
+            for inputs in batches:
+                token_mask['mask'] = inputs[2].to(output_norms[0].dtype)
+                num_tokens += token_mask['mask'].sum().item()
+                model._compute_bert_feats(*inputs)
+    finally:
+        for handle in handles:
+            handle.remove()
+        model.train(training)
+
+    return [activation_sum / max(num_tokens, 1.) * output_norm
+            for activation_sum, output_norm in zip(activation_sums, output_norms)]
+
+
+def prune_ffn(model, intermediate_size, importance=None):
+    """
+    Keep the intermediate_size most important neurons of the feed-forward block of every encoder layer of model,
+    in place, and set intermediate_size in its config. importance: see compute_neuron_importance,
+    default = the 'magnitude' one.
+    """
+    layers = model.bert.encoder.layer
+    config = model.bert.config
+    if intermediate_size < 1 or intermediate_size > layers[0].intermediate.dense.out_features:
+        raise ValueError('Cannot keep {} of the {} intermediate neurons!'.format(
+            intermediate_size, layers[0].intermediate.dense.out_features))
+
+    if importance is None:
+        importance = compute_neuron_importance(model, 'magnitude')
+
+    for layer, layer_importance in zip(layers, importance):
+        # keep the order of the neurons
+        index = torch.topk(layer_importance, intermediate_size)[1].sort()[0]
+        layer.intermediate.dense = prune_linear(layer.intermediate.dense, index, 0)
+        layer.output.dense = prune_linear(layer.output.dense, index, 1)
+
+    config.intermediate_size = intermediate_size
+    if getattr(model, 'config', config) is not config:
+        model.config.intermediate_size = intermediate_size
+
+    logger.info('Pruned the feed-forward blocks to intermediate_size={}'.format(intermediate_size))
+    return model
+
+
+def export_pruned_model(model, output_dir):
+    # bert_config.json and pytorch_model.bin of model in output_dir, e.g., the bert_model_dir of load_CWS_POS_model
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    with open(os.path.join(output_dir, CONFIG_NAME), 'w') as f:
+        f.write(model.bert.config.to_json_string())
+
+    # the keys of a models in DataParallel start with "module."
+    state_dict = OrderedDict([(k[len('module.'):] if k.startswith('module.') else k, v)
+                              for k, v in model.state_dict().items()])
+    torch.save(state_dict, os.path.join(output_dir, WEIGHTS_NAME))
+    logger.info('Exported the pruned model to {}'.format(output_dir))
@@ -0,0 +1,198 @@
+#!/anaconda3/envs/haiqin370/bin/ python3
+# -*- coding: utf-8 -*-
+"""
+Created on at 16:40 2019-07-10
+@author: haiqinyang
+
+Feature: importance scoring and physical pruning of the attention heads of the CWS/POS models
+
+Scenario:
+    The importance of head h of layer l is the mean absolute gradient of the loss on a dev set with respect to a
+    mask m[l, h] = 1 scaling the context of the head, normalized over the heads of each layer (Michel et al., 2019).
+    The least important heads are then removed from the model by slicing the rows of query/key/value and the
+    columns of BertSelfOutput.dense, so a pruned layer costs less time and memory. A checkpoint of a pruned model
+    is loaded by a model pruned the same way, see match_pruned_heads.
+
+    importance = compute_head_importance(model, dev_batches, loss_fn)
+    prune_heads(model, select_heads_to_prune(importance, 8))
+    torch.save(model.state_dict(), 'cws_pos_pruned.pt')
+
+    model = BertMLCWSPOS_with_Dict(device, config, vocab_file, 128, ...)
+    state_dict = torch.load('cws_pos_pruned.pt')
+    match_pruned_heads(model, state_dict).load_state_dict(state_dict)
+"""
+import re
+
+import torch
+import torch.nn as nn
+
+from .BERT.modeling import BertSelfAttention
+
+import logging
+logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                    datefmt = '%m/%d/%Y %H:%M:%S',
+                    level = logging.INFO)
+logger = logging.getLogger(__name__)
+
+PRUNED_WEIGHTS_NAME = 'pytorch_model_pruned.pt'
+
+
+def _self_attentions(model, layer_indexes=None):
+    self_attentions = [layer.attention.self for layer in model.bert.encoder.layer]
+    if layer_indexes is None:
+        layer_indexes = range(len(self_attentions))
+
+    for layer_index in layer_indexes:
+        self_attention = self_attentions[layer_index]
+        if not isinstance(self_attention, BertSelfAttention):
+            raise ValueError('Only the dense BertSelfAttention can be pruned, not {}!'.format(
+                self_attention.__class__.__name__))
+
+    return self_attentions
+
+
+def head_mask_hook(head_mask, head_size):
+    # forward hook of a BertSelfAttention scaling the context of each head, [batch_size, seq_len, num_heads*head_size],
+    # by head_mask, [num_heads], e.g., 0 for the heads to be pruned
+    def hook(module, inputs, output):
+        return (output.view(output.shape[:-1] + (-1, head_size)) * head_mask.unsqueeze(1)).view(output.shape)
+    return hook
+
+
+def compute_head_importance(model, batches, loss_fn, normalize=True):
+    """
+    Importance of the heads of each encoder layer of model, a list of [num_attention_heads] tensors.
+    batches: the dev batches; loss_fn(model, batch): the loss of a batch, e.g., model(*inputs, labels...).
+    normalize: divide the scores of each layer by their L2 norm, so that the layers are comparable.
+    """
+    self_attentions = _self_attentions(model)
+    device = next(model.parameters()).device
+    head_masks = [torch.ones(sa.num_attention_heads, device=device, requires_grad=True) for sa in self_attentions]
+
+    handles = [sa.register_forward_hook(head_mask_hook(head_mask, sa.attention_head_size))
+               for sa, head_mask in zip(self_attentions, head_masks)]
+
+    training = model.training
+    model.eval() # no dropout while scoring
+    importance = [torch.zeros(sa.num_attention_heads, device=device) for sa in self_attentions]
+    num_batches = 0
+    try:
+        for batch in batches:
+            loss = loss_fn(model, batch)
+            grads = torch.autograd.grad(loss, head_masks)
+            for layer_importance, grad in zip(importance, grads):
+                layer_importance += grad.abs().detach()
+            num_batches += 1
+    finally:
+        for handle in handles:
+            handle.remove()
+        model.train(training)
+
+    importance = [layer_importance / max(num_batches, 1) for layer_importance in importance]
+    if normalize:
+        importance = [layer_importance / layer_importance.norm().clamp(min=1e-20) for layer_importance in importance]
+
+    return importance
+
+
+def select_heads_to_prune(importance, num_heads_kept):
+    """
+    The least important heads of each layer, {layer_index: [head_index, ...]}, as needed by prune_heads.
+    num_heads_kept: heads kept in every layer, or a list of one budget per layer, at least 1 per layer.
+    """
+    if isinstance(num_heads_kept, int):
+        num_heads_kept = [num_heads_kept] * len(importance)
+    if len(num_heads_kept) != len(importance):
+        raise ValueError('{} head budgets for {} layers!'.format(len(num_heads_kept), len(importance)))
+
+    heads_to_prune = {}
+    for layer_index, (layer_importance, budget) in enumerate(zip(importance, num_heads_kept)):
+        if budget < 1 or budget > len(layer_importance):
+            raise ValueError('Cannot keep {} of the {} heads of layer {}!'.format(
+                budget, len(layer_importance), layer_index))
+
+        order = torch.argsort(layer_importance, descending=True).tolist()
+        if budget < len(order):
+            heads_to_prune[layer_index] = sorted(order[budget:])
+
+    return heads_to_prune
+
+
+def prune_linear(linear, index, dim):
+    # nn.Linear keeping the outputs (dim=0) or the inputs (dim=1) of linear in index
+    index = index.to(linear.weight.device)
+    weight = linear.weight.index_select(dim, index).clone().detach()
+    bias = linear.bias.clone().detach() if dim == 1 else linear.bias.index_select(0, index).clone().detach()
+
+    shape = list(linear.weight.shape)
+    shape[dim] = len(index)
+    new_linear = nn.Linear(shape[1], shape[0]).to(linear.weight.device)
+    with torch.no_grad():
+        new_linear.weight.copy_(weight)
+        new_linear.bias.copy_(bias)
+
+    return new_linear
+
+
+def prune_heads(model, heads_to_prune):
+    """
+    Remove the heads of heads_to_prune, {layer_index: [head_index, ...]}, from model in place. The head indexes
+    refer to the current heads of the layer, and each layer keeps at least one head.
+    """
+    self_attentions = _self_attentions(model, heads_to_prune.keys())
+    for layer_index, heads in heads_to_prune.items():
+        self_attention = self_attentions[layer_index]
+        attention = model.bert.encoder.layer[layer_index].attention
+        head_size = self_attention.attention_head_size
+
+        kept_heads = [h for h in range(self_attention.num_attention_heads) if h not in set(heads)]
+        if not kept_heads:
+            raise ValueError('Cannot prune all the heads of layer {}!'.format(layer_index))
+        index = torch.LongTensor([h*head_size + i for h in kept_heads for i in range(head_size)])
+
+        self_attention.query = prune_linear(self_attention.query, index, 0)
+        self_attention.key = prune_linear(self_attention.key, index, 0)
+        self_attention.value = prune_linear(self_attention.value, index, 0)
+        attention.output.dense = prune_linear(attention.output.dense, index, 1)
+
+        self_attention.num_attention_heads = len(kept_heads)
+        self_attention.all_head_size = len(kept_heads) * head_size
+
+    logger.info('Heads per layer after pruning: {}'.format(
+        [getattr(sa, 'num_attention_heads', None) for sa in self_attentions]))
+    return model
+
+
+def heads_in_state_dict(state_dict, head_size):
+    # number of heads of each encoder layer in state_dict, {layer_index: num_heads}, from the shape of its query,
+    # of its packed (weight, bias) in a quantized state_dict, see src/quantization.py
+    num_heads = {}
+    for k, v in state_dict.items():
+        match = re.search(r'encoder\.layer\.(\d+)\.attention\.self\.query\.(weight|_packed_params\._packed_params)$', k)
+        if match:
+            weight = v[0] if isinstance(v, tuple) else v
+            num_heads[int(match.group(1))] = weight.size(0) // head_size
+
+    return num_heads
+
+
+def match_pruned_heads(model, state_dict):
+    # prune model, e.g., newly built from the config, to the number of heads of each layer in state_dict,
+    # the layers with grouped query/key/value, see use_sparse_qkv, are skipped
+    config = model.bert.config
+    num_heads_saved = heads_in_state_dict(state_dict, config.hidden_size // config.num_attention_heads)
+
+    heads_to_prune = {}
+    for layer_index, layer in enumerate(model.bert.encoder.layer):
+        self_attention = layer.attention.self
+        if not isinstance(self_attention, BertSelfAttention):
+            continue
+
+        num_heads = num_heads_saved.get(layer_index)
+        if num_heads is not None and num_heads < self_attention.num_attention_heads:
+            heads_to_prune[layer_index] = list(range(num_heads, self_attention.num_attention_heads))
+
+    if heads_to_prune:
+        prune_heads(model, heads_to_prune)
+
+    return model
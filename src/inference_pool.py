@@ -0,0 +1,135 @@
+#!/anaconda3/envs/haiqin370/bin/ python3
+# -*- coding: utf-8 -*-
+"""
+Created on at 15:40 2019-06-26
+@author: haiqinyang
+
+Feature: multi-process CPU inference for the cutlist_noUNK models
+
+Scenario:
+    The model is loaded once in the parent process and its parameters are moved to shared memory,
+    so the forked workers read the same weights. Each worker is pinned to its own slice of cores with
+    a matching number of intra-op threads. Windows of texts are sent to the workers and the results are
+    collected in the input order.
+
+    with InferencePool(model, num_workers=4) as pool:
+        for words in pool.imap(open(infile, 'r', encoding='utf8')):
+            print(' '.join(words))
+"""
+import os
+import multiprocessing
+from collections import deque
+
+import torch
+
+from .utilis import window_text_stream
+
+import logging
+logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                    datefmt = '%m/%d/%Y %H:%M:%S',
+                    level = logging.INFO)
+logger = logging.getLogger(__name__)
+
+# set in the parent before forking, so that the workers inherit the model without pickling it
+_worker_model = None
+
+
+def split_cores(num_workers, cores=None):
+    # split the available cores into num_workers nearly even slices
+    if cores is None:
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') \
+            else list(range(multiprocessing.cpu_count()))
+
+    num_workers = min(num_workers, len(cores))
+    st, rest = divmod(len(cores), num_workers)
+
+    core_slices = []
+    s_idx = 0
+    for i in range(num_workers):
+        e_idx = s_idx + st + (1 if i < rest else 0)
+        core_slices.append(cores[s_idx:e_idx])
+        s_idx = e_idx
+
+    return core_slices
+
+
+def _init_worker(core_queue, threads_per_worker):
+    cores = core_queue.get()
+
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+
+    torch.set_num_threads(threads_per_worker if threads_per_worker > 0 else len(cores))
+
+
+def _segment_window(text_list):
+    with torch.no_grad():
+        return _worker_model.cutlist_noUNK(text_list)
+
+
+class InferencePool(object):
+    """Pool of forked CPU workers sharing the weights of model.
+
+    Params:
+        `model`: a model with cutlist_noUNK, e.g., BertMLCWSPOS_with_Dict, already on the CPU and in eval mode.
+        `num_workers`: the number of worker processes. Default = the number of available cores.
+        `threads_per_worker`: the number of intra-op threads per worker. Default = the size of its core slice.
+        `window_size`: the number of chunks of max_length-2 characters sent to a worker at once.
+            Default = model.batch_size.
+        `max_pending`: the number of windows sent to the workers and not yet yielded, which bounds the memory
+            used for a large input_iter. Default = 2*num_workers.
+    """
+    def __init__(self, model, num_workers=None, threads_per_worker=0, window_size=None, max_pending=None):
+        global _worker_model
+
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            raise RuntimeError('InferencePool needs the fork start method to share the model!')
+
+        core_slices = split_cores(num_workers if num_workers else multiprocessing.cpu_count())
+        self.num_workers = len(core_slices)
+        self.window_size = window_size if window_size else model.batch_size
+        self.len_max = model.max_length - 2
+        self.max_pending = max_pending if max_pending else 2*self.num_workers
+
+        model.eval()
+        model.share_memory()
+        _worker_model = model
+
+        ctx = multiprocessing.get_context('fork')
+        core_queue = ctx.Queue()
+        for cores in core_slices: core_queue.put(cores)
+
+        self.pool = ctx.Pool(self.num_workers, initializer=_init_worker, initargs=(core_queue, threads_per_worker))
+        logger.info('InferencePool: {} workers, cores {}'.format(self.num_workers, core_slices))
+
+    def imap(self, input_iter):
+        """
+        Yield the output of cutlist_noUNK for each text of input_iter, in the input order.
+        input_iter is read lazily, at most max_pending windows are in flight, unlike Pool.imap, which reads all of it.
+        """
+        text_windows = window_text_stream(input_iter, self.len_max*self.window_size)
+
+        pending = deque()
+        for text_list in text_windows:
+            pending.append(self.pool.apply_async(_segment_window, (text_list,)))
+            if len(pending) < self.max_pending: continue
+
+            for rs in pending.popleft().get():
+                yield rs
+
+        while pending:
+            for rs in pending.popleft().get():
+                yield rs
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.pool.terminate()
@@ -0,0 +1,223 @@
+#!/anaconda3/envs/haiqin370/bin/ python3
+# -*- coding: utf-8 -*-
+"""
+Created on at 11:05 2019-06-28
+@author: haiqinyang
+
+Feature: frozen inference session of the CWS/POS models
+
+Scenario:
+    The trained model is put in eval mode, its dropout modules are removed and its parameters are frozen.
+    Every batch is decoded under torch.no_grad(), the input tensors are written into buffers reused across
+    batches, and the encoder can optionally run through TorchScript graphs traced on the first batches.
+    The session keeps the contract of cutlist_noUNK.
+
+    session = InferenceSession.from_checkpoint(BertMLCWSPOS_with_Dict, 'cws_F1_weights_epoch09.pt',
+                    bert_config_file, vocab_file, 128, num_CWStags=6, num_POStags=110, do_mask_as_whole=True,
+                    dict_file='./resource/dict.txt', trace_encoder=True)
+    output = session.cutlist_noUNK([text])
+"""
+import os
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+
+from .BERT.modeling import BertConfig, WEIGHTS_NAME
+from .customize_modeling import BertMLModel, use_sparse_qkv, sparse_qkv_layers, segment_text_stream
+from .quantization import quantize_model
+from .head_pruning import match_pruned_heads
+
+import logging
+logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                    datefmt = '%m/%d/%Y %H:%M:%S',
+                    level = logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class Identity(nn.Module):
+    def forward(self, x):
+        return x
+
+
+def strip_dropout(module):
+    # replace the dropout modules by identities, they only cost time in eval mode
+    num_stripped = 0
+    for name, child in module.named_children():
+        if isinstance(child, nn.Dropout):
+            setattr(module, name, Identity())
+            num_stripped += 1
+        else:
+            num_stripped += strip_dropout(child)
+
+    return num_stripped
+
+
+class BertTraceAdapter(nn.Module):
+    # model.bert with positional tensor inputs and fixed output_all_encoded_layers and output_layers, see BertModel,
+    # as needed by torch.jit.trace
+    def __init__(self, bert, output_all_encoded_layers, output_layers=None, layer_reduction=None, layer_transform=None):
+        super(BertTraceAdapter, self).__init__()
+        self.bert = bert
+        self.output_all_encoded_layers = output_all_encoded_layers
+        self.layer_kwargs = {'output_layers': output_layers, 'layer_reduction': layer_reduction, \
+                             'layer_transform': layer_transform}
+        # the encoded layers are a list
+        self.output_list = output_all_encoded_layers if output_layers is None else layer_reduction is None
+        self.whole_word = isinstance(bert, BertMLModel)
+
+    def forward(self, input_ids, token_type_ids, attention_mask, *extra_inputs):
+        # extra_inputs: (cand_indexes, token_ids) of a whole-word model, (pack_ids,) of a packed batch or ()
+        if self.whole_word:
+            cand_indexes, token_ids = extra_inputs
+            encoded_layers, pooled_output = self.bert(input_ids, token_type_ids, attention_mask, \
+                    output_all_encoded_layers=self.output_all_encoded_layers, cand_indexes=cand_indexes, \
+                    token_ids=token_ids, **self.layer_kwargs)
+        else:
+            pack_ids = extra_inputs[0] if extra_inputs else None
+            encoded_layers, pooled_output = self.bert(input_ids, token_type_ids, attention_mask, \
+                    output_all_encoded_layers=self.output_all_encoded_layers, pack_ids=pack_ids, **self.layer_kwargs)
+
+        if self.output_list:
+            return tuple(encoded_layers) + (pooled_output,)
+
+        return encoded_layers, pooled_output
+
+
+class TracedBert(nn.Module):
+    """Drop-in replacement of model.bert running TorchScript graphs.
+
+    A graph is traced on the first batch of each value of output_all_encoded_layers, of packed or not and of
+    output_layers and layer_reduction, see BertModel. The batch size and the sequence length stay dynamic in the graph, so the buckets of different
+    lengths reuse it.
+    """
+    def __init__(self, bert):
+        super(TracedBert, self).__init__()
+        self.bert = bert
+        self.whole_word = isinstance(bert, BertMLModel)
+        self.traced = {}
+
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None, output_all_encoded_layers=True, \
+                cand_indexes=None, token_ids=None, pack_ids=None, output_layers=None, layer_reduction=None, \
+                layer_transform=None):
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        if token_type_ids is None:
+            token_type_ids = torch.zeros_like(input_ids)
+
+        inputs = (input_ids, token_type_ids, attention_mask)
+        if self.whole_word:
+            inputs += (cand_indexes, token_ids)
+        elif pack_ids is not None:
+            inputs += (pack_ids,)
+
+        key = (bool(output_all_encoded_layers), pack_ids is not None, repr(output_layers), layer_reduction)
+        if key not in self.traced:
+            adapter = BertTraceAdapter(self.bert, key[0], output_layers, layer_reduction, layer_transform)
+            with torch.no_grad():
+                self.traced[key] = (torch.jit.trace(adapter, inputs, check_trace=False), adapter.output_list)
+            logger.info('Traced the encoder, output_all_encoded_layers={}, packed={}, output_layers={}, '
+                        'layer_reduction={}'.format(*key))
+
+        traced, output_list = self.traced[key]
+        outputs = traced(*inputs)
+
+        if output_list:
+            return list(outputs[:-1]), outputs[-1]
+
+        return outputs[0], outputs[1]
+
+
+class InferenceSession(object):
+    """Frozen inference wrapper of BertCWS, BertCWSPOS, BertMLCWSPOS and BertMLCWSPOS_with_Dict.
+
+    Params:
+        `model`: the model, its weights already loaded. It is modified in place, so it should not be trained
+            any more.
+        `trace_encoder`: run model.bert through TorchScript graphs, see TracedBert. Default = False.
+
+    The other attributes, e.g., batch_size, max_length, chunk_cache, are read from model, so a session can be
+    used wherever the model is used for inference, e.g., by MicroBatcher and InferencePool.
+    """
+    def __init__(self, model, trace_encoder=False):
+        model.eval()
+        num_stripped = strip_dropout(model)
+        for param in model.parameters():
+            param.requires_grad = False
+
+        model.input_buffers = {} # see to_input_tensor
+        if trace_encoder and getattr(model, 'early_exit', False):
+            # the early exits run the encoder layers one by one
+            logger.warning('trace_encoder is ignored for a model with early_exit')
+            trace_encoder = False
+        if trace_encoder and not isinstance(model.bert, TracedBert):
+            model.bert = TracedBert(model.bert)
+
+        self.model = model
+        logger.info('InferenceSession: {} dropout modules removed, trace_encoder={}'.format(num_stripped, trace_encoder))
+
+    @classmethod
+    def from_checkpoint(cls, model_class, checkpoint, bert_config, vocab_file, max_length, device=None, \
+                        trace_encoder=False, quantized=False, **kwargs):
+        """
+        Build model_class, e.g., BertMLCWSPOS_with_Dict, and load the fine-tuned weights of checkpoint, i.e.,
+        a file saved from model.state_dict() or a directory containing pytorch_model.bin.
+        bert_config: a BertConfig or its json file. device: default = cuda if available else cpu.
+        quantized: checkpoint was saved by save_quantized_model, the model then runs in int8 on the cpu.
+        The layers with grouped query/key/value in checkpoint, see use_sparse_qkv, are converted before loading,
+        and the pruned heads of checkpoint, see src/head_pruning.py, are removed.
+        kwargs are passed to model_class, e.g., num_CWStags, num_POStags, do_mask_as_whole, dict_file.
+        """
+        if quantized:
+            device = torch.device('cpu')
+        elif device is None:
+            device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        if not isinstance(bert_config, BertConfig):
+            bert_config = BertConfig.from_json_file(bert_config)
+        if os.path.isdir(checkpoint):
+            checkpoint = os.path.join(checkpoint, WEIGHTS_NAME)
+
+        model = model_class(device, bert_config, vocab_file, max_length, **kwargs)
+
+        state_dict = torch.load(checkpoint, map_location='cpu')
+        metadata = getattr(state_dict, '_metadata', None)
+        # the keys of a models saved from DataParallel start with "module."
+        strip = lambda k: k[len('module.'):] if k.startswith('module.') else k
+        state_dict = OrderedDict([(strip(k), v) for k, v in state_dict.items()])
+        if metadata is not None:
+            # the module versions, needed by the quantized Linear layers
+            state_dict._metadata = OrderedDict([(strip(k), v) for k, v in metadata.items()])
+
+        sparse_layers = sparse_qkv_layers(state_dict)
+        if sparse_layers:
+            use_sparse_qkv(model, layers=sparse_layers)
+        match_pruned_heads(model, state_dict)
+        if quantized:
+            quantize_model(model)
+        model.load_state_dict(state_dict)
+        model.to(device)
+
+        return cls(model, trace_encoder)
+
+    def cutlist_noUNK(self, input_list):
+        with torch.no_grad():
+            return self.model.cutlist_noUNK(input_list)
+
+    def cutlist_with_confidence(self, input_list):
+        with torch.no_grad():
+            return self.model.cutlist_with_confidence(input_list)
+
+    def cutlist_long(self, input_list, window_size=None, stride=None):
+        with torch.no_grad():
+            return self.model.cutlist_long(input_list, window_size, stride)
+
+    def segment_stream(self, input_iter, window_size=None):
+        """Streaming version of cutlist_noUNK, see segment_text_stream."""
+        return segment_text_stream(self, input_iter, window_size)
+
+    def __getattr__(self, name):
+        # only called for the attributes missing from the session
+        if name == 'model':
+            raise AttributeError(name)
+
+        return getattr(self.model, name)
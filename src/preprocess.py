@@ -9,9 +9,11 @@ import copy
 import time
 import numpy as np
 from torch.utils.data import Dataset, DataLoader
+from torch.utils.data.dataloader import default_collate
 from torch.utils.data import RandomSampler, SequentialSampler
 from torch.utils.data.distributed import DistributedSampler
 from .config import MAX_SUBWORDS, MAX_GRAM_LEN, NUM_HIDDEN_SIZE
+from .utilis import pack_sequences, pack_row
 
 
 def set1_from_tuple(pp, mat, wd_tuple, max_length=128, shift0=0, shift1=0):
@@ -386,6 +388,55 @@ def cand_max2nparray(cand_indexes, max_length):
     return o_cand_indexes, o_cand_mask
 
 
+def indexes2csr(max_length, token_ids):
+    '''
+     Compact form of indexes2nparray, the subword ids of the words are concatenated instead of padded to MAX_SUBWORDS
+     Inputs:
+       max_length: e.g., 128 (<=512)
+       token_ids: e.g., [[101], [1738, 4501], [5110], ...]
+    # Output:
+       word_lens: array([1, 2, 1, ..., 0, 0]) of max_length, 0 for the padded words
+       flat_token_ids: array([101, 1738, 4501, 5110, ...])
+       cand_indexes are not kept, the model only uses the subword ids of each word
+    '''
+    word_lens = np.zeros(max_length, dtype=np.int16)
+    word_lens[:len(token_ids)] = [len(token_id) for token_id in token_ids]
+    flat_token_ids = np.fromiter(itertools.chain.from_iterable(token_ids), dtype=np.int32)
+
+    return word_lens, flat_token_ids
+
+
+def stack_csr(csr_list):
+    '''
+     Batch the outputs of indexes2csr, [word_lens, flat_token_ids] of each sentence
+    # Output:
+       cand_offsets: array of [batch_size, max_length+1], the offset of each word in its row of token_ids, the last
+          column is the number of subword ids of the row, i.e., the offsets of each row are a CSR index pointer
+       token_ids: array of [batch_size, max_subwords], the subword ids of each sentence padded by 0 to the longest one
+       The padded words are empty, i.e., their offsets equal the offsets of the next words.
+       Both arrays are split by rows, so that DataParallel scatters every sentence with its own offsets.
+    '''
+    word_lens = np.stack([csr[0] for csr in csr_list]).astype(np.int64)
+    cand_offsets = np.zeros((word_lens.shape[0], word_lens.shape[1]+1), dtype=np.int64)
+    np.cumsum(word_lens, axis=1, out=cand_offsets[:, 1:])
+
+    token_ids = np.zeros((len(csr_list), max(1, cand_offsets[:, -1].max())), dtype=np.int64)
+    for i, csr in enumerate(csr_list):
+        token_ids[i, :len(csr[1])] = csr[1]
+
+    return cand_offsets, token_ids
+
+
+def collate_csr(batch):
+    # collate_fn of the datasets with ragged_cand_indexes, the second item of each example is [word_lens, flat_token_ids]
+    cand_offsets, token_ids = stack_csr([example[1] for example in batch])
+
+    collated = [default_collate([example[k] for example in batch]) if k != 1 else None for k in range(len(batch[0]))]
+    collated[1] = [torch.from_numpy(cand_offsets), torch.from_numpy(token_ids)]
+
+    return collated
+
+
 def construct_pos_tags(pos_tags_file, mode = 'BIO'):
     pos_label_list  = ['[START]', '[END]']
 
@@ -409,12 +460,23 @@ def get_dataset_and_dataloader(processor, args, training=True, type_name='train'
     dataset = OntoNotesDataset(processor, args.data_dir, args.vocab_file,
                              args.max_seq_length, training=training, type_name=type_name,
                                do_lower_case=args.do_lower_case,
-                               do_mask_as_whole=args.do_mask_as_whole)
+                               do_mask_as_whole=args.do_mask_as_whole,
+                               ragged_cand_indexes=args.ragged_cand_indexes)
     dataloader = dataset_to_dataloader(dataset, args.train_batch_size,
                                        args.local_rank, training=training)
     return dataset, dataloader
 
 
+def get_packed_dataset_and_dataloader(processor, args, type_name='train'):
+    # training set of OntoNotesDataset with the short sentences packed into rows of max_seq_length, see PackedDataset
+    dataset = PackedDataset(OntoNotesDataset(processor, args.data_dir, args.vocab_file,
+                             args.max_seq_length, training=True, type_name=type_name,
+                               do_lower_case=args.do_lower_case))
+    dataloader = dataset_to_dataloader(dataset, args.train_batch_size,
+                                       args.local_rank, training=True)
+    return dataset, dataloader
+
+
 def get_eval_dataloaders(processor, args):
     if 'ontonotes' in args.task_name.lower():
         parts = ['test', 'dev', 'train']
@@ -433,7 +495,8 @@ def get_dataset_with_dict_and_dataloader(processor, args, training=True, type_na
     dataset = OntoNotesDataset_With_Dict(processor, args.data_dir, args.vocab_file,
                              args.max_seq_length, training=training, type_name=type_name,
                                 do_lower_case=args.do_lower_case,
-                                do_mask_as_whole=args.do_mask_as_whole)
+                                do_mask_as_whole=args.do_mask_as_whole,
+                                ragged_cand_indexes=args.ragged_cand_indexes)
 
     dataloader = dataset_to_dataloader(dataset, args.train_batch_size,
                                        args.local_rank, training=training)
@@ -459,7 +522,8 @@ def get_dataset_stored_with_dict_and_dataloader(processor, args, training=True,
                              args.max_seq_length, training=training, type_name=type_name,
                                 do_lower_case=args.do_lower_case,
                                 do_mask_as_whole=args.do_mask_as_whole,
-                                dict_file=args.dict_file)
+                                dict_file=args.dict_file,
+                                ragged_cand_indexes=args.ragged_cand_indexes)
 
     dataloader = dataset_to_dataloader(dataset, args.train_batch_size,
                                        args.local_rank, training=training)
@@ -701,7 +765,7 @@ class CWS_POS(MeituProcessor):
 
 class OntoNotesDataset(Dataset):
     def __init__(self, processor, data_dir, vocab_file, max_length, training=True, type_name='train', do_lower_case=True, \
-                 do_mask_as_whole=False):
+                 do_mask_as_whole=False, ragged_cand_indexes=False):
         self.tokenizer = BertTokenizer(
                 vocab_file=vocab_file, do_lower_case=do_lower_case)
         self.max_length = max_length
@@ -716,6 +780,9 @@ class OntoNotesDataset(Dataset):
         self.label_list = processor.get_labels()
         self.label_map = processor.label_map
         self.do_mask_as_whole = do_mask_as_whole
+        self.ragged_cand_indexes = ragged_cand_indexes
+        # the examples of ragged cand indexes have different lengths, see indexes2csr
+        self.collate_fn = collate_csr if do_mask_as_whole and ragged_cand_indexes else default_collate
 
         pos_label_map = getattr(processor, 'pos_label_map', None)
         if pos_label_map is not None:
@@ -755,7 +822,8 @@ class OntoNotesDataset(Dataset):
 
         for i, data in enumerate(self.df.itertuples()):
             if self.do_mask_as_whole:
-                token, cand_index = tokenize_text_with_cand_indexes(data.text, self.max_length, self.tokenizer)
+                token, cand_index = tokenize_text_with_cand_indexes(data.text, self.max_length, self.tokenizer, \
+                                                                    ragged=self.ragged_cand_indexes)
                 # cand_index_len = list(cand_index.size())[0]
                 # labelid = tokenize_label_list_restriction(data.label, self.max_length, self.label_map, cand_index_len)
                 labelid = tokenize_label_list(data.label, self.max_length, self.label_map)
@@ -861,9 +929,43 @@ class OntoNotesDataset(Dataset):
         return self.df.shape[0]
 
 
+class PackedDataset(Dataset):
+    """Sentences of an OntoNotesDataset without do_mask_as_whole packed into rows of max_length tokens.
+
+    The sentences are packed once by pack_sequences, so that a row holds several short sentences with their
+    own [CLS] and [SEP] and the padding is close to zero. A row is
+    (input_ids, segment_ids, input_mask, label_ids[, pos_label_ids], pack_ids), see BertModel for pack_ids.
+    len(dataset) is the number of rows.
+    """
+    def __init__(self, dataset):
+        if dataset.do_mask_as_whole:
+            raise ValueError('Packing the whole-word inputs, do_mask_as_whole=True, is not supported!')
+
+        if 'token' not in dataset.df.columns:
+            dataset._tokenize()
+
+        self.dataset = dataset
+        self.max_length = dataset.max_length
+        self.tokenizer = dataset.tokenizer
+        self.lengths = [int(token[2].sum()) for token in dataset.df.token] # sums of the input masks
+        self.rows = pack_sequences(self.lengths, self.max_length)
+
+        logging.info('Packed {} sentences into {} rows of {} tokens'.format(len(self.lengths), len(self.rows), \
+                                                                             self.max_length))
+
+    def __getitem__(self, r):
+        row = self.rows[r]
+        packed, pack_ids = pack_row([self.dataset[i] for i in row], [self.lengths[i] for i in row], self.max_length)
+
+        return packed + (pack_ids,)
+
+    def __len__(self):
+        return len(self.rows)
+
+
 class OntoNotesDataset_With_Dict(OntoNotesDataset):
     def __init__(self, processor, data_dir, vocab_file, max_length, training=True, type_name='train', do_lower_case=True, \
-                 do_mask_as_whole=False, dict_file='./resource/dict.txt'):
+                 do_mask_as_whole=False, dict_file='./resource/dict.txt', ragged_cand_indexes=False):
         self.tokenizer = BertTokenizer(
                 vocab_file=vocab_file, do_lower_case=do_lower_case)
 
@@ -879,6 +981,9 @@ class OntoNotesDataset_With_Dict(OntoNotesDataset):
         self.label_list = processor.get_labels()
         self.label_map = processor.label_map
         self.do_mask_as_whole = do_mask_as_whole
+        self.ragged_cand_indexes = ragged_cand_indexes
+        # the examples of ragged cand indexes have different lengths, see indexes2csr
+        self.collate_fn = collate_csr if do_mask_as_whole and ragged_cand_indexes else default_collate
         self.dict_file = dict_file
 
         if dict_file is not None:
@@ -926,7 +1031,8 @@ class OntoNotesDataset_With_Dict(OntoNotesDataset):
 
         for i, data in enumerate(self.df.itertuples()):
             if self.do_mask_as_whole:
-                token, cand_index, words = tokenize_text_with_cand_indexes_to_words(data.text, self.max_length, self.tokenizer)
+                token, cand_index, words = tokenize_text_with_cand_indexes_to_words(data.text, self.max_length, \
+                                                    self.tokenizer, ragged=self.ragged_cand_indexes)
                 labelid = tokenize_label_list(data.label, self.max_length, self.label_map)
 
                 if self.pos_label_map:
@@ -1051,7 +1157,7 @@ class OntoNotesDataset_With_Dict(OntoNotesDataset):
 
 class OntoNotesDataset_Stored_With_Dict(OntoNotesDataset):
     def __init__(self, processor, data_dir, vocab_file, max_length, training=True, type_name='train', do_lower_case=True, \
-                 do_mask_as_whole=False, dict_file='./resource/dict.txt'):
+                 do_mask_as_whole=False, dict_file='./resource/dict.txt', ragged_cand_indexes=False):
         self.tokenizer = BertTokenizer(
                 vocab_file=vocab_file, do_lower_case=do_lower_case)
         self.max_length = max_length
@@ -1066,6 +1172,9 @@ class OntoNotesDataset_Stored_With_Dict(OntoNotesDataset):
         self.label_list = processor.get_labels()
         self.label_map = processor.label_map
         self.do_mask_as_whole = do_mask_as_whole
+        self.ragged_cand_indexes = ragged_cand_indexes
+        # the examples of ragged cand indexes have different lengths, see indexes2csr
+        self.collate_fn = collate_csr if do_mask_as_whole and ragged_cand_indexes else default_collate
         self.dict_file = dict_file
         self.zeros_mat = np.zeros((max_length, 2*(MAX_GRAM_LEN-1)), dtype=np.uint8)
         self.pattern = re.compile(r'[(](.*?)[)]', re.S) # minimum matching ()
@@ -1101,7 +1210,8 @@ class OntoNotesDataset_Stored_With_Dict(OntoNotesDataset):
 
         for i, data in enumerate(self.df.itertuples()):
             if self.do_mask_as_whole:
-                token, cand_index, words = tokenize_text_with_cand_indexes_to_words(data.text, self.max_length, self.tokenizer)
+                token, cand_index, words = tokenize_text_with_cand_indexes_to_words(data.text, self.max_length, \
+                                                    self.tokenizer, ragged=self.ragged_cand_indexes)
                 labelid = tokenize_label_list(data.label, self.max_length, self.label_map)
 
                 if self.pos_label_map:
@@ -1271,7 +1381,7 @@ def tokens2ids(tokens, max_length, tokenizer):
     return [tokens, segment, mask]
 
 
-def tokenize_text_with_cand_indexes(text, max_length, tokenizer):
+def tokenize_text_with_cand_indexes(text, max_length, tokenizer, ragged=False):
     # words = re.findall('[^0-9a-zA-Z]|[0-9a-zA-Z]+', text.lower())
     # words = list(filter(lambda x: x!=' ', words))
     # words = list(itertools.chain(*[tokenizer.tokenize(x) for x in words]))
@@ -1296,12 +1406,15 @@ def tokenize_text_with_cand_indexes(text, max_length, tokenizer):
     mask = np.array([1] * can_index_len + [0] * (max_length - can_index_len))
     segment = np.array([0] * max_length)
 
-    cand_indexes, token_ids = indexes2nparray(max_length, cand_indexes, token_ids)
+    if ragged: # [word_lens, flat_token_ids], see indexes2csr
+        cand_indexes, token_ids = indexes2csr(max_length, token_ids)
+    else:
+        cand_indexes, token_ids = indexes2nparray(max_length, cand_indexes, token_ids)
 
     return [tokens, segment, mask], [cand_indexes, token_ids] #, can_index_len # include ['SEP']
 
 
-def tokenize_text_with_cand_indexes_to_words(text, max_length, tokenizer):
+def tokenize_text_with_cand_indexes_to_words(text, max_length, tokenizer, ragged=False):
     # words = re.findall('[^0-9a-zA-Z]|[0-9a-zA-Z]+', text.lower())
     # words = list(filter(lambda x: x!=' ', words))
     # words = list(itertools.chain(*[tokenizer.tokenize(x) for x in words]))
@@ -1327,7 +1440,10 @@ def tokenize_text_with_cand_indexes_to_words(text, max_length, tokenizer):
     mask = np.array([1] * can_index_len + [0] * (max_length - can_index_len))
     segment = np.array([0] * max_length)
 
-    cand_indexes, token_ids = indexes2nparray(max_length, cand_indexes, token_ids)
+    if ragged: # [word_lens, flat_token_ids], see indexes2csr
+        cand_indexes, token_ids = indexes2csr(max_length, token_ids)
+    else:
+        cand_indexes, token_ids = indexes2nparray(max_length, cand_indexes, token_ids)
 
     return [tokens, segment, mask], [cand_indexes, token_ids], words#, can_index_len # include ['SEP']
 
@@ -1360,7 +1476,7 @@ def tokenize_list_with_cand_indexes(words, max_length, tokenizer):
     return [tokens, segment, mask], [cand_indexes, token_ids]#, can_index_len # include ['SEP']
 
 
-def tokenize_list_with_cand_indexes_lang_status(words, max_length, tokenizer):
+def tokenize_list_with_cand_indexes_lang_status(words, max_length, tokenizer, ragged=False):
     # words = re.findall('[^0-9a-zA-Z]|[0-9a-zA-Z]+', text.lower())
     # words = list(filter(lambda x: x!=' ', words))
     # words = list(itertools.chain(*[tokenizer.tokenize(x) for x in words]))
@@ -1390,11 +1506,14 @@ def tokenize_list_with_cand_indexes_lang_status(words, max_length, tokenizer):
     mask = np.array([1] * can_index_len + [0] * (max_length - can_index_len))
     segment = np.array([0] * max_length)
 
-    cand_indexes, token_ids = indexes2nparray(max_length, cand_indexes, token_ids)
+    if ragged: # [word_lens, flat_token_ids], see indexes2csr
+        cand_indexes, token_ids = indexes2csr(max_length, token_ids)
+    else:
+        cand_indexes, token_ids = indexes2nparray(max_length, cand_indexes, token_ids)
     return [tokens, segment, mask], [cand_indexes, token_ids], [lang_status]#, can_index_len # include ['SEP']
 
 
-def tokenize_list_with_cand_indexes_lang_status_dict_vec(words, max_length, tokenizer, word_dict):
+def tokenize_list_with_cand_indexes_lang_status_dict_vec(words, max_length, tokenizer, word_dict, ragged=False):
     # words: list, max_length: int, tokenizer, word_dict: list#，word_mat: np.array
     # words = re.findall('[^0-9a-zA-Z]|[0-9a-zA-Z]+', text.lower())
     # words = list(filter(lambda x: x!=' ', words))
@@ -1425,7 +1544,10 @@ def tokenize_list_with_cand_indexes_lang_status_dict_vec(words, max_length, toke
     mask = np.array([1] * can_index_len + [0] * (max_length - can_index_len))
     segment = np.array([0] * max_length)
 
-    cand_indexes, token_ids = indexes2nparray(max_length, cand_indexes, token_ids)
+    if ragged: # [word_lens, flat_token_ids], see indexes2csr
+        cand_indexes, token_ids = indexes2csr(max_length, token_ids)
+    else:
+        cand_indexes, token_ids = indexes2nparray(max_length, cand_indexes, token_ids)
 
     word_tuples = words2dict_tuple(words, word_dict, MAX_GRAM_LEN)
     word_mat = np.zeros((max_length, 2*(MAX_GRAM_LEN-1)))
@@ -1606,7 +1728,9 @@ def dataset_to_dataloader(dataset, batch_size, local_rank=-1, training=True):
             sampler = SequentialSampler(dataset)
     else:
         sampler = DistributedSampler(dataset)
-    dataloader = DataLoader(dataset, sampler=sampler, batch_size=batch_size)
+    # the datasets with ragged cand indexes batch their examples by collate_csr
+    collate_fn = getattr(dataset, 'collate_fn', default_collate)
+    dataloader = DataLoader(dataset, sampler=sampler, batch_size=batch_size, collate_fn=collate_fn)
     return dataloader
 
 
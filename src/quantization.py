@@ -0,0 +1,66 @@
+#!/anaconda3/envs/haiqin370/bin/ python3
+# -*- coding: utf-8 -*-
+"""
+Created on at 14:20 2019-07-02
+@author: haiqinyang
+
+Feature: dynamic int8 quantization of the CWS/POS models for CPU inference
+
+Scenario:
+    The weights of the Linear layers, i.e., query/key/value, BertIntermediate.dense, BertOutput.dense, the
+    poolers and the tag heads, and of the biLSTM if any, are stored as int8, and the activations are quantized
+    on the fly. The quantized state dict is saved as the artifact and loaded back into a model quantized
+    the same way.
+
+    quantize_model(model)
+    save_quantized_model(model, 'cws_pos_int8.pt')
+
+    model = load_quantized_model(BertMLCWSPOS_with_Dict(device, config, vocab_file, 128, ...), 'cws_pos_int8.pt')
+"""
+import torch
+import torch.nn as nn
+
+import logging
+logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                    datefmt = '%m/%d/%Y %H:%M:%S',
+                    level = logging.INFO)
+logger = logging.getLogger(__name__)
+
+QUANTIZED_WEIGHTS_NAME = 'pytorch_model_int8.pt'
+
+
+def quantize_model(model, dtype=torch.qint8, quantize_lstm=True):
+    """
+    Quantize the Linear layers of model, and its LSTMs if quantize_lstm, in place. Only supported on the CPU,
+    so model is moved there. The embeddings, the LayerNorms and the CRF transitions stay in float32.
+    """
+    if not hasattr(torch, 'quantization') or not hasattr(torch.quantization, 'quantize_dynamic'):
+        raise RuntimeError('Dynamic quantization needs pytorch >= 1.3!')
+
+    model.to('cpu')
+    if hasattr(model, 'device'):
+        model.device = torch.device('cpu')
+    model.eval()
+
+    module_types = {nn.Linear, nn.LSTM} if quantize_lstm else {nn.Linear}
+    torch.quantization.quantize_dynamic(model, module_types, dtype=dtype, inplace=True)
+    model.quantized = True
+
+    return model
+
+
+def save_quantized_model(model, output_file):
+    # the packed int8 weights are in the state dict
+    if not getattr(model, 'quantized', False):
+        raise ValueError('model is not quantized, call quantize_model first!')
+
+    torch.save(model.state_dict(), output_file)
+    logger.info('Saved the quantized weights to {}'.format(output_file))
+
+
+def load_quantized_model(model, model_file, dtype=torch.qint8, quantize_lstm=True):
+    """Quantize model, a newly built float32 model, and load the weights saved by save_quantized_model."""
+    quantize_model(model, dtype, quantize_lstm)
+    model.load_state_dict(torch.load(model_file, map_location='cpu'))
+
+    return model
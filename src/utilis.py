@@ -14,10 +14,11 @@ import re
 import pandas as pd
 import torch
 import numpy as np
-from .config import UNK_TOKEN, PUNC_TOKENS, UNUSED_SPACE_TOKEN
+from .config import UNK_TOKEN, PUNC_TOKENS, UNUSED_SPACE_TOKEN, segType
 from functools import reduce
 import operator
 import random
+from collections import OrderedDict
 
 import logging
 logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
@@ -866,3 +867,380 @@ def extract_pos(pos_list):
     return result_pos_str
 
 
+
+
+def window_text_stream(input_iter, max_chars):
+    """Group an iterator of texts into lists whose total length is at most max_chars.
+
+    A single text longer than max_chars is emitted on its own, so every text is
+    yielded exactly once and in the original order.
+    """
+    window = []
+    num_chars = 0
+
+    for text in input_iter:
+        if isinstance(text, float): text = '' # empty line converted to nan
+
+        if window and num_chars+len(text) > max_chars:
+            yield window
+            window = []
+            num_chars = 0
+
+        window.append(text)
+        num_chars += len(text)
+
+    if window:
+        yield window
+
+
+def stream_cutlist(cutlist_fn, input_iter, len_max, window_size):
+    """Yield the output of cutlist_fn for each text of input_iter, one text at a time.
+
+    Texts are decoded in windows of about window_size chunks of len_max characters,
+    so only one window is held in memory however long input_iter is.
+    """
+    for text_list in window_text_stream(input_iter, len_max*window_size):
+        for result in cutlist_fn(text_list):
+            yield result
+
+
+def bucket_by_length(seq_list, batch_size, max_length):
+    """Schedule seq_list into batches of sequences with similar lengths.
+
+    Sequences are sorted by length so that each batch only needs to be padded to its longest member
+    (plus [CLS] and [SEP], at most max_length). Yield (indexes, padded_length), where indexes are the
+    positions in seq_list, so that the results can be put back in the original order.
+    Empty sequences are skipped.
+    """
+    sorted_idx = sorted([i for i in range(len(seq_list)) if seq_list[i]], key=lambda i: len(seq_list[i]))
+
+    for i in range(0, len(sorted_idx), batch_size):
+        batch_idx = sorted_idx[i:i+batch_size]
+        padded_length = min(len(seq_list[batch_idx[-1]])+2, max_length)
+
+        yield batch_idx, padded_length
+
+
+def pack_sequences(lengths, max_length):
+    """Pack sequences of lengths into rows of at most max_length positions, best fit decreasing.
+
+    Each sequence goes to the fullest row that still has room for it, so that the padding left in the rows
+    is small. Return a list of rows, each the list of the indexes of its sequences in lengths.
+    Sequences longer than max_length are put alone in a row.
+    """
+    rows = []
+    free_rows = {} # remaining space -> indexes of the rows with that much space
+
+    for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        space = min([s for s in free_rows if s >= lengths[i]], default=None)
+
+        if space is None:
+            rows.append([i])
+            r = len(rows) - 1
+            space = max_length
+        else:
+            r = free_rows[space].pop()
+            if not free_rows[space]: del free_rows[space]
+            rows[r].append(i)
+
+        space -= lengths[i]
+        if space > 0:
+            free_rows.setdefault(space, []).append(r)
+
+    return rows
+
+
+def pack_row(arrays_list, lengths, padded_length):
+    """Concatenate the first lengths[k] values of the arrays of each sequence k of a packed row.
+
+    arrays_list: one tuple of arrays per sequence, e.g., (input_ids, segment_ids, input_mask, label_ids), packed
+    along their first dimension.
+    Return the tuple of the packed arrays padded by 0 to padded_length and the pack_ids of the row, i.e.,
+    the 1-based index of the sequence of each position, 0 for padding, see BertModel.
+    """
+    num_padding = padded_length - sum(lengths)
+
+    packed = []
+    for arrays in zip(*arrays_list):
+        values = [np.asarray(a)[:n] for a, n in zip(arrays, lengths)]
+        packed.append(np.concatenate(values + [np.zeros((num_padding,)+values[0].shape[1:], dtype=values[0].dtype)]))
+
+    pack_ids = np.concatenate([np.full(n, k+1, dtype=np.int64) for k, n in enumerate(lengths)] \
+                              + [np.zeros(num_padding, dtype=np.int64)])
+
+    return tuple(packed), pack_ids
+
+
+def unpack_tags(tags_list, lengths_list):
+    # split the decoded tags of each packed row into its sequences, lengths_list: the lengths of each row
+    unpacked = []
+    for tags, lengths in zip(tags_list, lengths_list):
+        start = 0
+        for n in lengths:
+            unpacked.append(tags[start:start+n])
+            start += n
+
+    return unpacked
+
+
+class LRUCache(object):
+    """Bounded least-recently-used cache with hit/miss/eviction counters."""
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        if key in self.data:
+            self.data.move_to_end(key)
+            self.hits += 1
+            return self.data[key]
+
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        if key in self.data:
+            self.data.move_to_end(key)
+        self.data[key] = value
+
+        while len(self.data) > self.max_size:
+            self.data.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.data.clear()
+
+    def stats(self):
+        num_access = self.hits + self.misses
+        return {'size': len(self.data), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses, \
+                'evictions': self.evictions, 'hit_rate': self.hits / num_access if num_access else 0.}
+
+    def __len__(self):
+        return len(self.data)
+
+
+def tokenize_with_offsets(tokenizer, text, unk_if_empty=False):
+    # tokens of text and their (start, end) offsets in text, an empty text gives one [UNK] if unk_if_empty
+    tokens, offsets = tokenizer.tokenize_with_offsets(text)
+    if not tokens and unk_if_empty:
+        return [UNK_TOKEN], [(0, len(text))]
+
+    return tokens, offsets
+
+
+def decode_chunks(chunk_list, tokenize_fn, seg_fn, batch_size, max_length, num_outputs=2, chunk_cache=None, \
+                  fingerprint=None):
+    """Tokenize and decode text chunks, looking them up in chunk_cache first.
+
+    tokenize_fn(chunk) returns the tokens of chunk and their (start, end) offsets in chunk.
+    seg_fn(token_lists, padded_length) decodes a batch and returns num_outputs lists of tag arrays.
+    Only the chunks missing from chunk_cache are tokenized and decoded, in length buckets.
+    Return the token lists, the offset lists and num_outputs lists of tag arrays, all in the order of chunk_list.
+    """
+    len_chunks = len(chunk_list)
+    token_list = [None] * len_chunks
+    offset_list = [None] * len_chunks
+    output_lists = [[''] * len_chunks for _ in range(num_outputs)]
+
+    miss_chunks = {} # chunk -> indexes in chunk_list, so that duplicated chunks are decoded once
+    for idx, chunk in enumerate(chunk_list):
+        cached = chunk_cache.get((fingerprint, chunk)) if chunk_cache is not None else None
+        if cached is None:
+            miss_chunks.setdefault(chunk, []).append(idx)
+        else:
+            token_list[idx], offset_list[idx] = cached[0], cached[1]
+            for k in range(num_outputs): output_lists[k][idx] = cached[2][k]
+
+    miss_chunk_list = list(miss_chunks.keys())
+    miss_token_list = []
+    miss_offset_list = []
+    for chunk in miss_chunk_list:
+        tokens, offsets = tokenize_fn(chunk)
+        miss_token_list.append(tokens)
+        miss_offset_list.append(offsets)
+    miss_output_lists = [[''] * len(miss_chunk_list) for _ in range(num_outputs)]
+
+    for b_idx, b_max_length in bucket_by_length(miss_token_list, batch_size, max_length):
+        outputs = seg_fn([miss_token_list[i] for i in b_idx], b_max_length)
+        if num_outputs == 1: outputs = (outputs,)
+
+        for k in range(num_outputs):
+            for i, output_i in zip(b_idx, outputs[k]):
+                miss_output_lists[k][i] = output_i
+
+    for m_idx, chunk in enumerate(miss_chunk_list):
+        outputs = tuple(miss_output_lists[k][m_idx] for k in range(num_outputs))
+        for idx in miss_chunks[chunk]:
+            token_list[idx] = miss_token_list[m_idx]
+            offset_list[idx] = miss_offset_list[m_idx]
+            for k in range(num_outputs): output_lists[k][idx] = outputs[k]
+
+        if chunk_cache is not None:
+            chunk_cache.put((fingerprint, chunk), (miss_token_list[m_idx], miss_offset_list[m_idx], outputs))
+
+    return token_list, offset_list, output_lists
+
+
+def bio2pos_index(pos_tags, default_index=35):
+    # map the BIO tag ids of POS, see POSType.BIO_idx_to_label_map, to the indexes of POSType.POS_label_map
+    pos_tags = np.asarray(pos_tags, dtype=np.int64)
+    return np.where(pos_tags > 2, (pos_tags-2)//3, default_index)
+
+
+def clean_cws_tags(cws_tags, lang_status=None):
+    # the BMES tag ids of a chunk, the tokens tagged [START] or [END] are separated words, i.e., S,
+    # and so are the tokens of lang_status 1, i.e., the english words
+    cws_tags = np.array(cws_tags, dtype=np.int64)
+    cws_tags[cws_tags < segType.BMES_label_map['B']] = segType.BMES_label_map['S']
+    if lang_status is not None:
+        cws_tags[np.asarray(lang_status)[:len(cws_tags)] == 1] = segType.BMES_label_map['S']
+
+    return cws_tags
+
+
+def word_starts(cws_tags):
+    # a word starts at a token tagged B or following a token tagged E or S, and at the first token
+    word_start = cws_tags == segType.BMES_label_map['B']
+    word_start[1:] |= cws_tags[:-1] > segType.BMES_label_map['M'] # after E and S
+    word_start[0] = True
+
+    return word_start
+
+
+def tags_to_spans(chunk_list, offset_list, cws_tag_list, pos_tag_list=None, pos_vote='first'):
+    """Rebuild the words of a text from the offsets and the tag ids of the tokens of its chunks.
+
+    chunk_list: the chunks of the text; offset_list: (start, end) of each token in its chunk;
+    cws_tag_list: BMES tag ids of each chunk; pos_tag_list: POS indexes of each chunk, optional.
+    A word starts at a token tagged B or following a token tagged E or S. The POS of a word is the one of
+    its first token, or the most frequent one if pos_vote='majority'.
+    Return the (start, end) of the words in ''.join(chunk_list), shape [num_words, 2],
+    and the array of their POS indexes (None if pos_tag_list is None).
+    """
+    spans = []
+    chunk_start = 0
+    for chunk, offsets, tags in zip(chunk_list, offset_list, cws_tag_list):
+        spans.extend((chunk_start+s, chunk_start+e) for s, e in offsets[:len(tags)])
+        chunk_start += len(chunk)
+    spans = np.array(spans, dtype=np.int64).reshape(-1, 2)
+
+    cws_tags = [np.asarray(tags, dtype=np.int64) for tags in cws_tag_list if len(tags)]
+    cws_tags = np.concatenate(cws_tags) if cws_tags else np.zeros(0, dtype=np.int64)
+    cws_tags = cws_tags[:len(spans)]
+    num_tokens = len(cws_tags)
+
+    if num_tokens == 0:
+        return np.zeros((0, 2), dtype=np.int64), (None if pos_tag_list is None else np.zeros(0, dtype=np.int64))
+
+    word_start = word_starts(cws_tags)
+
+    starts = np.flatnonzero(word_start)
+    ends = np.append(starts[1:], num_tokens) - 1
+    word_spans = np.stack([spans[starts, 0], spans[ends, 1]], axis=1)
+
+    if pos_tag_list is None:
+        return word_spans, None
+
+    pos_tags = [np.asarray(tags, dtype=np.int64) for tags in pos_tag_list if len(tags)]
+    pos_tags = np.concatenate(pos_tags)[:num_tokens]
+
+    if pos_vote == 'majority':
+        num_words = len(starts)
+        num_pos = int(pos_tags.max()) + 1
+        word_ids = np.cumsum(word_start) - 1
+        counts = np.bincount(word_ids*num_pos + pos_tags, minlength=num_words*num_pos).reshape(num_words, num_pos)
+        word_pos = counts.argmax(axis=1)
+    else:
+        word_pos = pos_tags[starts]
+
+    return word_spans, word_pos
+
+
+def word_confidences(offset_list, cws_tag_list, cws_confidence_list, pos_confidence_list=None):
+    """Confidences of the words of tags_to_spans, from the confidences of the tags of their tokens.
+
+    cws_confidence_list, pos_confidence_list: the probability of the CWS and of the POS tag of each token of each
+    chunk, e.g., its marginal probability, see tag_confidences in customize_modeling.
+    The confidence of a word is the lowest one of its tokens, an upper bound of the probability of the word;
+    the one of its POS is the one of its first token, as its POS of pos_vote='first'.
+    Return the arrays of the confidences of the words and of their POS (None if pos_confidence_list is None).
+    """
+    num_tokens = sum(min(len(offsets), len(tags)) for offsets, tags in zip(offset_list, cws_tag_list))
+    cws_tags = [np.asarray(tags, dtype=np.int64) for tags in cws_tag_list if len(tags)]
+    cws_tags = np.concatenate(cws_tags)[:num_tokens] if cws_tags else np.zeros(0, dtype=np.int64)
+    num_tokens = len(cws_tags)
+
+    if num_tokens == 0:
+        return np.zeros(0), (None if pos_confidence_list is None else np.zeros(0))
+
+    word_start = word_starts(cws_tags)
+    word_ids = np.cumsum(word_start) - 1
+
+    confidences = np.concatenate([np.asarray(c, dtype=np.float64) for c in cws_confidence_list if len(c)])[:num_tokens]
+    word_confidence = np.ones(word_ids[-1] + 1)
+    np.minimum.at(word_confidence, word_ids, confidences)
+
+    if pos_confidence_list is None:
+        return word_confidence, None
+
+    pos_confidences = np.concatenate([np.asarray(c, dtype=np.float64) for c in pos_confidence_list if len(c)])
+    return word_confidence, pos_confidences[:num_tokens][word_start]
+
+
+def spans_to_words(text, word_spans, word_pos=None):
+    # slice the words out of text; a word containing spaces is split and its parts keep its POS
+    words = []
+    pos_list = []
+    for k, (start, end) in enumerate(word_spans.tolist()):
+        for word in text[start:end].split():
+            words.append(word)
+            if word_pos is not None: pos_list.append(word_pos[k])
+
+    return words, pos_list
+
+
+def sliding_windows(unit_lens, window_size, stride):
+    """Split a sequence of units, unit k having unit_lens[k] tokens, into overlapping windows.
+
+    Every window holds at most window_size tokens (at least one unit) and the next one starts about stride
+    tokens later. Only the centre region of a window is kept: the overlap of two consecutive windows is split
+    at its middle, so the kept regions cover the sequence exactly once.
+    Return a list of (window_start, window_end, keep_start, keep_end), all indexes of units.
+    """
+    num_units = len(unit_lens)
+    if num_units == 0:
+        return []
+
+    cum_lens = np.concatenate([[0], np.cumsum(unit_lens)])
+
+    windows = []
+    w_start = 0
+    while True:
+        w_end = int(np.searchsorted(cum_lens, cum_lens[w_start]+window_size, side='right')) - 1
+        w_end = min(max(w_end, w_start+1), num_units)
+        windows.append([w_start, w_end])
+        if w_end >= num_units:
+            break
+
+        next_start = int(np.searchsorted(cum_lens, cum_lens[w_start]+stride, side='left'))
+        w_start = min(max(next_start, w_start+1), w_end)
+
+    results = []
+    keep_start = 0
+    for k, (w_start, w_end) in enumerate(windows):
+        if k+1 < len(windows):
+            # middle of the overlap with the next window, in tokens
+            next_start = windows[k+1][0]
+            middle = (cum_lens[next_start] + cum_lens[w_end]) / 2.
+            keep_end = int(np.searchsorted(cum_lens, middle, side='left'))
+            keep_end = min(max(keep_end, next_start, keep_start+1), w_end)
+        else:
+            keep_end = num_units
+
+        results.append((w_start, w_end, keep_start, keep_end))
+        keep_start = keep_end
+
+    return results